@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+'''
+This script times the fast paths of some loading steps against the original paths, and checks that their output is identical.
+
+Usage:
+  ./etc/benchmark.py parse /path/to/assoc-file.tsv.gz [--num-samples=5000] [--minimum-maf=0.01]
+  ./etc/benchmark.py write /path/to/generated-by-pheweb/parsed/phenocode
+  ./etc/benchmark.py index /path/to/generated-by-pheweb/parsed/phenocode
+  ./etc/benchmark.py best-of-pheno /path/to/generated-by-pheweb/pheno_gz/phenocode.gz
+  ./etc/benchmark.py qq-strata [--num-variants=50000000]
+  ./etc/benchmark.py qq-streaming [--num-variants=50000000]
+'''
+
+import argparse
+import csv
+import gzip
+import os
+import tempfile
+import time
+
+
+def timed(label, f):
+    start = time.time()
+    rv = f()
+    print('{:>30}: {:.2f} seconds'.format(label, time.time() - start))
+    return rv
+
+def timed_with_peak_memory(label, f):
+    import tracemalloc
+    tracemalloc.start()
+    rv = timed(label, f)
+    print('{:>30}  peak memory: {:.0f} MB'.format('', tracemalloc.get_traced_memory()[1] / 1e6))
+    tracemalloc.stop()
+    return rv
+
+def read_file(filepath):
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    return gzip.decompress(data) if data[:2] == b'\x1f\x8b' else data
+
+
+def benchmark_parse(args):
+    from pheweb.load.read_input_file import PhenoReader
+    from pheweb.file_utils import VariantFileWriter
+
+    pheno = {'phenocode': 'benchmark', 'assoc_files': args.assoc_files}
+    if args.num_samples: pheno['num_samples'] = args.num_samples
+
+    def parse_by_variant(out_filepath):
+        with VariantFileWriter(out_filepath) as writer:
+            writer.write_all(PhenoReader(pheno, minimum_maf=args.minimum_maf).get_variants())
+    def parse_by_chunk(out_filepath):
+        with VariantFileWriter(out_filepath) as writer:
+            for chunk in PhenoReader(pheno, minimum_maf=args.minimum_maf).get_variant_chunks():
+                writer.write_columns(chunk)
+
+    out_filepaths = [os.path.join(args.data_dir, 'parsed-by-variant'), os.path.join(args.data_dir, 'parsed-by-chunk')]
+    timed('parse one variant at a time', lambda: parse_by_variant(out_filepaths[0]))
+    timed('parse by chunk', lambda: parse_by_chunk(out_filepaths[1]))
+    print('outputs are identical' if read_file(out_filepaths[0]) == read_file(out_filepaths[1]) else 'OUTPUTS DIFFER!')
+
+
+def benchmark_write(args):
+    from pheweb.file_utils import VariantFileReader, VariantFileWriter
+    with VariantFileReader(args.variant_file) as reader:
+        fields = reader.fields
+        variants = list(reader)
+
+    def write_with_dictwriter(out_filepath):
+        with gzip.open(out_filepath, 'wt', compresslevel=2) as f:
+            writer = csv.DictWriter(f, fieldnames=fields, dialect='pheweb-internal-dialect')
+            writer.writeheader()
+            for v in variants: writer.writerow(v)
+    def write_with_VariantFileWriter(out_filepath):
+        with VariantFileWriter(out_filepath) as writer:
+            writer.write_all(variants)
+
+    out_filepaths = [os.path.join(args.data_dir, 'csv-dictwriter'), os.path.join(args.data_dir, 'variantfilewriter')]
+    timed('csv.DictWriter', lambda: write_with_dictwriter(out_filepaths[0]))
+    timed('VariantFileWriter', lambda: write_with_VariantFileWriter(out_filepaths[1]))
+    print('outputs are identical' if read_file(out_filepaths[0]) == read_file(out_filepaths[1]) else 'OUTPUTS DIFFER!')
+
+
+def benchmark_index(args):
+    import pysam
+    from pheweb.file_utils import VariantFileReader, VariantFileWriter, IndexedVariantFileWriter, convert_VariantFile_to_IndexedVariantFile
+    with VariantFileReader(args.variant_file) as reader:
+        variants = list(reader)
+
+    def write_then_convert(out_filepath):
+        unzipped_filepath = out_filepath + '.tsv'
+        with VariantFileWriter(unzipped_filepath, use_gzip=False) as writer:
+            writer.write_all(variants)
+        pysam.tabix_compress(unzipped_filepath, out_filepath, force=True)
+        pysam.tabix_index(filename=out_filepath, force=True, seq_col=0, start_col=1, end_col=1, line_skip=1)
+        os.unlink(unzipped_filepath)
+    def write_indexed(out_filepath):
+        with IndexedVariantFileWriter(out_filepath) as writer:
+            writer.write_all(variants)
+
+    out_filepaths = [os.path.join(args.data_dir, 'tabix-index'), os.path.join(args.data_dir, 'indexedvariantfilewriter')]
+    timed('write, bgzip, then tabix', lambda: write_then_convert(out_filepaths[0]))
+    timed('IndexedVariantFileWriter', lambda: write_indexed(out_filepaths[1]))
+    tabix_files = [pysam.TabixFile(filepath) for filepath in out_filepaths]
+    identical = read_file(out_filepaths[0]) == read_file(out_filepaths[1]) and all(
+        list(tabix_files[0].fetch(chrom)) == list(tabix_files[1].fetch(chrom)) for chrom in tabix_files[0].contigs)
+    print('outputs are identical' if identical else 'OUTPUTS DIFFER!')
+
+
+def benchmark_best_of_pheno(args):
+    from pheweb.file_utils import VariantFileReader, VariantFileWriter
+    from pheweb.utils import get_chrom_pos_key
+    from pheweb.load.load_utils import MaxPriorityQueue, scan_variant_file
+    from pheweb.load import best_of_pheno
+
+    class HeapBestOfPhenoFileMaker:
+        # This is how `best_of_pheno.BestOfPhenoFileMaker` used to work.
+        def __init__(self, out_filepath):
+            self._out_filepath = out_filepath
+            self._q = MaxPriorityQueue()
+        def process_variant(self, v):
+            self._q.add_and_keep_size(v, v['pval'], best_of_pheno.NUM_VARIANTS)
+        def finish(self):
+            assocs = list(self._q.pop_all())
+            assocs.sort(key=lambda v: get_chrom_pos_key(v['chrom'], v['pos']))
+            with VariantFileWriter(self._out_filepath) as vfw: vfw.write_all(assocs)
+
+    out_filepaths = [os.path.join(args.data_dir, 'heap'), os.path.join(args.data_dir, 'two-pass')]
+    timed('MaxPriorityQueue', lambda: scan_variant_file(args.pheno_file, [HeapBestOfPhenoFileMaker(out_filepaths[0])]))
+    timed('two passes with np.partition', lambda: best_of_pheno.make_bestof_file_explicit(args.pheno_file, out_filepaths[1]))
+    if read_file(out_filepaths[0]) == read_file(out_filepaths[1]):
+        print('outputs are identical')
+    else:
+        # `MaxPriorityQueue` keeps an arbitrary subset of the variants tied at the largest pval kept, but the two-pass version keeps the first ones.
+        variant_sets = []
+        for out_filepath in out_filepaths:
+            with VariantFileReader(out_filepath) as reader:
+                variants = list(reader)
+            threshold = max(v['pval'] for v in variants)
+            variant_sets.append((len(variants), threshold, {tuple(v.values()) for v in variants if v['pval'] < threshold}))
+        print('outputs only differ in which tied variants are kept' if variant_sets[0] == variant_sets[1] else 'OUTPUTS DIFFER!')
+
+
+def benchmark_qq_strata(args):
+    import numpy as np
+    from pheweb.load import qq
+    rng = np.random.default_rng(0)
+    variants = np.empty(args.num_variants, dtype=[('maf',np.float32),('qval',np.float32)])
+    variants['maf'] = np.round(rng.uniform(0.001, 0.5, args.num_variants), 3)  # rounded, so that there are ties at the borders
+    variants['qval'] = -np.log10(rng.uniform(size=args.num_variants))
+
+    def by_sorting():
+        # This is how `qq.make_qq_stratified()` used to split the variants.
+        sorted_variants = variants[np.argsort(variants['maf'])]
+        rv = []
+        for idx in range(qq.NUM_MAF_RANGES):
+            start, stop = len(variants) * idx // qq.NUM_MAF_RANGES, len(variants) * (idx+1) // qq.NUM_MAF_RANGES
+            qvals = sorted_variants['qval'][start:stop].copy()
+            qvals[::-1].sort()
+            rv.append((sorted_variants['maf'][start], sorted_variants['maf'][stop-1], len(qvals)))
+        return rv
+    def by_partition():
+        strata, maf_ranges = qq.get_maf_strata(variants['maf'])
+        rv = []
+        for idx in range(qq.NUM_MAF_RANGES):
+            qvals = variants['qval'][strata == idx]
+            qvals[::-1].sort()
+            rv.append((maf_ranges[idx][0], maf_ranges[idx][1], len(qvals)))
+        return rv
+
+    strata_by_sorting = timed_with_peak_memory('argsort by maf', by_sorting)
+    strata_by_partition = timed_with_peak_memory('qq.get_maf_strata', by_partition)
+    print('maf ranges and counts are identical' if strata_by_sorting == strata_by_partition else 'MAF RANGES OR COUNTS DIFFER!')
+
+
+def benchmark_qq_streaming(args):
+    import numpy as np
+    from pheweb.load import qq
+    def get_chunks():
+        # Variants are made in chunks, so that they only take memory while the QQ keeps them.
+        rng = np.random.default_rng(0)
+        for chunk_start in range(0, args.num_variants, qq.SKETCH_CHUNK_SIZE):
+            chunk_size = min(qq.SKETCH_CHUNK_SIZE, args.num_variants - chunk_start)
+            yield rng.uniform(0.001, 0.5, chunk_size).astype(np.float32), -np.log10(rng.uniform(size=chunk_size)).astype(np.float32)
+
+    def exact():
+        variants = np.empty(args.num_variants, dtype=[('maf',np.float32),('qval',np.float32)])
+        for chunk_start, (mafs, qvals) in zip(range(0, args.num_variants, qq.SKETCH_CHUNK_SIZE), get_chunks()):
+            variants['maf'][chunk_start:chunk_start + len(mafs)] = mafs
+            variants['qval'][chunk_start:chunk_start + len(qvals)] = qvals
+        return qq.make_qq_json(variants)
+    def streaming():
+        sketch = qq.QQSketch(has_maf=True)
+        for mafs, qvals in get_chunks():
+            sketch.add(mafs, qvals)
+        return qq.make_qq_json_from_sketch(sketch)
+
+    exact_qq = timed_with_peak_memory('qq.make_qq_json', exact)
+    streaming_qq = timed_with_peak_memory('qq.make_qq_json_from_sketch', streaming)
+    print('counts and confidence intervals are identical' if
+          exact_qq['ci'] == streaming_qq['ci'] and
+          [s['count'] for s in exact_qq['by_maf']] == [s['count'] for s in streaming_qq['by_maf']] else 'COUNTS OR CIS DIFFER!')
+    for perc in qq.GC_LAMBDA_PERCS:
+        print('gc_lambda at {:>5}: {} exact, {} streaming'.format(perc, exact_qq['overall']['gc_lambda'].get(perc), streaming_qq['overall']['gc_lambda'].get(perc)))
+    for exact_stratum, streaming_stratum in zip(exact_qq['by_maf'], streaming_qq['by_maf']):
+        exact_bins, streaming_bins = set(exact_stratum['qq']['bins']), set(streaming_stratum['qq']['bins'])
+        print('maf {:.3f}-{:.3f}: {} of {} bins are the same'.format(*exact_stratum['maf_range'], len(exact_bins & streaming_bins), len(exact_bins | streaming_bins)))
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    p = subparsers.add_parser('parse', help='time `pheweb parse-input-files` on one phenotype')
+    p.add_argument('assoc_files', nargs='+')
+    p.add_argument('--num-samples', type=int)
+    p.add_argument('--minimum-maf', type=float, default=0)
+    p.set_defaults(func=benchmark_parse)
+    p = subparsers.add_parser('write', help='time writing every variant in an internal variant file')
+    p.add_argument('variant_file')
+    p.set_defaults(func=benchmark_write)
+    p = subparsers.add_parser('index', help='time writing an internal variant file and its tabix index')
+    p.add_argument('variant_file')
+    p.set_defaults(func=benchmark_index)
+    p = subparsers.add_parser('best-of-pheno', help='time making a best-of-pheno file from one pheno file')
+    p.add_argument('pheno_file')
+    p.set_defaults(func=benchmark_best_of_pheno)
+    p = subparsers.add_parser('qq-strata', help='time splitting variants into maf strata for QQ plots, and measure peak memory (not counting the variants)')
+    p.add_argument('--num-variants', type=int, default=50_000_000)
+    p.set_defaults(func=benchmark_qq_strata)
+    p = subparsers.add_parser('qq-streaming', help='time making a QQ with and without `qq_streaming = True`, and measure peak memory')
+    p.add_argument('--num-variants', type=int, default=50_000_000)
+    p.set_defaults(func=benchmark_qq_streaming)
+    args = parser.parse_args()
+    if not hasattr(args, 'func'): parser.error('choose a benchmark')
+
+    from pheweb import conf
+    with tempfile.TemporaryDirectory() as data_dir:
+        conf.set_override('data_dir', data_dir)
+        args.data_dir = data_dir
+        args.func(args)
+
+if __name__ == '__main__':
+    run()
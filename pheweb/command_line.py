@@ -46,6 +46,7 @@ for submodule in '''
  best_of_pheno
  manhattan
  qq
+ summarize_phenos
  matrix
  top_hits
  phenotypes
@@ -134,11 +134,20 @@ def get_num_procs(cmd:Optional[str] = None) -> int:
     except Exception: pass
     n_cpus = multiprocessing.cpu_count()
     return 1 if n_cpus==1 else int(n_cpus * 3/4)
+def get_num_compression_threads() -> int:
+    import multiprocessing
+    return _get_config_int('num_compression_threads', min(4, multiprocessing.cpu_count()))
+def get_matrix_phenos_per_shard() -> Optional[int]: return _get_config_optional_int('matrix_phenos_per_shard')
+def should_make_sparse_matrix() -> bool: return _get_config_bool('matrix_sparse', False)
+def should_index_pheno_sites() -> bool: return _get_config_bool('pheno_gz_site_index', False)
+def should_write_pheno_sidecars() -> bool: return _get_config_bool('pheno_sidecars', False)
+def should_stream_qq() -> bool: return _get_config_bool('qq_streaming', False)
 
 
 
 ## Parsing config
 def get_assoc_min_maf() -> float: return _get_config_float('assoc_min_maf', 0)
+def should_merge_sites_by_chrom() -> bool: return _get_config_bool('sites_by_chrom', False)
 def get_field_aliases() -> Dict[str,str]:
     return overrides.get('field_aliases', parse_utils.default_field_aliases)
 
@@ -1,20 +1,29 @@
 
-from .utils import PheWebError, get_phenolist, chrom_order
+from .utils import PheWebError, get_phenolist, chrom_order, get_chrom_pos_key, get_chrom_pos_keys
 from . import conf
 from . import parse_utils
 
 import io
 import os
+import re
 import csv
-from contextlib import contextmanager
+import shutil
+import struct
+import array
+import zlib
+import concurrent.futures
+from contextlib import contextmanager, ExitStack
 import json
 import gzip
 import datetime
 from boltons.fileutils import AtomicSaver, mkdir_p
 import pysam
 import itertools, random
+import collections, collections.abc, functools, operator
+import numpy as np
 from pathlib import Path
-from typing import List, Callable, Dict, Union, Iterator, Optional, Any
+import typing as ty
+from typing import List, Tuple, Sequence, Callable, Dict, Union, Iterator, Iterable, Optional, Any, Type, cast
 
 
 def get_generated_path(*path_parts:str) -> str:
@@ -47,11 +56,13 @@ _single_filepaths: Dict[str,Callable[[],str]] = {
     'unanno': (lambda: get_generated_path('sites/sites-unannotated.tsv')),
     'sites-rsids': (lambda: get_generated_path('sites/sites-rsids.tsv')),
     'sites': (lambda: get_generated_path('sites/sites.tsv')),
+    'sites-table': (lambda: get_generated_path('sites/sites-table')),
     'best-phenos-by-gene-sqlite3': (lambda: get_generated_path('best-phenos-by-gene.sqlite3')),
     'best-phenos-by-gene-old-json': (lambda: get_generated_path('best-phenos-by-gene.json')),
     'correlations': (lambda: get_generated_path('pheno-correlations.txt')),
     'cpras-rsids-sqlite3': (lambda: get_generated_path('sites/cpras-rsids.sqlite3')),
     'matrix': (lambda: get_generated_path('matrix.tsv.gz')),
+    'matrix-manifest': (lambda: get_generated_path('matrix', 'manifest.json')),
     'top-hits': (lambda: get_generated_path('top_hits.json')),
     'top-hits-1k': (lambda: get_generated_path('top_hits_1k.json')),
     'top-hits-tsv': (lambda: get_generated_path('top_hits.tsv')),
@@ -75,9 +86,12 @@ def get_pheno_filepath(kind:str, phenocode:str, *, must_exist:bool = True) -> st
     return filepath
 _pheno_filepaths: Dict[str,Callable[[str],str]] = {
     'parsed': (lambda phenocode: get_generated_path('parsed', phenocode)),
+    'parsed_tbi': (lambda phenocode: get_generated_path('parsed', '{}.tbi'.format(phenocode))),
     'pheno_gz': (lambda phenocode: get_generated_path('pheno_gz', '{}.gz'.format(phenocode))),
     'pheno_gz_tbi': (lambda phenocode: get_generated_path('pheno_gz', '{}.gz.tbi'.format(phenocode))),
+    'pheno_gz_sidecar': (lambda phenocode: get_generated_path('pheno_gz', '{}.gz.npy'.format(phenocode))),
     'best_of_pheno': (lambda phenocode: get_generated_path('best_of_pheno', phenocode)),
+    'best_of_pheno_sidecar': (lambda phenocode: get_generated_path('best_of_pheno', '{}.npy'.format(phenocode))),
     'manhattan': (lambda phenocode: get_generated_path('manhattan', '{}.json'.format(phenocode))),
     'qq': (lambda phenocode: get_generated_path('qq', '{}.json'.format(phenocode))),
 }
@@ -123,7 +137,7 @@ csv.register_dialect(
 ## Readers
 
 @contextmanager
-def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = False):
+def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = False, fields:Optional[List[str]] = None, records:bool = False, chrom:Optional[str] = None, row_mask:Optional[np.ndarray] = None):
     '''
     Reads variants (as dictionaries) from an internal file.  Iterable.  Exposes `.fields`.
 
@@ -131,19 +145,44 @@ def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = F
             print(reader.fields)
             for variant in reader:
                 print(variant)
+
+    `fields` parses only those fields (in that order), and `only_per_variant_fields` parses only the fields in `parse_utils.per_variant_fields`.
+    Skipping fields is the best way to speed up reading.
+    `records=True` yields namedtuples (of the type `get_variant_record_type(reader.fields)`) instead of dictionaries, which use less than half the memory.
+    `chrom` reads only the variants on that chromosome, using the file's tabix index (at `filepath + '.tbi'`).
+    Pheno files written with `pheno_gz_site_index` are read like they were written without it.
+    `row_mask` (a boolean array, like from a sidecar) reads only the variants where it's True, which skips parsing the others.
     '''
-    with read_maybe_gzip(filepath) as f:
+    with read_maybe_gzip(filepath) as f, ExitStack() as exit_stack:
         reader:Iterator[List[str]] = csv.reader(f, dialect='pheweb-internal-dialect')
-        try: fields = next(reader)
+        try: all_fields = next(reader)
         except StopIteration: raise PheWebError("It looks like the file {} is empty".format(filepath))
-        if fields[0].startswith('#'): # This won't happen in normal use but it's convenient for temporary internal re-routing
-            fields[0] = fields[0][1:]
-        for field in fields:
+        lines:Iterator[str] = f
+        if chrom is not None:
+            tabix_file = exit_stack.enter_context(pysam.TabixFile(str(filepath)))
+            lines = tabix_file.fetch(chrom) if chrom in tabix_file.contigs else iter([])
+            reader = csv.reader(lines, dialect='pheweb-internal-dialect')
+        if row_mask is not None:
+            lines = itertools.compress(lines, np.asarray(row_mask, dtype=bool).tobytes())
+            reader = csv.reader(lines, dialect='pheweb-internal-dialect')
+        if _is_site_indexed(all_fields):
+            all_fields, expand_line = _get_site_indexed_line_expander(all_fields, str(filepath))
+            reader = csv.reader(map(expand_line, lines), dialect='pheweb-internal-dialect')
+        if all_fields[0].startswith('#'): # This won't happen in normal use but it's convenient for temporary internal re-routing
+            all_fields[0] = all_fields[0][1:]
+        for field in all_fields:
             assert field in parse_utils.per_variant_fields or field in parse_utils.per_assoc_fields, field
         if only_per_variant_fields:
-            yield _vfr_only_per_variant_fields(fields, reader)
+            fields = [field for field in (fields or all_fields) if field in parse_utils.per_variant_fields]
+        for field in fields or []:
+            if field not in all_fields:
+                raise PheWebError("The field {!r} was requested from {} but it only has the fields {!r}".format(field, filepath, all_fields))
+        if records:
+            yield _vfr_records(all_fields, fields or all_fields, reader)
+        elif fields is not None:
+            yield _vfr_some_fields(all_fields, fields, reader)
         else:
-            yield _vfr(fields, reader)
+            yield _vfr(all_fields, reader)
 class _vfr:
     def __init__(self, fields:List[str], reader:Iterator[List[str]]):
         self.fields = fields
@@ -156,11 +195,11 @@ class _vfr:
             assert len(unparsed_variant) == len(self.fields), (unparsed_variant, self.fields)
             variant = {field: parser(value) for parser,field,value in zip(parsers, self.fields, unparsed_variant)}
             yield variant
-class _vfr_only_per_variant_fields:
-    def __init__(self, fields:List[str], reader:Iterator[List[str]]):
-        self._all_fields = fields
-        self._extractors = [(parse_utils.reader_for_field[field], field, colidx) for colidx,field in enumerate(fields) if field in parse_utils.per_variant_fields]
-        self.fields = [e[1] for e in self._extractors]
+class _vfr_some_fields:
+    def __init__(self, all_fields:List[str], fields:List[str], reader:Iterator[List[str]]):
+        self._all_fields = all_fields
+        self._extractors = [(parse_utils.reader_for_field[field], field, all_fields.index(field)) for field in fields]
+        self.fields = fields
         self._reader = reader
     def __iter__(self) -> Iterator[Dict[str,Any]]:
         return self._get_variants()
@@ -169,73 +208,151 @@ class _vfr_only_per_variant_fields:
             assert len(unparsed_variant) == len(self._all_fields), (unparsed_variant, self._all_fields)
             variant = {field: parser(unparsed_variant[colidx]) for parser,field,colidx in self._extractors}
             yield variant
+class _vfr_records:
+    def __init__(self, all_fields:List[str], fields:List[str], reader:Iterator[List[str]]):
+        self._all_fields = all_fields
+        self._colidxs = [all_fields.index(field) for field in fields]
+        self._parsers = [parse_utils.reader_for_field[field] for field in fields]
+        self.fields = fields
+        self.Record = get_variant_record_type(tuple(fields))
+        self._reader = reader
+    def __iter__(self) -> Iterator[tuple]:
+        return self._get_variants()
+    def _get_variants(self) -> Iterator[tuple]:
+        make_record = self.Record._make
+        num_all_fields = len(self._all_fields)
+        parsers = self._parsers
+        if self._colidxs == list(range(num_all_fields)):
+            for unparsed_variant in self._reader:
+                assert len(unparsed_variant) == num_all_fields, (unparsed_variant, self._all_fields)
+                yield make_record([parser(value) for parser,value in zip(parsers, unparsed_variant)])
+        else:
+            colidxs = self._colidxs
+            for unparsed_variant in self._reader:
+                assert len(unparsed_variant) == num_all_fields, (unparsed_variant, self._all_fields)
+                yield make_record([parser(unparsed_variant[colidx]) for parser,colidx in zip(parsers, colidxs)])
+
+@functools.lru_cache(maxsize=None)
+def get_variant_record_type(fields:Tuple[str,...]) -> Type[Any]:
+    '''
+    A namedtuple for variants with these fields.  Use `record.pval`, `record[idx]`, or `record._asdict()`.
+    Fields that are python keywords (like `or`) must be accessed with `getattr(record, 'or')`.
+    '''
+    Record = cast(Type[Any], collections.namedtuple('VariantRecord', fields, rename=True))
+    for idx, field in enumerate(fields):
+        if Record._fields[idx] != field:
+            setattr(Record, field, property(operator.itemgetter(idx)))
+    Record._fields = fields
+    return Record
+assert getattr(get_variant_record_type(('pval', 'or'))._make([0.5, 2]), 'or') == 2
+assert get_variant_record_type(('pval', 'or'))._make([0.5, 2])._asdict() == {'pval': 0.5, 'or': 2}
 
 
 @contextmanager
-def IndexedVariantFileReader(phenocode:str):
+def IndexedVariantFileReader(phenocode:str, fields:Optional[List[str]] = None, records:bool = False):
+    '''
+    Reads regions of variants from a tabixed pheno file.
+    `fields` parses only those fields, and `records=True` yields tuples (of the type `get_variant_record_type(fields)`) instead of dictionaries.
+    `get_variant()` needs the fields chrom, pos, ref, and alt.
+    '''
     filepath = get_pheno_filepath('pheno_gz', phenocode)
     with read_gzip(filepath) as f:
         reader:Iterator[List[str]] = csv.reader(f, dialect='pheweb-internal-dialect')
-        fields = next(reader)
-    if fields[0].startswith('#'): # previous version of PheWeb commented the header line
-        fields[0] = fields[0][1:]
-    for field in fields:
+        all_fields = next(reader)
+    if all_fields[0].startswith('#'): # previous version of PheWeb commented the header line
+        all_fields[0] = all_fields[0][1:]
+    expand_line = None
+    if _is_site_indexed(all_fields):
+        all_fields, expand_line = _get_site_indexed_line_expander(all_fields, filepath)
+    for field in all_fields:
         assert field in parse_utils.per_variant_fields or field in parse_utils.per_assoc_fields, field
-    colidxs = {field: idx for idx, field in enumerate(fields)}
+    for field in fields or []:
+        if field not in all_fields:
+            raise PheWebError("The field {!r} was requested from {} but it only has the fields {!r}".format(field, filepath, all_fields))
+    colidxs = {field: all_fields.index(field) for field in (fields or all_fields)}
     with pysam.TabixFile(filepath, parser=None) as tabix_file:
-        yield _ivfr(tabix_file, colidxs)
+        yield _ivfr(tabix_file, colidxs, records, expand_line)
 class _ivfr:
-    def __init__(self, _tabix_file:pysam.TabixFile, _colidxs:Dict[str,int]):
+    _expand_line:Optional[Callable[[str],str]] = None
+    def __init__(self, _tabix_file:pysam.TabixFile, _colidxs:Dict[str,int], records:bool = False, _expand_line:Optional[Callable[[str],str]] = None):
         self._tabix_file=_tabix_file
+        self._expand_line=_expand_line
         self._colidxs=_colidxs
+        self._extractors = [(field, colidx, parse_utils.reader_for_field[field]) for field, colidx in _colidxs.items()]
+        self._Record = get_variant_record_type(tuple(_colidxs)) if records else None
 
-    def _parse_variant_row(self, variant_row:List[str]) -> Dict[str,Any]:
-        variant = {}
-        for field in self._colidxs:
-            val = variant_row[self._colidxs[field]]
-            parser = parse_utils.reader_for_field[field]
-            try:
-                variant[field] = parser(val)
-            except Exception as exc:
-                raise PheWebError('ERROR: Failed to parse the value {!r} for field {!r} in file {!r}'.format(val, field, self._tabix_file.filename)) from exc
-        return variant
+    def _parse_variant_row(self, variant_row:List[str]) -> Union[Dict[str,Any],tuple]:
+        try:
+            values = [parser(variant_row[colidx]) for field, colidx, parser in self._extractors]
+        except Exception:
+            for field, colidx, parser in self._extractors:
+                val = variant_row[colidx]
+                try:
+                    parser(val)
+                except Exception as exc:
+                    raise PheWebError('ERROR: Failed to parse the value {!r} for field {!r} in file {!r}'.format(val, field, self._tabix_file.filename)) from exc
+            raise
+        if self._Record is not None:
+            return self._Record._make(values)
+        return dict(zip(self._colidxs, values))
 
-    def get_region(self, chrom:str, start:int, end:int) -> Iterator[Dict[str,Any]]:
+    def get_region(self, chrom:str, start:int, end:int) -> Iterator[Union[Dict[str,Any],tuple]]:
         '''
         includes `start`, does not include `end`
         return is like [{
               'chrom': 'X', 'pos': 43254, ...,
             }, ...]
         '''
-        if start < 1: start = 1
-        if start >= end: return []
-        if chrom not in self._tabix_file.contigs: return []
-
-        # I do not understand why I need to use `pos-1`.
-        # The pysam docs talk about being zero-based or one-based. Is this what they're referring to?
-        # Doesn't make much sense to me.  There must be a reason that I don't understand.
-        try:
-            tabix_iter = self._tabix_file.fetch(chrom, start-1, end-1, parser=None)
-        except Exception as exc:
-            raise PheWebError('ERROR when fetching {}-{}-{} from {}'.format(chrom, start-1, end-1, self._tabix_file.filename)) from exc
-        reader:Iterator[List[str]] = csv.reader(tabix_iter, dialect='pheweb-internal-dialect')
-        for variant_row in reader:
+        for variant_row in self._get_region_rows(chrom, start, end):
             yield self._parse_variant_row(variant_row)
+    def _get_region_rows(self, chrom:str, start:int, end:int) -> Iterator[List[str]]:
+        return _fetch_rows(self._tabix_file, chrom, start, end, self._expand_line)
 
-    def get_variant(self, chrom:str, pos:int, ref:str, alt:int) -> Optional[Dict[str,Any]]:
+    def get_variant(self, chrom:str, pos:int, ref:str, alt:str) -> Optional[Union[Dict[str,Any],tuple]]:
         x = self.get_region(chrom, pos, pos+1)
         for variant in x:
-            if variant['pos'] != pos:
+            v = variant._asdict() if isinstance(variant, tuple) else variant  # type: ignore
+            if v['pos'] != pos:
                 # print('WARNING: while looking for variant {}-{}-{}-{}, saw {!r}'.format(chrom, pos, ref, alt, variant))
                 continue
-            if variant['ref'] == ref and variant['alt'] == alt and variant:
+            if v['ref'] == ref and v['alt'] == alt and variant:
                 return variant
         return None
 
 
+def _fetch_rows(tabix_file:pysam.TabixFile, chrom:str, start:int, end:int, expand_line:Optional[Callable[[str],str]] = None) -> Iterator[List[str]]:
+    if start < 1: start = 1
+    if start >= end: return
+    if chrom not in tabix_file.contigs: return
+
+    # I do not understand why I need to use `pos-1`.
+    # The pysam docs talk about being zero-based or one-based. Is this what they're referring to?
+    # Doesn't make much sense to me.  There must be a reason that I don't understand.
+    try:
+        tabix_iter = tabix_file.fetch(chrom, start-1, end-1, parser=None)
+    except Exception as exc:
+        raise PheWebError('ERROR when fetching {}-{}-{} from {}'.format(chrom, start-1, end-1, tabix_file.filename)) from exc
+    if expand_line is not None: tabix_iter = map(expand_line, tabix_iter)
+    yield from csv.reader(tabix_iter, dialect='pheweb-internal-dialect')
+
+
 class MatrixReader:
+    '''
+    Reads `matrix.tsv.gz`, or, if `matrix_phenos_per_shard` is set, the files in `matrix/manifest.json`.
+    Those are a file of per-variant fields and shards of per-assoc fields, and each variant's rows in them are joined into a row like in `matrix.tsv.gz`.
+    With `matrix_sparse`, `matrix.tsv.gz` begins with a line "##sparse..." and its rows only have the phenos that have each variant (see `_sparse_mr`).
+    '''
     def __init__(self):
-        self._filepath = get_generated_path('matrix.tsv.gz')
+        if conf.get_matrix_phenos_per_shard():
+            manifest_filepath = get_filepath('matrix-manifest')
+            with open(manifest_filepath) as f:
+                manifest = json.load(f)
+            matrix_dir = os.path.dirname(manifest_filepath)
+            self._filepaths = [os.path.join(matrix_dir, filename) for filename in [manifest['variants']] + [shard['filename'] for shard in manifest['shards']]]
+        else:
+            self._filepaths = [get_generated_path('matrix.tsv.gz')]
+        # Shared by every `context()`, since threads are only started as they're needed.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(self._filepaths) - 1)) if len(self._filepaths) > 1 else None
 
         phenos:List[Dict[str,Any]] = get_phenolist()
         phenocodes:List[str] = [pheno['phenocode'] for pheno in phenos]
@@ -244,11 +361,24 @@ class MatrixReader:
             for pheno in phenos
         }
 
-        with read_gzip(self._filepath) as f:
-            reader = csv.reader(f, dialect='pheweb-internal-dialect')
-            colnames = next(reader)
-        assert colnames[0].startswith('#'), colnames
-        colnames[0] = colnames[0][1:]
+        colnames:List[str] = []
+        self._shard_widths:List[int] = [] # the number of per-assoc columns in each shard
+        self._sparse = False
+        for filepath in self._filepaths:
+            with read_gzip(filepath) as f:
+                reader = csv.reader(f, dialect='pheweb-internal-dialect')
+                file_colnames = next(reader)
+                if file_colnames[0].startswith('##sparse'):
+                    assert len(self._filepaths) == 1, filepath
+                    self._sparse = True
+                    file_colnames = next(reader)
+            assert file_colnames[0].startswith('#'), file_colnames
+            file_colnames[0] = file_colnames[0][1:]
+            if colnames: # shards begin with chrom-pos-ref-alt, which is dropped when joining
+                assert file_colnames[:4] == ['chrom', 'pos', 'ref', 'alt'], file_colnames
+                file_colnames = file_colnames[4:]
+                self._shard_widths.append(len(file_colnames))
+            colnames.extend(file_colnames)
 
         self._colidxs:Dict[str,int] = {} # maps field -> column_index
         self._colidxs_for_pheno:Dict[str,Dict[str,int]] = {} # maps phenocode -> field -> column_index
@@ -264,24 +394,105 @@ class MatrixReader:
                 field = colname
                 assert field in parse_utils.fields, (field)
                 self._colidxs[field] = colnum
+        if len(self._filepaths) > 1:
+            # Order the phenos like the columns of `matrix.tsv.gz`, which follow the sorted glob of `pheno_gz/*.gz`, instead of by shard.
+            self._colidxs_for_pheno = {phenocode: self._colidxs_for_pheno[phenocode] for phenocode in
+                                       sorted(self._colidxs_for_pheno, key=lambda phenocode: get_pheno_filepath('pheno_gz', phenocode, must_exist=False))}
 
     def get_phenocodes(self) -> List[str]:
         return list(self._colidxs_for_pheno)
 
+    def is_sparse(self) -> bool:
+        return self._sparse
+
     @contextmanager
     def context(self):
-        with pysam.TabixFile(self._filepath, parser=None) as tabix_file:
-            yield _mr(tabix_file, self._colidxs, self._colidxs_for_pheno, self._info_for_pheno)
+        with ExitStack() as exit_stack:
+            tabix_files = [exit_stack.enter_context(pysam.TabixFile(filepath, parser=None)) for filepath in self._filepaths]
+            if len(tabix_files) == 1:
+                mr_class = _sparse_mr if self._sparse else _mr
+                yield mr_class(tabix_files[0], self._colidxs, self._colidxs_for_pheno, self._info_for_pheno)
+            else:
+                assert self._executor is not None
+                yield _sharded_mr(tabix_files[0], tabix_files[1:], self._shard_widths, self._executor, self._colidxs, self._colidxs_for_pheno, self._info_for_pheno)
 class _mr(_ivfr):
     def __init__(self, _tabix_file:pysam.TabixFile, _colidxs:Dict[str,int], _colidxs_for_pheno:Dict[str,Dict[str,int]], _info_for_pheno:Dict[str,Dict[str,Any]]):
         self._tabix_file=_tabix_file
         self._colidxs=_colidxs
         self._colidxs_for_pheno=_colidxs_for_pheno
         self._info_for_pheno=_info_for_pheno
+        self._fields_for_pheno = {phenocode: list(fields) for phenocode, fields in _colidxs_for_pheno.items()}
+        self._colidx_list_for_pheno = {phenocode: list(fields.values()) for phenocode, fields in _colidxs_for_pheno.items()}
+        self._get_fields_of_pheno = {phenocode: operator.itemgetter(*colidxs) for phenocode, colidxs in self._colidx_list_for_pheno.items()}
+        self._field_position_for_pheno = {phenocode: {field: i for i, field in enumerate(fields)} for phenocode, fields in _colidxs_for_pheno.items()}
+        self._field_getters:Dict[str,Callable[[List[str]],Sequence[str]]] = {}
+
+    def get_region(self, chrom:str, start:int, end:int, fields:Optional[Iterable[str]] = None, phenocodes:Optional[Iterable[str]] = None) -> Iterator[Dict[str,Any]]:
+        '''
+        includes `start`, does not include `end`
+        `fields` limits the per-assoc and per-pheno fields in each pheno's record, and `phenocodes` limits which phenos are in `variant['phenos']`.
+        `variant['phenos']` is a `_PhenoRecords`, which only parses each pheno's record when it's looked up.
+        '''
+        field_set = None if fields is None else set(fields)
+        phenocode_list = None if phenocodes is None else self._check_phenocodes(phenocodes)
+        for variant_row in self._get_region_rows(chrom, start, end, phenocode_list):
+            yield self._parse_variant_row(variant_row, field_set, phenocode_list)
+    def _get_region_rows(self, chrom:str, start:int, end:int, phenocodes:Optional[List[str]] = None) -> Iterator[List[str]]:
+        return _fetch_rows(self._tabix_file, chrom, start, end)
+
+    def get_variant(self, chrom:str, pos:int, ref:str, alt:str, fields:Optional[Iterable[str]] = None, phenocodes:Optional[Iterable[str]] = None) -> Optional[Dict[str,Any]]:
+        for variant in self.get_region(chrom, pos, pos+1, fields, phenocodes):
+            if variant['pos'] == pos and variant['ref'] == ref and variant['alt'] == alt:
+                return variant
+        return None
+
+    def get_phenocodes(self) -> List[str]:
+        return list(self._fields_for_pheno)
+
+    def get_region_field_arrays(self, chrom:str, start:int, end:int, field:str, chunk_num_values:int = 2**22) -> Iterator[Tuple[np.ndarray,np.ndarray,Callable[[int],Dict[str,Any]]]]:
+        '''
+        Yields chunks of `(positions, values, get_variant)` for the variants in the region (including `start`, not including `end`).
+        `values[i,j]` is the per-assoc `field` of the i-th variant for the pheno `get_phenocodes()[j]` as float64, or nan if it doesn't have that variant.
+        `get_variant(i)` parses the i-th variant, so that callers only parse the variants they need.
+        Each chunk has about `chunk_num_values` values.
+        '''
+        chunk_num_variants = max(1, chunk_num_values // max(1, len(self._fields_for_pheno)))
+        pos_colidx = self._colidxs['pos']
+        variant_rows = self._get_region_rows(chrom, start, end)
+        while True:
+            chunk_rows = list(itertools.islice(variant_rows, chunk_num_variants))
+            if not chunk_rows: break
+            positions = np.array([int(variant_row[pos_colidx]) for variant_row in chunk_rows], dtype=np.int64)
+            # python's float() parses strings much faster than numpy's `.astype(np.float64)`
+            try:
+                array = np.array([float(val) if val else np.nan for variant_row in chunk_rows for val in self._get_field_strings(variant_row, field)], dtype=np.float64)
+            except ValueError as exc:
+                raise PheWebError('ERROR: Failed to parse the values of field {!r} in the region {}:{}-{}'.format(field, chrom, start, end)) from exc
+            array = array.reshape((len(chunk_rows), len(self._fields_for_pheno)))
+            def get_variant(i:int, chunk_rows:List[List[str]] = chunk_rows) -> Dict[str,Any]:
+                return self._parse_variant_row(chunk_rows[i])
+            yield positions, array, get_variant
+
+    def _get_field_strings(self, variant_row:List[str], field:str) -> Sequence[str]:
+        '''Returns the unparsed `field` of each pheno, or '' for phenos that don't have this variant.'''
+        if field not in self._field_getters:
+            try: colidxs = [fields[field] for fields in self._colidxs_for_pheno.values()]
+            except KeyError: raise PheWebError("The field {!r} isn't in the matrix for every pheno".format(field))
+            self._field_getters[field] = operator.itemgetter(*colidxs) if len(colidxs) > 1 else lambda row: [row[colidx] for colidx in colidxs]
+        return self._field_getters[field](variant_row)
+
+    def _check_phenocodes(self, phenocodes:Iterable[str]) -> List[str]:
+        phenocodes = list(phenocodes)
+        for phenocode in phenocodes:
+            if phenocode not in self._colidxs_for_pheno:
+                raise PheWebError("The phenocode {!r} was requested from the matrix but it isn't there".format(phenocode))
+        return phenocodes
 
     def _parse_field(self, variant_row:List[str], field:str, phenocode:Optional[str] = None) -> Any:
         colidx = self._colidxs[field] if phenocode is None else self._colidxs_for_pheno[phenocode][field]
-        val = variant_row[colidx]
+        return self._parse_value(variant_row[colidx], field, phenocode)
+
+    def _parse_value(self, val:str, field:str, phenocode:Optional[str] = None) -> Any:
         parser = parse_utils.reader_for_field[field]
         try:
             return parser(val)  # type: ignore
@@ -290,19 +501,119 @@ class _mr(_ivfr):
             if phenocode is not None: error_message += ' and phenocode {!r}'.format(phenocode)
             raise PheWebError(error_message) from exc
 
-    def _parse_variant_row(self, variant_row:List[str]) -> Dict[str,Any]:
-        variant:Dict[str,Any] = {'phenos': {}}
+    def _parse_variant_row(self, variant_row:List[str], fields:Optional[ty.Set[str]] = None, phenocodes:Optional[List[str]] = None) -> Dict[str,Any]:
+        variant:Dict[str,Any] = {'phenos': _PhenoRecords(self, variant_row, self._get_colidxs_of_phenos_in_row(variant_row, phenocodes), fields)}
         for field in self._colidxs:
             variant[field] = self._parse_field(variant_row, field)
-        for phenocode, fields in self._colidxs_for_pheno.items():
-            if any(variant_row[self._colidxs_for_pheno[phenocode][field]] != '' for field in fields):
-                p = {}
-                for field in fields:
-                    p[field] = self._parse_field(variant_row, field, phenocode)
-                    p.update(self._info_for_pheno[phenocode])
-                    variant['phenos'][phenocode] = p
         return variant
 
+    def _get_colidxs_of_phenos_in_row(self, variant_row:List[str], phenocodes:Optional[List[str]]) -> Dict[str,Sequence[int]]:
+        '''Returns {phenocode: the column of each of `self._fields_for_pheno[phenocode]`} for each pheno that has this variant.'''
+        if phenocodes is None: phenocodes = self._fields_for_pheno  # type: ignore
+        ret:Dict[str,Sequence[int]] = {}
+        for phenocode in phenocodes:  # type: ignore
+            if any(self._get_fields_of_pheno[phenocode](variant_row)): # a pheno with one field gets a str, which is also falsy if empty
+                ret[phenocode] = self._colidx_list_for_pheno[phenocode]
+        return ret
+
+    def _parse_pheno(self, variant_row:List[str], phenocode:str, colidxs:Sequence[int], fields:Optional[ty.Set[str]]) -> Dict[str,Any]:
+        p = {field: self._parse_value(variant_row[colidx], field, phenocode)
+             for field, colidx in zip(self._fields_for_pheno[phenocode], colidxs)
+             if fields is None or field in fields}
+        info = self._info_for_pheno[phenocode]
+        p.update(info if fields is None else {k: v for k, v in info.items() if k in fields})
+        return p
+class _sparse_mr(_mr):
+    '''
+    Reads a sparse matrix, where each row has the per-variant fields and then, for each pheno that has the variant,
+    the pheno's index (among the phenos in the header) followed by its per-assoc fields.
+    '''
+    def __init__(self, _tabix_file:pysam.TabixFile, _colidxs:Dict[str,int], _colidxs_for_pheno:Dict[str,Dict[str,int]], _info_for_pheno:Dict[str,Dict[str,Any]]):
+        super().__init__(_tabix_file, _colidxs, _colidxs_for_pheno, _info_for_pheno)
+        self._num_per_variant_fields = len(_colidxs)
+        self._phenocode_and_width = [(phenocode, len(fields)) for phenocode, fields in _colidxs_for_pheno.items()]
+
+    def _get_colidxs_of_phenos_in_row(self, variant_row:List[str], phenocodes:Optional[List[str]]) -> Dict[str,Sequence[int]]:
+        phenocode_set = None if phenocodes is None else set(phenocodes)
+        ret:Dict[str,Sequence[int]] = {}
+        i = self._num_per_variant_fields
+        while i < len(variant_row):
+            phenocode, width = self._phenocode_and_width[int(variant_row[i])]
+            if phenocode_set is None or phenocode in phenocode_set:
+                ret[phenocode] = range(i+1, i+1+width)
+            i += 1 + width
+        return ret
+
+    def _get_field_strings(self, variant_row:List[str], field:str) -> List[str]:
+        ret = [''] * len(self._phenocode_and_width)
+        i = self._num_per_variant_fields
+        while i < len(variant_row):
+            pheno_idx = int(variant_row[i])
+            phenocode, width = self._phenocode_and_width[pheno_idx]
+            try:
+                ret[pheno_idx] = variant_row[i+1+self._field_position_for_pheno[phenocode][field]]
+            except KeyError:
+                raise PheWebError("The field {!r} isn't in the matrix for the pheno {!r}".format(field, phenocode))
+            i += 1 + width
+        return ret
+class _PhenoRecords(collections.abc.Mapping):
+    '''
+    Maps phenocode -> the per-assoc and per-pheno fields of each pheno that has a variant.
+    Each record is parsed from the matrix row the first time it's looked up, so callers only pay for the phenos they use.
+    '''
+    def __init__(self, mr:_mr, variant_row:List[str], colidxs_for_pheno:Dict[str,Sequence[int]], fields:Optional[ty.Set[str]]):
+        self._mr=mr
+        self._variant_row=variant_row
+        self._colidxs_for_pheno=colidxs_for_pheno
+        self._fields=fields
+        self._records:Dict[str,Dict[str,Any]] = {}
+
+    def __getitem__(self, phenocode:str) -> Dict[str,Any]:
+        try: return self._records[phenocode]
+        except KeyError: pass
+        colidxs = self._colidxs_for_pheno[phenocode]
+        p = self._records[phenocode] = self._mr._parse_pheno(self._variant_row, phenocode, colidxs, self._fields)
+        return p
+    def __iter__(self) -> Iterator[str]: return iter(self._colidxs_for_pheno)
+    def __len__(self) -> int: return len(self._colidxs_for_pheno)
+
+    def get_field(self, phenocode:str, field:str) -> Any:
+        '''Parses one per-assoc field of a pheno without making its whole record.'''
+        colidx = self._colidxs_for_pheno[phenocode][self._mr._field_position_for_pheno[phenocode][field]]
+        return self._mr._parse_value(self._variant_row[colidx], field, phenocode)
+class _sharded_mr(_mr):
+    def __init__(self, _tabix_file:pysam.TabixFile, _shard_tabix_files:List[pysam.TabixFile], _shard_widths:List[int], _executor:concurrent.futures.Executor,
+                 _colidxs:Dict[str,int], _colidxs_for_pheno:Dict[str,Dict[str,int]], _info_for_pheno:Dict[str,Dict[str,Any]]):
+        super().__init__(_tabix_file, _colidxs, _colidxs_for_pheno, _info_for_pheno)
+        self._shard_tabix_files=_shard_tabix_files
+        self._shard_widths=_shard_widths
+        self._executor=_executor
+        self._shard_idx_for_pheno:Dict[str,int] = {}
+        shard_start_colidxs = list(itertools.accumulate([len(_colidxs)] + _shard_widths))
+        for phenocode, colidxs in self._colidx_list_for_pheno.items():
+            self._shard_idx_for_pheno[phenocode] = sum(1 for colidx in shard_start_colidxs[1:] if colidx <= colidxs[0])
+
+    def _get_region_rows(self, chrom:str, start:int, end:int, phenocodes:Optional[List[str]] = None) -> Iterator[List[str]]:
+        # Shards only have rows for variants in some of their phenos, so the rows of each variant are joined by chrom-pos-ref-alt.
+        # Each shard is fetched on its own thread, since htslib reads and decompresses without the GIL.
+        # Shards without any of `phenocodes` aren't read, and their columns are left blank.
+        def get_shard_rows(tabix_file:pysam.TabixFile) -> Dict[tuple,List[str]]:
+            return {tuple(row[:4]): row[4:] for row in _fetch_rows(tabix_file, chrom, start, end)}
+        shard_idxs_to_read = set(range(len(self._shard_tabix_files))) if phenocodes is None else {self._shard_idx_for_pheno[phenocode] for phenocode in phenocodes}
+        shard_rows_futures = [self._executor.submit(get_shard_rows, tabix_file) if shard_idx in shard_idxs_to_read else None
+                              for shard_idx, tabix_file in enumerate(self._shard_tabix_files)]
+        try:
+            variant_rows = list(_fetch_rows(self._tabix_file, chrom, start, end))
+        finally:
+            # The executor outlives this context, so don't let it read a shard after its file is closed.
+            concurrent.futures.wait([future for future in shard_rows_futures if future is not None])
+        shard_rows = [{} if future is None else future.result() for future in shard_rows_futures]
+        for variant_row in variant_rows:
+            cpra = tuple(variant_row[:4])
+            for rows, width in zip(shard_rows, self._shard_widths):
+                variant_row.extend(rows.get(cpra) or [''] * width)
+            yield variant_row
+
 
 def with_chrom_idx(variants:Iterator[Dict[str,Any]]) -> Iterator[Dict[str,Any]]:
     for v in variants:
@@ -333,6 +644,192 @@ def read_maybe_gzip(filepath:Union[str,Path]):
             yield f
 
 
+## Sites table
+
+def write_sites_table(sites_filepath:str, dirpath:str) -> None:
+    '''Writes the directory `dirpath` for `SitesTable` from the sites file.'''
+    tmp_dirpath = get_tmp_path(dirpath)
+    mkdir_p(tmp_dirpath)
+    keys = array.array('q')
+    offsets = array.array('q', [0])
+    with read_maybe_gzip(sites_filepath) as f, \
+         open(os.path.join(tmp_dirpath, 'text.bin'), 'wb', buffering=2**18) as text_f:
+        fields = next(csv.reader([next(f)], dialect='pheweb-internal-dialect'))
+        assert fields[:2] == ['chrom', 'pos'], fields
+        offset = 0
+        for line in f:
+            chrom, pos, _ = line.split('\t', 2)
+            key = get_chrom_pos_key(chrom, int(pos))
+            if keys and key < keys[-1]: raise PheWebError("The sites file ({}) isn't sorted at the line {!r}".format(sites_filepath, line))
+            keys.append(key)
+            line_bytes = line.encode()
+            text_f.write(line_bytes)
+            offset += len(line_bytes)
+            offsets.append(offset)
+    if not keys: raise PheWebError("It appears that your sites file ({!r}) has no variants.".format(sites_filepath))
+    np.save(os.path.join(tmp_dirpath, 'offsets.npy'), np.frombuffer(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dirpath, 'keys.npy'), np.frombuffer(keys, dtype=np.int64))
+    write_json(filepath=os.path.join(tmp_dirpath, 'fields.json'), data=fields)
+    with open(os.path.join(tmp_dirpath, 'id.txt'), 'w') as f:
+        f.write(os.urandom(8).hex()) # pheno files with `pheno_gz_site_index` check this to make sure that they use this table
+    if os.path.exists(dirpath): shutil.rmtree(dirpath)
+    os.replace(tmp_dirpath, dirpath)
+
+class SitesTable:
+    '''
+    The sites file as arrays (written by `write_sites_table()`), which are memory-mapped so that every process can share them.
+    `keys[i]` is `get_chrom_pos_key()` of the i-th variant, and `text[offsets[i]:offsets[i+1]]` is its line of the sites file.
+    '''
+    def __init__(self, dirpath:str):
+        with open(os.path.join(dirpath, 'fields.json')) as f:
+            self.fields:List[str] = json.load(f)
+        with open(os.path.join(dirpath, 'id.txt')) as f:
+            self.id = f.read()
+        self._keys = np.load(os.path.join(dirpath, 'keys.npy'), mmap_mode='r')
+        self._offsets = np.load(os.path.join(dirpath, 'offsets.npy'), mmap_mode='r')
+        self._text = np.memmap(os.path.join(dirpath, 'text.bin'), dtype=np.uint8, mode='r')
+        self._ref_colidx = self.fields.index('ref')
+        self._alt_colidx = self.fields.index('alt')
+
+    def get_rows(self, chroms:Sequence[str], positions:Sequence[int], refs:Sequence[str], alts:Sequence[str],
+                 min_idx:Optional[int] = None) -> Tuple[np.ndarray, List[Optional[List[str]]]]:
+        '''
+        Returns the index and the unparsed row (with a value for each of `self.fields`) of each of the variants.
+        Variants that aren't in the table get -1 and None.
+        With `min_idx`, the variants are matched in order, like merging a file into the sites file: each one gets the first matching row
+        at or after `min_idx` and after the row of the previous variant, so a variant that's repeated gets the rows of its repeats in the sites file.
+        '''
+        keys = get_chrom_pos_keys(chroms, positions)
+        idxs = np.searchsorted(self._keys, keys).tolist()
+        ret_idxs = np.full(len(keys), -1, dtype=np.int64)
+        rows:List[Optional[List[str]]] = [None] * len(keys)
+        num_sites = len(self._keys)
+        for j, (key, i) in enumerate(zip(keys.tolist(), idxs)):
+            if min_idx is not None: i = max(i, min_idx)
+            # Multiallelic variants share a key, so check the ref and alt of each variant with this key.
+            while i < num_sites and self._keys[i] == key:
+                row = self._get_row(i)
+                if row[self._ref_colidx] == refs[j] and row[self._alt_colidx] == alts[j]:
+                    ret_idxs[j] = i
+                    rows[j] = row
+                    if min_idx is not None: min_idx = i + 1
+                    break
+                i += 1
+        return ret_idxs, rows
+
+    def get_first_idx_of_chrom(self, chrom:str) -> int:
+        return int(np.searchsorted(self._keys, get_chrom_pos_key(chrom, 0)))
+
+    def get_line(self, idx:int) -> str:
+        '''Returns the i-th line of the sites file, without its newline.'''
+        return self._text[self._offsets[idx]:self._offsets[idx+1]-1].tobytes().decode()
+
+    def _get_row(self, idx:int) -> List[str]:
+        line = self.get_line(idx)
+        if '\\' in line or '"' in line:
+            return next(csv.reader([line], dialect='pheweb-internal-dialect'))
+        return line.split('\t')
+
+def get_sites_table() -> SitesTable:
+    dirpath = get_filepath('sites-table')
+    return _get_sites_table(dirpath, os.stat(os.path.join(dirpath, 'id.txt')).st_mtime)
+@functools.lru_cache(None)
+def _get_sites_table(dirpath:str, mtime:float) -> SitesTable:
+    # Each process maps the sites table once, and the OS shares its pages between processes.
+    return SitesTable(dirpath)
+
+# With `pheno_gz_site_index`, each line of a pheno file has chrom, pos, the index of the variant in the `SitesTable` (in place of all the per-variant fields), and the per-assoc fields.
+# The header of the index column is "site@<id of the SitesTable>".
+def _is_site_indexed(fields:List[str]) -> bool:
+    return len(fields) > 2 and fields[2].startswith('site@')
+
+def _get_site_indexed_line_expander(fields:List[str], filepath:str) -> Tuple[List[str], Callable[[str],str]]:
+    '''Returns the fields of the site-indexed file and a function that turns each of its lines into the line it would've had without `pheno_gz_site_index`.'''
+    sites_table = get_sites_table()
+    if fields[2] != 'site@' + sites_table.id:
+        raise PheWebError("{} was made from a different sites file than the current one, so it must be remade by `pheweb augment-phenos`.".format(filepath))
+    get_line = sites_table.get_line
+    def expand_line(line:str) -> str:
+        _, _, site_idx, per_assoc_fields = line.split('\t', 3)
+        return get_line(int(site_idx)) + '\t' + per_assoc_fields
+    return sites_table.fields + fields[3:], expand_line
+
+def get_site_index_header(filepath:str) -> Optional[str]:
+    '''Returns the header of the site index column of a pheno file (or None if it was written without `pheno_gz_site_index`).'''
+    with read_gzip(filepath) as f:
+        fields = f.readline().rstrip('\n').split('\t')
+    return fields[2] if _is_site_indexed(fields) else None
+
+def get_pheno_tsv_gz(phenocode:str) -> Iterator[bytes]:
+    '''Yields the gzipped pheno file, like it would be without `pheno_gz_site_index`, for downloading.'''
+    filepath = get_pheno_filepath('pheno_gz', phenocode)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip
+    with read_gzip(filepath) as f:
+        fields = f.readline().rstrip('\n').split('\t')
+        fields, expand_line = _get_site_indexed_line_expander(fields, filepath)
+        yield compressor.compress(('\t'.join(fields) + '\n').encode())
+        while True:
+            lines = list(itertools.islice(f, 10_000))
+            if not lines: break
+            yield compressor.compress(''.join(map(expand_line, lines)).encode())
+    yield compressor.flush()
+
+
+## Sidecars
+# With `pheno_sidecars = True`, files in `pheno_gz/` and `best_of_pheno/` get a sidecar `.npy` with a few columns for each of their variants (in the same order).
+# Steps that only need those columns memory-map the sidecar instead of parsing the pheno file.
+sidecar_dtype = np.dtype([('chrom_idx', np.uint8), ('pos', np.uint32), ('pval', np.float64), ('maf', np.float32), ('flags', np.uint8)])
+SIDECAR_FLAG_SNP = 1  # len(ref) == len(alt) == 1
+SIDECAR_FLAG_LOF = 2  # the consequence is in `vep_consqeuence_category` as 'lof'
+SIDECAR_FLAG_NONSYN = 4  # the consequence is in `vep_consqeuence_category` as 'nonsyn'
+
+def get_sidecar_rows(chroms:Sequence[str], positions:Sequence[int], pvals:Sequence[float], mafs:Sequence[Optional[float]],
+                     refs:Sequence[str], alts:Sequence[str], consequences:Optional[Sequence[str]] = None) -> np.ndarray:
+    '''Makes rows for a sidecar.  Variants without a maf (ie, `None`) get nan.'''
+    from .utils import vep_consqeuence_category
+    rows = np.empty(len(chroms), dtype=sidecar_dtype)
+    rows['chrom_idx'] = np.fromiter(map(chrom_order.__getitem__, chroms), dtype=np.uint8, count=len(chroms))
+    rows['pos'] = positions
+    rows['pval'] = pvals
+    rows['maf'] = np.array([np.nan if maf is None else maf for maf in mafs], dtype=np.float32)
+    flags = np.array([len(ref) == 1 and len(alt) == 1 for ref, alt in zip(refs, alts)], dtype=np.uint8) * SIDECAR_FLAG_SNP
+    if consequences is not None:
+        flag_for_category = {'lof': SIDECAR_FLAG_LOF, 'nonsyn': SIDECAR_FLAG_NONSYN}
+        flags |= np.array([flag_for_category.get(vep_consqeuence_category.get(csq, ''), 0) for csq in consequences], dtype=np.uint8)
+    rows['flags'] = flags
+    return rows
+
+@contextmanager
+def SidecarWriter(filepath:str):
+    '''Writes a sidecar from batches of `get_sidecar_rows()`, without holding them all in memory.'''
+    tmp_filepath = get_tmp_path(filepath)
+    with open(tmp_filepath, 'wb') as f:
+        writer = _sidecar_writer(f)
+        yield writer
+    # `.npy` needs the number of rows in its header, so prepend the header now.
+    with AtomicSaver(filepath, text_mode=False, part_file=get_tmp_path(filepath + '.part'), overwrite_part=True) as f_out, open(tmp_filepath, 'rb') as f_in:
+        np.lib.format.write_array_header_1_0(f_out, {'descr': np.lib.format.dtype_to_descr(sidecar_dtype), 'fortran_order': False, 'shape': (writer.num_rows,)})
+        shutil.copyfileobj(f_in, f_out, 2**20)
+    os.remove(tmp_filepath)
+class _sidecar_writer:
+    def __init__(self, f:ty.BinaryIO):
+        self._f = f
+        self.num_rows = 0
+    def write(self, rows:np.ndarray) -> None:
+        assert rows.dtype == sidecar_dtype
+        self._f.write(rows.tobytes())
+        self.num_rows += len(rows)
+
+def get_sidecar_filepath(data_filepath:str) -> str: return data_filepath + '.npy'
+
+def read_sidecar(data_filepath:str) -> Optional[np.ndarray]:
+    '''Memory-maps the sidecar of `data_filepath`, or returns None if it doesn't exist or is older than `data_filepath`.'''
+    sidecar_filepath = get_sidecar_filepath(data_filepath)
+    if not os.path.exists(sidecar_filepath) or os.stat(sidecar_filepath).st_mtime < os.stat(data_filepath).st_mtime: return None
+    sidecar = np.load(sidecar_filepath, mmap_mode='r')
+    if sidecar.dtype != sidecar_dtype: return None
+    return sidecar
+
 
 ## Writers
 
@@ -345,38 +842,422 @@ def VariantFileWriter(filepath:str, allow_extra_fields:bool = False, use_gzip:bo
             writer.write({'chrom': '2', 'pos': 47, ...})
 
     Each variant/association/hit/loci written must have a subset of the keys of the first one.
+    Variants are buffered and written in batches, so batches can also be passed directly with `write_columns()` or `write_rows()`.
     '''
     part_file = get_tmp_path(filepath)
     make_basedir(filepath)
     if use_gzip:
         with AtomicSaver(filepath, text_mode=False, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
-            with gzip.open(f, 'wt', compresslevel=2) as f_gzip:
-                yield _vfw(f_gzip, allow_extra_fields, filepath)
+            with io.TextIOWrapper(BgzipWriter(f, compresslevel=2)) as f_gzip:
+                writer = _vfw(f_gzip, allow_extra_fields, filepath)
+                yield writer
+                writer.flush()
     else:
         with AtomicSaver(filepath, text_mode=True, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
-            yield _vfw(f, allow_extra_fields, filepath)
+            writer = _vfw(f, allow_extra_fields, filepath)
+            yield writer
+            writer.flush()
+@contextmanager
+def IndexedVariantFileWriter(filepath:str, compresslevel:int = 6, fields:Optional[List[str]] = None):
+    '''
+    Writes variants like `VariantFileWriter`, but to a BGZF file along with its tabix index (`filepath + '.tbi'`).
+    This does the same thing as `convert_VariantFile_to_IndexedVariantFile()` in a single pass, without an uncompressed file.
+    Variants must be sorted by chrom and pos.
+    `fields` sets the columns (which needn't be in `parse_utils.fields`), instead of using the fields of the first variant.
+    '''
+    tabix_index = TabixIndexBuilder(line_skip=1)  # skip header
+    part_file = get_tmp_path(filepath)
+    make_basedir(filepath)
+    with AtomicSaver(filepath, text_mode=False, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
+        with io.TextIOWrapper(BgzipWriter(f, compresslevel=compresslevel, tabix_index=tabix_index)) as f_gzip:
+            writer = _vfw(f_gzip, False, filepath)
+            if fields is not None: writer._make_writer(fields, exact=True)
+            yield writer
+            writer.flush()
+    tabix_index.save(filepath + '.tbi')
 class _vfw:
+    _batch_size = 10_000
     def __init__(self, f, allow_extra_fields:bool, filepath:str):
         self._f = f
         self._allow_extra_fields = allow_extra_fields
         self._filepath = filepath
+        self._rows:List[List[Any]] = []
+    def _make_writer(self, first_variant_fields:Iterable[str], exact:bool = False) -> None:
+        fields:List[str] = []
+        for field in parse_utils.fields:
+            if field in first_variant_fields: fields.append(field)
+        extra_fields = list(set(first_variant_fields) - set(fields))
+        if exact:
+            fields, extra_fields = list(first_variant_fields), []
+        if extra_fields:
+            if not self._allow_extra_fields:
+                raise PheWebError("ERROR: found unexpected fields {!r} among the expected fields {!r} while writing {!r}.".format(
+                                extra_fields, fields, self._filepath))
+            fields += extra_fields
+        self.fields = fields
+        self._fieldset = set(fields)
+        self._formatters = [_ValueFormatter() for _ in fields]
+        self._writer = csv.writer(self._f, dialect='pheweb-internal-dialect')
+        self._writer.writerow(fields)
     def write(self, variant:Dict[str,Any]) -> None:
-        if not hasattr(self, '_writer'):
-            fields:List[str] = []
-            for field in parse_utils.fields:
-                if field in variant: fields.append(field)
-            extra_fields = list(set(variant.keys()) - set(fields))
-            if extra_fields:
-                if not self._allow_extra_fields:
-                    raise PheWebError("ERROR: found unexpected fields {!r} among the expected fields {!r} while writing {!r}.".format(
-                                    extra_fields, fields, self._filepath))
-                fields += extra_fields
-            self._writer = csv.DictWriter(self._f, fieldnames=fields, dialect='pheweb-internal-dialect')
-            self._writer.writeheader()
-        self._writer.writerow(variant)
+        if not hasattr(self, '_writer'): self._make_writer(variant.keys())
+        row = list(map(variant.get, self.fields))  # missing fields become None, which gets written as ''
+        if len(variant) + row.count(None) != len(self.fields) and not variant.keys() <= self._fieldset:
+            raise ValueError("dict contains fields not in fieldnames: " + ", ".join(repr(field) for field in variant.keys() - self._fieldset))
+        self._rows.append(row)
+        if len(self._rows) >= self._batch_size: self.flush()
     def write_all(self, variants:Iterator[Dict[str,Any]]) -> None:
         for v in variants:
             self.write(v)
+    def write_columns(self, columns:Dict[str,Any]) -> None:
+        '''Writes a batch of variants given as columns (lists or arrays), like `{'chrom': ['1', '1'], 'pos': [123, 456], ...}`'''
+        if not hasattr(self, '_writer'): self._make_writer(columns.keys())
+        if not set(columns).issubset(self._fieldset):
+            raise PheWebError("ERROR: found unexpected fields {!r} while writing {!r}.".format(set(columns) - self._fieldset, self._filepath))
+        num_rows = len(next(iter(columns.values()))) if columns else 0
+        self.flush()
+        self._write_columns([columns[field] if field in columns else [''] * num_rows for field in self.fields])
+    def write_rows(self, fields:List[str], rows:Iterable[Sequence[Any]]) -> None:
+        '''Writes a batch of variants given as tuples (eg, from `VariantFileReader(records=True)`) with values in the order of `fields`'''
+        if not hasattr(self, '_writer'): self._make_writer(fields)
+        if not set(fields).issubset(self._fieldset):
+            raise PheWebError("ERROR: found unexpected fields {!r} while writing {!r}.".format(set(fields) - self._fieldset, self._filepath))
+        self.flush()
+        columns = list(zip(*rows)) or [()] * len(fields)
+        num_rows = len(columns[0]) if columns else 0
+        column_for_field = dict(zip(fields, columns))
+        self._write_columns([column_for_field[field] if field in column_for_field else [''] * num_rows for field in self.fields])
+    def flush(self) -> None:
+        if self._rows:
+            self._write_columns(list(zip(*self._rows)))
+            self._rows = []
+    def _write_columns(self, columns:List[Sequence[Any]]) -> None:
+        # This formats values exactly like `csv.writer` (ie, `str()`, except that None becomes ''), but much faster.
+        # Values that `csv.writer` would quote or escape are rare, so in that case just let it handle the whole batch.
+        if not columns or len(columns[0]) == 0: return
+        formatted_columns = []
+        for column, formatter in zip(columns, self._formatters):
+            if isinstance(column, np.ndarray): column = column.tolist()
+            types = set(map(type, column))
+            if types == {str}: formatted_column = column
+            elif types == {int}: formatted_column = list(map(str, column))
+            else: formatted_column = list(map(formatter.__getitem__, column))
+            if str in types and _csv_special_chars_regex.search(''.join(formatted_column)):
+                self._writer.writerows(zip(*columns))
+                return
+            formatted_columns.append(formatted_column)
+        if len(formatted_columns) == 1:
+            self._writer.writerows(zip(*columns))  # `csv.writer` quotes an empty string when it's the only value in a row
+            return
+        self._f.write('\n'.join(map('\t'.join, zip(*formatted_columns))))
+        self._f.write('\n')
+
+class _ValueFormatter(dict):
+    '''
+    Maps each value to the string that `csv.writer` would write for it.
+    Non-integral floats get cached, because they're usually rounded to a few sigfigs and so they repeat a lot.
+    (Integral floats are never cached, because `0.0 == 0` would make the cached "0.0" get used for `0`.)
+    '''
+    def __init__(self):
+        self[''] = ''
+    def __missing__(self, value:Any) -> str:
+        if value is None: return ''
+        s = str(value)
+        if type(value) is float and not value.is_integer():
+            if len(self) > 100_000: self.clear(); self[''] = ''
+            self[value] = s
+        return s
+_csv_special_chars_regex = re.compile(r'[\t\n\r"\\]')
+
+class BgzipWriter(io.BufferedIOBase):
+    '''
+    Writes BGZF (blocked gzip, which tabix needs and gzip can read) to the binary file `f`.
+    Each block is compressed independently, so blocks get compressed on `num_threads` threads and then written in order.
+    Closing this writes the remaining data and the EOF block, but doesn't close `f`.
+    '''
+    # Like htslib's bgzf.c
+    _block_size = 0xff00
+    _eof_block = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+    def __init__(self, f, num_threads:Optional[int] = None, compresslevel:int = 6, tabix_index:Optional['TabixIndexBuilder'] = None):
+        self._f = f
+        self._compresslevel = compresslevel
+        self._tabix_index = tabix_index
+        self._buffer = bytearray()
+        if num_threads is None: num_threads = conf.get_num_compression_threads()
+        self._executor = concurrent.futures.ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+        self._max_num_pending = 4 * num_threads
+        self._pending:ty.Deque[concurrent.futures.Future] = collections.deque()
+    @property
+    def name(self) -> Any:  # `io.TextIOWrapper` exposes this
+        return getattr(self._f, 'name', None)
+    def writable(self) -> bool:
+        return True
+    def write(self, data) -> int:  # type: ignore
+        if self._tabix_index is not None: self._tabix_index.add_data(data)
+        self._buffer += data
+        if len(self._buffer) >= self._block_size:
+            num_full_bytes = len(self._buffer) // self._block_size * self._block_size
+            for start in range(0, num_full_bytes, self._block_size):
+                self._write_block(bytes(self._buffer[start:start+self._block_size]))
+            del self._buffer[:num_full_bytes]
+        return len(data)
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                if self._buffer: self._write_block(bytes(self._buffer))
+                self._buffer = bytearray()
+                while self._pending: self._write_compressed_block(self._pending.popleft().result())
+                self._f.write(self._eof_block)
+            finally:
+                if self._executor is not None: self._executor.shutdown()
+                super().close()
+    def _write_block(self, block:bytes) -> None:
+        if self._executor is None:
+            self._write_compressed_block(_compress_bgzf_block(block, self._compresslevel))
+            return
+        self._pending.append(self._executor.submit(_compress_bgzf_block, block, self._compresslevel))
+        while len(self._pending) > self._max_num_pending or (self._pending and self._pending[0].done()):
+            self._write_compressed_block(self._pending.popleft().result())
+    def _write_compressed_block(self, compressed_block:bytes) -> None:
+        if self._tabix_index is not None: self._tabix_index.add_compressed_block(len(compressed_block))
+        self._f.write(compressed_block)
+def _compress_bgzf_block(block:bytes, compresslevel:int) -> bytes:
+    # zlib releases the GIL while it compresses, so this runs in parallel on threads.
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)  # -15 means raw deflate without a zlib header
+    compressed = compressor.compress(block) + compressor.flush()
+    bsize = 18 + len(compressed) + 8  # header + data + footer
+    assert bsize <= 0x10000, bsize
+    return b'\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0' + struct.pack('<H', bsize - 1) + compressed + struct.pack('<II', zlib.crc32(block), len(block))
+
+class TabixIndexBuilder:
+    '''
+    Builds a tabix index of a BGZF file while `BgzipWriter(f, tabix_index=...)` writes it, so the file doesn't need to be read again by `pysam.tabix_index()`.
+    Lines are indexed like `pysam.tabix_index(seq_col=0, start_col=1, end_col=1, line_skip=line_skip)`, so they must be sorted by chrom and pos.
+    This follows `tbx_index()` and `hts_idx_push()` in htslib, except that it tracks uncompressed offsets and only converts them to virtual offsets
+    in `save()`, once every block has been compressed.
+    The bins aren't in the same order as htslib writes them, but otherwise the index is the same (see `tests/test_tabix_index.py`).
+    '''
+    # Like htslib's hts.c, with tabix's defaults
+    _min_shift = 14
+    _n_lvls = 5
+    _first_bin_of_last_level = ((1 << 3*_n_lvls) - 1) // 7
+    _num_bins = ((1 << 3*_n_lvls + 3) - 1) // 7
+    _meta_bin = _num_bins + 1
+    _max_pos = 1 << 29
+    _batch_num_bytes = 2**20
+    def __init__(self, line_skip:int = 0):
+        self._line_skip = self._num_lines_to_skip = line_skip
+        self._buffer = bytearray()
+        self._offset = 0  # uncompressed offset of the start of `self._buffer`
+        self._compressed_block_sizes:List[int] = []
+        self._chroms:List[bytes] = []
+        self._bins_for_chrom:List[Dict[int,List[List[int]]]] = []  # chunks are [start, end] uncompressed offsets
+        self._meta_for_chrom:List[Tuple[int,int,int]] = []  # (start, end, num_lines)
+        self._linear_index_for_chrom:List[List[int]] = []
+        self._last_chrom:Optional[bytes] = None
+    def add_compressed_block(self, size:int) -> None:
+        self._compressed_block_sizes.append(size)
+    def add_data(self, data:bytes) -> None:
+        self._buffer += data
+        if len(self._buffer) >= self._batch_num_bytes: self._index_buffer()
+    def _index_buffer(self) -> None:
+        # Lines are handled in batches with numpy, so that python only does work for each 16kb window of positions instead of each line.
+        data = bytes(self._buffer)
+        pos = 0
+        while self._num_lines_to_skip:
+            newline_pos = data.find(b'\n', pos)
+            if newline_pos == -1: break
+            pos = newline_pos + 1
+            self._num_lines_to_skip -= 1
+        end = data.rfind(b'\n') + 1
+        if not self._num_lines_to_skip and end > pos:
+            lines = np.frombuffer(data, dtype=np.uint8)[pos:end]
+            line_ends = np.flatnonzero(lines == ord('\n'))
+            line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+            is_meta = lines[line_starts] == ord('#')  # tabix skips these
+            if is_meta.any(): line_starts, line_ends = line_starts[~is_meta], line_ends[~is_meta]
+            if len(line_starts):
+                chrom_ends, chrom_starts, begs = self._parse_lines(lines, line_starts, line_ends)
+                for i, j in zip(chrom_starts, chrom_starts[1:] + [len(line_starts)]):
+                    chrom = lines[line_starts[i]:chrom_ends[i]].tobytes()
+                    self._push(chrom, begs[i:j], line_starts[i:j] + (self._offset + pos))
+        else:
+            end = pos
+        self._offset += end
+        del self._buffer[:end]
+    @staticmethod
+    def _parse_lines(lines:np.ndarray, line_starts:np.ndarray, line_ends:np.ndarray) -> Tuple[np.ndarray, List[int], np.ndarray]:
+        '''Returns the end of the chrom of each line, the indexes of lines that start a new chrom, and the 0-based position of each line.'''
+        def get_line(i:int) -> str: return lines[line_starts[i]:line_ends[i]].tobytes().decode()
+        tabs = np.append(np.flatnonzero(lines == ord('\t')), len(lines))
+        first_tab_idxs = np.searchsorted(tabs, line_starts)
+        chrom_ends = tabs[first_tab_idxs]
+        pos_ends = np.minimum(tabs[np.minimum(first_tab_idxs + 1, len(tabs) - 1)], line_ends)
+        bad_idxs = np.flatnonzero(chrom_ends > line_ends)
+        if len(bad_idxs): raise PheWebError("Cannot tabix-index the line {!r} because it doesn't have a chrom and pos".format(get_line(bad_idxs[0])))
+        # Gather each field into a row of a 2d array, right-aligned for positions (for place values) and left-aligned for chroms.
+        def get_field_bytes(starts:np.ndarray, ends:np.ndarray, right_aligned:bool) -> Tuple[np.ndarray, np.ndarray]:
+            lengths = ends - starts
+            width = max(int(lengths.max()), 1)
+            offsets = np.arange(width)
+            idxs = (ends[:, None] - width + offsets) if right_aligned else (starts[:, None] + offsets)
+            is_in_field = (offsets >= width - lengths[:, None]) if right_aligned else (offsets < lengths[:, None])
+            return np.where(is_in_field, lines[np.clip(idxs, 0, len(lines) - 1)], 0), is_in_field
+        chrom_bytes, _ = get_field_bytes(line_starts, chrom_ends, right_aligned=False)
+        is_new_chrom = np.ones(len(line_starts), dtype=bool)
+        is_new_chrom[1:] = (chrom_bytes[1:] != chrom_bytes[:-1]).any(axis=1)
+        pos_bytes, is_in_pos = get_field_bytes(chrom_ends + 1, pos_ends, right_aligned=True)
+        digits = pos_bytes.astype(np.int64) - ord('0')
+        bad_idxs = np.flatnonzero(((is_in_pos & ((digits < 0) | (digits > 9))).any(axis=1)) | ~is_in_pos.any(axis=1) | (pos_ends - chrom_ends > 19))
+        if len(bad_idxs): raise PheWebError("Cannot tabix-index the line {!r} because its position isn't an integer".format(get_line(bad_idxs[0])))
+        begs = (np.where(is_in_pos, digits, 0) * 10 ** np.arange(digits.shape[1] - 1, -1, -1, dtype=np.int64)).sum(axis=1) - 1
+        return chrom_ends, np.flatnonzero(is_new_chrom).tolist(), begs
+    def _push(self, chrom:bytes, begs:np.ndarray, starts:np.ndarray) -> None:
+        # Like `hts_idx_push()` for lines covering [beg, beg+1) which start at uncompressed offsets `starts`, all on the same chrom
+        if chrom != self._last_chrom:
+            if chrom in self._chroms:
+                raise PheWebError("Cannot tabix-index because the lines for chromosome {!r} are not all together".format(chrom.decode()))
+            if self._last_chrom is not None: self._finish_chrom(int(starts[0]))
+            self._chroms.append(chrom)
+            self._bins_for_chrom.append({})
+            self._linear_index_for_chrom.append([])
+            self._last_chrom, self._last_beg = chrom, int(begs[0])
+            self._save_bin, self._save_start, self._chrom_start, self._num_lines = -1, int(starts[0]), int(starts[0]), 0
+        unsorted_idxs = np.flatnonzero(np.diff(begs, prepend=self._last_beg) < 0)
+        if len(unsorted_idxs):
+            i = unsorted_idxs[0]
+            raise PheWebError("Cannot tabix-index because position {} comes after position {} on chromosome {!r}".format(
+                begs[i]+1, (begs[i-1] if i else self._last_beg)+1, chrom.decode()))
+        if begs[-1] >= self._max_pos:
+            raise PheWebError("Cannot tabix-index position {} on chromosome {!r} because tabix only supports positions below {}".format(begs[-1]+1, chrom.decode(), self._max_pos))
+        self._last_beg = int(begs[-1])
+        self._num_lines += len(begs)
+        # Each line is in one window, and its bin is the smallest bin, which covers just that window.
+        windows = np.maximum(begs, 0) >> self._min_shift
+        window_starts = np.flatnonzero(np.diff(windows, prepend=-1))
+        linear_index = self._linear_index_for_chrom[-1]
+        for window, start in zip(windows[window_starts].tolist(), starts[window_starts].tolist()):
+            if len(linear_index) <= window: linear_index.extend([-1] * (window + 1 - len(linear_index)))
+            if linear_index[window] == -1: linear_index[window] = start
+            bin_ = self._first_bin_of_last_level + window
+            if bin_ != self._save_bin:
+                if self._save_bin != -1: self._bins_for_chrom[-1].setdefault(self._save_bin, []).append([self._save_start, start])
+                self._save_bin, self._save_start = bin_, start
+    def _finish_chrom(self, end:int) -> None:
+        self._bins_for_chrom[-1].setdefault(self._save_bin, []).append([self._save_start, end])
+        self._meta_for_chrom.append((self._chrom_start, end, self._num_lines))
+    def save(self, filepath:str) -> None:
+        '''Writes the index to `filepath`.  Call this after the `BgzipWriter` is closed.'''
+        self._index_buffer()
+        if self._buffer:
+            raise PheWebError("Cannot tabix-index a file that doesn't end with a newline")
+        if self._last_chrom is not None:
+            self._finish_chrom(self._offset)
+            self._last_chrom = None
+        block_offsets = list(itertools.accumulate([0] + self._compressed_block_sizes))
+        def get_virtual_offset(offset:int) -> int:
+            block_idx, offset_in_block = divmod(offset, BgzipWriter._block_size)
+            if offset == self._offset and offset_in_block: return block_offsets[block_idx+1] << 16  # like htslib, the end of the last block is the start of the next
+            return block_offsets[block_idx] << 16 | offset_in_block
+
+        chroms = []
+        for chrom, bins, (chrom_start, chrom_end, num_lines), linear_index in zip(self._chroms, self._bins_for_chrom, self._meta_for_chrom, self._linear_index_for_chrom):
+            bins = {bin_: [[get_virtual_offset(start), get_virtual_offset(end)] for start, end in chunks] for bin_, chunks in bins.items()}
+            self._compress_binning(bins)
+            chrom_start = get_virtual_offset(chrom_start)
+            bins[self._meta_bin] = [[chrom_start, get_virtual_offset(chrom_end)], [num_lines, 0]]
+            # Like `update_loff()`, empty windows point to the next line
+            virtual_linear_index = [get_virtual_offset(offset) if offset != -1 else -1 for offset in linear_index]
+            for i in range(len(virtual_linear_index) - 2, -1, -1):
+                if virtual_linear_index[i] == -1: virtual_linear_index[i] = virtual_linear_index[i+1]
+            chroms.append((chrom.decode(), bins, virtual_linear_index))
+        _write_tabix_index(filepath, self._line_skip, chroms)
+    def _compress_binning(self, bins:Dict[int,List[List[int]]]) -> None:
+        # Like `compress_binning()`, merge small bins into their parents and then merge chunks that start in the same block
+        for level in range(self._n_lvls, 0, -1):
+            first_bin = ((1 << 3*level) - 1) // 7
+            for bin_ in list(bins):
+                if bin_ < first_bin: continue
+                chunks = bins[bin_]
+                if level < self._n_lvls: chunks.sort()
+                parent_bin = (bin_ - 1) >> 3
+                if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < 0x10000 and parent_bin in bins:
+                    bins[parent_bin].extend(chunks)
+                    del bins[bin_]
+        for bin_, chunks in bins.items():
+            chunks.sort()
+            merged_chunks = chunks[:1]
+            for chunk in chunks[1:]:
+                if merged_chunks[-1][1] >> 16 >= chunk[0] >> 16: merged_chunks[-1][1] = max(merged_chunks[-1][1], chunk[1])
+                else: merged_chunks.append(chunk)
+            bins[bin_] = merged_chunks
+
+TabixChrom = Tuple[str, Dict[int,List[List[int]]], List[int]]  # (chrom, chunks for each bin, linear index)
+def _read_tabix_index(filepath:str) -> Tuple[int, List[TabixChrom]]:
+    '''Reads a `.tbi` written with chrom/pos/pos columns, returning (line_skip, chroms)'''
+    with gzip.open(filepath, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'TBI\1':
+        raise PheWebError("The file {!r} isn't a tabix index".format(filepath))
+    num_chroms, *columns, l_nm = struct.unpack_from('<8i', data, 4)
+    if columns[:5] != [0, 1, 2, 2, ord('#')]:
+        raise PheWebError("The tabix index {!r} has unexpected columns {!r}".format(filepath, columns))
+    chrom_names = data[36:36+l_nm].split(b'\0')[:num_chroms]
+    chroms = []
+    pos = 36 + l_nm
+    for chrom in chrom_names:
+        bins = {}
+        num_bins, = struct.unpack_from('<i', data, pos); pos += 4
+        for _ in range(num_bins):
+            bin_, num_chunks = struct.unpack_from('<Ii', data, pos); pos += 8
+            chunks = struct.unpack_from('<{}Q'.format(2*num_chunks), data, pos); pos += 16*num_chunks
+            bins[bin_] = [list(chunk) for chunk in zip(chunks[::2], chunks[1::2])]
+        num_intervals, = struct.unpack_from('<i', data, pos); pos += 4
+        linear_index = list(struct.unpack_from('<{}Q'.format(num_intervals), data, pos)); pos += 8*num_intervals
+        chroms.append((chrom.decode(), bins, linear_index))
+    return columns[5], chroms
+def _write_tabix_index(filepath:str, line_skip:int, chroms:List[TabixChrom]) -> None:
+    names = b''.join(chrom.encode() + b'\0' for chrom, _, _ in chroms)
+    parts = [b'TBI\1', struct.pack('<8i', len(chroms), 0, 1, 2, 2, ord('#'), line_skip, len(names)), names]
+    for _, bins, linear_index in chroms:
+        parts.append(struct.pack('<i', len(bins)))
+        for bin_, chunks in bins.items():
+            parts.append(struct.pack('<Ii{}Q'.format(2*len(chunks)), bin_, len(chunks), *itertools.chain.from_iterable(chunks)))
+        parts.append(struct.pack('<i{}Q'.format(len(linear_index)), len(linear_index), *linear_index))
+    parts.append(struct.pack('<Q', 0))  # number of lines without coordinates
+    with AtomicSaver(filepath, text_mode=False, part_file=get_tmp_path(filepath), overwrite_part=True, rm_part_on_exc=False) as f:
+        with BgzipWriter(f, num_threads=1) as f_bgzip:
+            f_bgzip.write(b''.join(parts))
+
+def get_chrom_virtual_offsets(tbi_filepath:str) -> Dict[str,int]:
+    '''Reads a tabix index and returns the virtual offset of the first line of each chromosome'''
+    ret = {}
+    for chrom, bins, _ in _read_tabix_index(tbi_filepath)[1]:
+        chunk_starts = [chunk[0] for bin_, chunks in bins.items() if bin_ != TabixIndexBuilder._meta_bin for chunk in chunks]
+        if chunk_starts: ret[chrom] = min(chunk_starts)
+    return ret
+
+def concatenate_tabix_indexes(filepaths:List[str], out_filepath:str) -> None:
+    '''
+    Makes the `.tbi` for the concatenation of the BGZF files `filepaths` (which must not have EOF blocks) from each of their `.tbi`s,
+    by shifting their virtual offsets.  Every chromosome must be in just one file.
+    '''
+    line_skip = None
+    chroms: List[TabixChrom] = []
+    shift = 0
+    for filepath in filepaths:
+        file_line_skip, file_chroms = _read_tabix_index(filepath + '.tbi')
+        if line_skip is None: line_skip = file_line_skip
+        for chrom, bins, linear_index in file_chroms:
+            for bin_, chunks in bins.items():
+                for chunk in (chunks[:1] if bin_ == TabixIndexBuilder._meta_bin else chunks):  # the meta-bin's second chunk is (num_lines, 0)
+                    chunk[0] += shift << 16
+                    chunk[1] += shift << 16
+            chroms.append((chrom, bins, [offset + (shift << 16) for offset in linear_index]))
+        shift += os.path.getsize(filepath)
+    if len(set(chrom for chrom, _, _ in chroms)) != len(chroms):
+        raise PheWebError("Some chromosome is in multiple files of {!r}".format(filepaths))
+    _write_tabix_index(out_filepath, line_skip or 0, chroms)
 
 def write_heterogenous_variantfile(filepath:str, assocs:List[Dict[str,Any]], use_gzip:bool = True) -> None:
     '''inject all necessary keys into the first association so that the writer will be made correctly'''
@@ -390,14 +1271,48 @@ def convert_VariantFile_to_IndexedVariantFile(vf_path:str, ivf_path:str) -> None
     make_basedir(ivf_path)
     tmp_path = get_tmp_path(ivf_path)
     tmp_path = '{}/cvt-{}'.format(os.path.dirname(tmp_path), os.path.basename(tmp_path))  # Avoid using the same tmp path as augment-phenos
-    pysam.tabix_compress(vf_path, tmp_path, force=True)
+    tabix_index = TabixIndexBuilder(line_skip=1)  # skip header
+    with open(vf_path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+        with BgzipWriter(f_out, tabix_index=tabix_index) as f_bgzip:
+            shutil.copyfileobj(f_in, f_bgzip, 2**20)
     os.rename(tmp_path, ivf_path)
+    tabix_index.save(ivf_path + '.tbi')
 
-    pysam.tabix_index(
-        filename=ivf_path, force=True,
-        seq_col=0, start_col=1, end_col=1, # note: `pysam.tabix_index` calls the first column `0`, but cmdline `tabix` calls it `1`.
-        line_skip=1, # skip header
-    )
+
+def concatenate_variant_files(filepaths:List[str], out_filepath:str) -> None:
+    '''
+    Concatenates BGZF internal files (like those written by `VariantFileWriter`) which all have the same header, keeping only the first header.
+    Only the first block of each file is decompressed (to drop its header), and the rest are copied without recompressing.
+    '''
+    header = None
+    part_file = get_tmp_path(out_filepath)
+    make_basedir(out_filepath)
+    with AtomicSaver(out_filepath, text_mode=False, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f_out:
+        for filepath in filepaths:
+            with open(filepath, 'rb') as f:
+                for block_idx, block in enumerate(_read_bgzf_blocks(f, filepath)):
+                    if block_idx == 0:
+                        data = zlib.decompress(block[18:-8], -15)
+                        file_header, data = data.split(b'\n', 1)
+                        if header is None:
+                            header = file_header
+                        elif file_header != header:
+                            raise PheWebError("The header of {!r} ({!r}) doesn't match the header of {!r} ({!r})".format(filepath, file_header, filepaths[0], header))
+                        else:
+                            if not data: continue
+                            block = _compress_bgzf_block(data, 6)
+                    f_out.write(block)
+        f_out.write(BgzipWriter._eof_block)
+def _read_bgzf_blocks(f, filepath:str) -> Iterator[bytes]:
+    '''Yields each non-empty BGZF block, still compressed'''
+    while True:
+        header = f.read(18)
+        if not header: return
+        if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+            raise PheWebError("The file {!r} isn't BGZF (blocked gzip)".format(filepath))
+        block = header + f.read(struct.unpack('<H', header[16:18])[0] + 1 - 18)
+        if struct.unpack('<I', block[-4:])[0] != 0:  # skip empty blocks, like the EOF block
+            yield block
 
 
 def write_json(*, filepath:Optional[str] = None, data=None, indent:Optional[int] = None, sort_keys:bool = False) -> None:
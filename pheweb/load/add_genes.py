@@ -4,7 +4,7 @@ This script takes a file with the columns [chrom, pos, ...] (but no headers) and
 '''
 
 from ..utils import get_gene_tuples
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath
+from ..file_utils import VariantFileReader, IndexedVariantFileWriter, get_filepath
 from .load_utils import mtime
 
 from intervaltree import IntervalTree, Interval
@@ -74,7 +74,7 @@ class GeneAnnotator(object):
 def annotate_genes(in_filepath:str, out_filepath:str) -> None:
     '''Both args are filepaths'''
     ga = GeneAnnotator(get_gene_tuples())
-    with VariantFileWriter(out_filepath) as out_f, \
+    with IndexedVariantFileWriter(out_filepath, compresslevel=2) as out_f, \
          VariantFileReader(in_filepath) as variants:
         for v in variants:
             v['nearest_genes'] = ga.annotate_position(v['chrom'], v['pos'])
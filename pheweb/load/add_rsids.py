@@ -19,19 +19,18 @@ We read one full position at a time.  When we have a position-match, we find all
 # TODO: rename `cpra` to something else to reflect that it can also contain other per-variant fields
 
 
-from ..utils import chrom_order, chrom_order_list, chrom_aliases, PheWebError
+from ..utils import chrom_order, chrom_order_list, chrom_aliases, get_chrom_pos_key, get_chrom_idx_of_key, get_pos_of_key, PheWebError
 from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, read_maybe_gzip
 from .. import conf
 from .load_utils import mtime
 
 import os
 import itertools
-from typing import Iterator,Dict,Any,List
+from typing import Iterator,Dict,Any,List,Tuple
 
 
 def get_rsid_reader(rsids_f:Iterator[str], rsids_filepath:str) -> Iterator[Dict[str,Any]]:
-    prev_chrom_idx = -1
-    prev_pos = -1
+    prev_key = -1
     for line in rsids_f:
         if not line.startswith('##'):
             if line.startswith('#'):
@@ -50,16 +49,18 @@ def get_rsid_reader(rsids_f:Iterator[str], rsids_filepath:str) -> Iterator[Dict[
                             'The recognized chromosomes are: {!r}.\n' +
                             'Recognized aliases are: {!r}.\n').format(
                                 rsids_filepath, chrom, list(chrom_order.keys()), list(chrom_aliases.keys())))
-                chrom_idx = chrom_order[chrom]
-                if prev_chrom_idx > chrom_idx:
-                    raise PheWebError((
-                        'The rsids file, {!r}, contains chromosomes in the wrong order.' +
-                        'The order should be: {!r}' +
-                        'but instead {} came before {}').format(
-                            rsids_filepath, chrom_order_list, chrom_order_list[prev_chrom_idx], chrom_order_list[chrom_idx]))
-                if prev_chrom_idx == chrom_idx and prev_pos > pos:
+                key = get_chrom_pos_key(chrom, pos)
+                if prev_key > key:
+                    prev_chrom_idx, chrom_idx = get_chrom_idx_of_key(prev_key), get_chrom_idx_of_key(key)
+                    if prev_chrom_idx > chrom_idx:
+                        raise PheWebError((
+                            'The rsids file, {!r}, contains chromosomes in the wrong order.' +
+                            'The order should be: {!r}' +
+                            'but instead {} came before {}').format(
+                                rsids_filepath, chrom_order_list, chrom_order_list[prev_chrom_idx], chrom_order_list[chrom_idx]))
                     raise PheWebError('The rsids file, {!r}, on chromosome {!r}, has position {} before {}.'.format(
-                        rsids_filepath, chrom_order_list[chrom_idx], prev_pos, pos))
+                        rsids_filepath, chrom_order_list[chrom_idx], get_pos_of_key(prev_key), pos))
+                prev_key = key
                 assert rsid.startswith('rs')
                 # Sometimes the reference contains `N`, and that's okay.
                 assert all(base in 'ATCGN' for base in ref), (chrom, pos, ref, alt_group)
@@ -70,15 +71,15 @@ def get_rsid_reader(rsids_f:Iterator[str], rsids_filepath:str) -> Iterator[Dict[
                     yield {'chrom':chrom, 'pos':int(pos), 'ref':ref, 'alt':alt, 'rsid':rsid}
 
 
-def get_one_chr_pos_at_a_time(iterator:Iterator[Dict[str,Any]]) -> Iterator[List[Dict[str,Any]]]:
+def get_one_chr_pos_at_a_time(iterator:Iterator[Dict[str,Any]]) -> Iterator[Tuple[int,List[Dict[str,Any]]]]:
     '''Turns
     [{'chr':'1', 'pos':123, 'ref':'A', 'alt':'T'},{'chr':'1', 'pos':123, 'ref':'A', 'alt':'GC'},{'chr':'1', 'pos':128, 'ref':'A', 'alt':'T'},...]
     into:
-    [ [{'chr':'1', 'pos':123, 'ref':'A', 'alt':'T'},{'chr':'1', 'pos':123, 'ref':'A', 'alt':'GC'}] , [{'chr':'1', 'pos':128, 'ref':'A', 'alt':'T'}] ,...]
-    where variants with the same position are in a list.
+    [ (key1, [{'chr':'1', 'pos':123, 'ref':'A', 'alt':'T'},{'chr':'1', 'pos':123, 'ref':'A', 'alt':'GC'}]) , (key2, [{'chr':'1', 'pos':128, 'ref':'A', 'alt':'T'}]) ,...]
+    where variants with the same position are in a list, along with `get_chrom_pos_key()` of that position.
     '''
-    for k, g in itertools.groupby(iterator, key=lambda cpra: (cpra['chrom'], cpra['pos'])):
-        yield list(g)
+    for k, g in itertools.groupby(iterator, key=lambda cpra: get_chrom_pos_key(cpra['chrom'], cpra['pos'])):
+        yield k, list(g)
 
 def are_match(seq1:str, seq2:str) -> bool:
     '''Compares nucleotide sequences.  Eg, "A" == "A", "A" == "N", "A" != "AN".'''
@@ -117,24 +118,17 @@ def run(argv:List[str]) -> None:
         debugging_limit_num_variants = conf.get_debugging_limit_num_variants()
         if debugging_limit_num_variants: rsid_group_reader = itertools.islice(rsid_group_reader, 0, debugging_limit_num_variants)
 
-        rsid_group = next(rsid_group_reader)
-        for cp_group in cp_group_reader:
+        rsid_key, rsid_group = next(rsid_group_reader)
+        for cp_key, cp_group in cp_group_reader:
 
             # Advance rsid_group until it is up to/past cp_group
-            while True:
-                if rsid_group[0]['chrom'] == cp_group[0]['chrom']:
-                    rsid_is_not_behind = rsid_group[0]['pos'] >= cp_group[0]['pos']
-                else:
-                    rsid_is_not_behind = chrom_order[rsid_group[0]['chrom']] >= chrom_order[cp_group[0]['chrom']]
-                if rsid_is_not_behind:
+            while rsid_key < cp_key:
+                try:
+                    rsid_key, rsid_group = next(rsid_group_reader)
+                except StopIteration:
                     break
-                else:
-                    try:
-                        rsid_group = next(rsid_group_reader)
-                    except StopIteration:
-                        break
 
-            if rsid_group[0]['chrom'] == cp_group[0]['chrom'] and rsid_group[0]['pos'] == cp_group[0]['pos']:
+            if rsid_key == cp_key:
                 # we have rsids at this position!  will they match on ref/alt?
                 for cpra in cp_group:
                     rsids = [rsid['rsid'] for rsid in rsid_group if cpra['ref'] == rsid['ref'] and are_match(cpra['alt'], rsid['alt'])]
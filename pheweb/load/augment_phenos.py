@@ -1,9 +1,12 @@
 
 from ..utils import PheWebError
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, get_pheno_filepath, with_chrom_idx, get_tmp_path, convert_VariantFile_to_IndexedVariantFile
-from .load_utils import parallelize_per_pheno, get_phenos_subset, get_phenolist
+from ..file_utils import VariantFileReader, IndexedVariantFileWriter, write_sites_table, get_sites_table, get_site_index_header, get_filepath, get_pheno_filepath, SidecarWriter, get_sidecar_rows
+from .. import conf, parse_utils
+from .load_utils import get_mafs, parallelize_per_pheno, get_phenos_subset, get_phenolist, mtime
 
-import argparse, os
+import os, argparse, itertools
+from contextlib import ExitStack
+import numpy as np
 from typing import List,Dict,Any
 
 def run(argv:List[str]) -> None:
@@ -22,7 +25,20 @@ def run(argv:List[str]) -> None:
         return [
             get_pheno_filepath('pheno_gz', pheno['phenocode'], must_exist=False),
             get_pheno_filepath('pheno_gz_tbi', pheno['phenocode'], must_exist=False),
-        ]
+        ] + ([get_pheno_filepath('pheno_gz_sidecar', pheno['phenocode'], must_exist=False)] if conf.should_write_pheno_sidecars() else [])
+
+    # Every process reads the sites file through the same memory-mapped `SitesTable`, instead of each one parsing all of it.
+    sites_filepath = get_filepath('sites')
+    sites_table_dirpath = get_filepath('sites-table', must_exist=False)
+    if not os.path.exists(os.path.join(sites_table_dirpath, 'id.txt')) or mtime(os.path.join(sites_table_dirpath, 'id.txt')) < mtime(sites_filepath):
+        write_sites_table(sites_filepath, sites_table_dirpath)
+
+    # Remake pheno files that don't match `pheno_gz_site_index` or that use a different sites table.
+    site_index_header = 'site@' + get_sites_table().id if conf.should_index_pheno_sites() else None
+    for pheno in phenos:
+        filepath = get_pheno_filepath('pheno_gz', pheno['phenocode'], must_exist=False)
+        if os.path.exists(filepath) and get_site_index_header(filepath) != site_index_header:
+            os.remove(filepath)
 
     parallelize_per_pheno(
         get_input_filepaths = get_input_filepaths,
@@ -37,51 +53,43 @@ def convert(pheno:Dict[str,Any]) -> None:
     parsed_filepath = get_pheno_filepath('parsed', pheno['phenocode'])
     sites_filepath = get_filepath('sites')
     out_filepath = get_pheno_filepath('pheno_gz', pheno['phenocode'], must_exist=False)
-    out_unzipped_filepath = get_tmp_path(out_filepath)
-
-
-    with VariantFileReader(sites_filepath) as sites_reader, \
-         VariantFileReader(parsed_filepath) as pheno_reader, \
-         VariantFileWriter(out_unzipped_filepath, use_gzip=False) as writer:
-        sites_variants = with_chrom_idx(iter(sites_reader))
-        pheno_variants = with_chrom_idx(iter(pheno_reader))
-
-        def write_variant(sites_variant:Dict[str,Any], pheno_variant:Dict[str,Any]) -> None:
-            # Sometimes I use copy files from pheno_gz/ into parsed/, and I want the new sites info to take precendence.
-            pheno_variant.update(sites_variant)
-            del pheno_variant['chrom_idx']
-            writer.write(pheno_variant)
-
-        try: pheno_variant = next(pheno_variants)
-        except StopIteration: raise PheWebError("It appears that the phenotype {!r} has no variants.".format(pheno['phenocode']))
-        try: sites_variant = next(sites_variants)
-        except StopIteration: raise PheWebError("It appears that your sites file ({!r}) has no variants.".format(sites_filepath))
-        while True:
-            cmp = _which_variant_is_bigger(pheno_variant, sites_variant)
-            if cmp == 1:  # pheno variant is ahead, so advance sites variant
-                try: sites_variant = next(sites_variants)
-                except StopIteration: raise PheWebError("The sites file ({}) ran out of variants while {} still had {}".format(sites_filepath, parsed_filepath, pheno_variant))
-            elif cmp == 2:  # sites variant is ahead, so something went wrong.
-                raise PheWebError("The sites file ({}) is missing a variant that's present in {}: {}.".format(sites_filepath, parsed_filepath, pheno_variant))
-            else:  # they're equal, so write out the match and then advance both. (pheno first and sites second)
-                write_variant(sites_variant, pheno_variant)
-                try: pheno_variant = next(pheno_variants)
-                except StopIteration: break  # done.
-                try: sites_variant = next(sites_variants)
-                except StopIteration: raise PheWebError("The sites file ({}) ran out of variants while {} still had {}".format(sites_filepath, parsed_filepath, pheno_variant))
-
-    convert_VariantFile_to_IndexedVariantFile(out_unzipped_filepath, out_filepath)
-    os.unlink(out_unzipped_filepath)
-
+    sites_table = get_sites_table()
+    site_index = conf.should_index_pheno_sites()
+    sidecar_filepath = get_pheno_filepath('pheno_gz_sidecar', pheno['phenocode'], must_exist=False) if conf.should_write_pheno_sidecars() else None
 
-def _which_variant_is_bigger(v1:Dict[str,Any], v2:Dict[str,Any]) -> int:
-    '''1 means v1 is bigger.  2 means v2 is bigger. 0 means tie.'''
-    if v1['chrom_idx'] == v2['chrom_idx']:
-        if v1['pos'] == v2['pos']:
-            if v1['ref'] == v2['ref']:
-                if v1['alt'] == v2['alt']:
-                    return 0
-                return 1 if v1['alt'] > v2['alt'] else 2
-            return 1 if v1['ref'] > v2['ref'] else 2
-        return 1 if v1['pos'] > v2['pos'] else 2
-    return 1 if v1['chrom_idx'] > v2['chrom_idx'] else 2
+    with VariantFileReader(parsed_filepath, records=True) as pheno_reader:
+        # With `pheno_gz_site_index`, the per-variant fields (except chrom and pos, for tabix) are replaced by the variant's index in the sites table.
+        per_assoc_fields = [field for field in pheno_reader.fields if field not in parse_utils.per_variant_fields]
+        out_fields = ['chrom', 'pos', 'site@' + sites_table.id] + per_assoc_fields if site_index else None
+        # The sidecar is finished after the pheno file is closed, so that it's newer.
+        with ExitStack() as exit_stack:
+            sidecar_writer = exit_stack.enter_context(SidecarWriter(sidecar_filepath)) if sidecar_filepath else None
+            writer = exit_stack.enter_context(IndexedVariantFileWriter(out_filepath, fields=out_fields))
+            pheno_variants = iter(pheno_reader)
+            prev_sites_idx = -1
+            while True:
+                chunk = list(itertools.islice(pheno_variants, 100_000))
+                if not chunk:
+                    if prev_sites_idx == -1: raise PheWebError("It appears that the phenotype {!r} has no variants.".format(pheno['phenocode']))
+                    break
+                columns = dict(zip(pheno_reader.fields, zip(*chunk)))
+                # Each variant gets the next matching row of the sites file, so a repeated variant gets the rows of its repeats.
+                sites_idxs, maybe_sites_rows = sites_table.get_rows(columns['chrom'], columns['pos'], columns['ref'], columns['alt'], min_idx=prev_sites_idx + 1)
+                for j in np.flatnonzero(sites_idxs == -1)[:1]:
+                    # If the variant is in the sites file but only before the previous variant's row, it's out of order.
+                    if sites_table.get_rows([columns['chrom'][j]], [columns['pos'][j]], [columns['ref'][j]], [columns['alt'][j]])[0][0] != -1:
+                        raise PheWebError("The variants in {} aren't in the same order as in the sites file ({}).".format(parsed_filepath, sites_filepath))
+                    raise PheWebError("The sites file ({}) is missing a variant that's present in {}: {}.".format(sites_filepath, parsed_filepath, chunk[j]._asdict()))
+                sites_rows = [row for row in maybe_sites_rows if row is not None]  # that's all of them, since none are missing
+                prev_sites_idx = sites_idxs[-1]
+                if sidecar_writer:
+                    consequences = [row[sites_table.fields.index('consequence')] for row in sites_rows] if 'consequence' in sites_table.fields else None
+                    sidecar_writer.write(get_sidecar_rows(columns['chrom'], columns['pos'], columns['pval'], get_mafs(columns, pheno), columns['ref'], columns['alt'], consequences))
+                if site_index:
+                    writer.write_columns({'chrom': columns['chrom'], 'pos': columns['pos'], 'site@' + sites_table.id: sites_idxs, **{field: columns[field] for field in per_assoc_fields}})
+                    continue
+                # Sometimes I use copy files from pheno_gz/ into parsed/, and I want the new sites info to take precendence.
+                for colidx, field in enumerate(sites_table.fields):
+                    parser = parse_utils.reader_for_field[field]
+                    columns[field] = [parser(row[colidx]) for row in sites_rows]  # type: ignore
+                writer.write_columns(columns)
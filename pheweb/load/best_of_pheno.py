@@ -2,11 +2,12 @@
 This script creates generated-by-pheweb/best-of-pheno/<pheno> which contains the strongest 100k associations for the phenotype.
 '''
 
-from ..file_utils import VariantFileReader, VariantFileWriter, get_pheno_filepath
-from ..utils import chrom_order
-from .load_utils import MaxPriorityQueue, parallelize_per_pheno, get_phenos_subset, get_phenolist
+from ..file_utils import VariantFileWriter, VariantFileReader, SidecarWriter, get_pheno_filepath, get_sidecar_filepath, read_sidecar
+from ..utils import get_chrom_pos_key
+from .load_utils import parallelize_per_pheno, get_phenos_subset, get_phenolist
 
-import argparse
+import argparse, array, math
+import numpy as np
 from typing import List,Dict,Any
 
 
@@ -33,10 +34,73 @@ def make_bestof_file(pheno:Dict[str,Any]) -> None:
                               get_pheno_filepath('best_of_pheno', pheno['phenocode'], must_exist=False))
 
 def make_bestof_file_explicit(in_filepath:str, out_filepath:str) -> None:
-    q = MaxPriorityQueue()
-    with VariantFileReader(in_filepath) as vfr:
-        for v in vfr:
-            q.add_and_keep_size(v, v['pval'], NUM_VARIANTS)
-    assocs = list(q.pop_all())
-    assocs.sort(key=lambda v: (chrom_order[v['chrom']], v['pos']))
+    sidecar = read_sidecar(in_filepath)
+    if sidecar is not None:
+        make_bestof_file_from_sidecar(sidecar, in_filepath, out_filepath)
+    else:
+        # Read only the pvals first, and then only the best variants.
+        maker = BestOfPhenoFileMaker(in_filepath, out_filepath)
+        with VariantFileReader(in_filepath, fields=['pval']) as reader:
+            for v in reader: maker.process_variant(v)
+        maker.finish()
+
+def get_best_row_mask(pvals:np.ndarray, num_variants:int = NUM_VARIANTS) -> np.ndarray:
+    '''Returns a mask of the `num_variants` variants with the smallest pvals.  Ties at the largest pval kept are broken by order in the file.'''
+    if len(pvals) <= num_variants: return np.ones(len(pvals), dtype=bool)
+    threshold = np.partition(pvals, num_variants - 1)[num_variants - 1]
+    row_mask = pvals < threshold
+    tied_idxs = np.flatnonzero(pvals == threshold)
+    row_mask[tied_idxs[:num_variants - np.count_nonzero(row_mask)]] = True
+    return row_mask
+
+def write_bestof_file(in_filepath:str, out_filepath:str, row_mask:np.ndarray) -> None:
+    '''Writes the variants of `in_filepath` where `row_mask` is True, ordered by `get_chrom_pos_key()` and then weakest first.'''
+    with VariantFileReader(in_filepath, row_mask=row_mask) as reader:
+        assocs = list(reader)
+    assocs.sort(key=lambda v: (get_chrom_pos_key(v['chrom'], v['pos']), -v['pval']))  # stable, so ties stay in file order
     with VariantFileWriter(out_filepath) as vfw: vfw.write_all(assocs)
+
+def make_bestof_file_from_sidecar(sidecar:np.ndarray, in_filepath:str, out_filepath:str) -> None:
+    '''
+    Does the same as `BestOfPhenoFileMaker`, but finds the best variants using the columns of a sidecar and only reads those from `in_filepath`.
+    This also writes a sidecar for the best-of-pheno file, for `/api/manhattan-filtered/`.
+    '''
+    row_mask = get_best_row_mask(np.asarray(sidecar['pval']))
+    idxs = np.flatnonzero(row_mask)
+    with VariantFileReader(in_filepath, row_mask=row_mask) as reader:
+        assocs = list(reader)
+    columns = sidecar[idxs]
+    order = np.lexsort((-columns['pval'], columns['chrom_idx'].astype(np.int64) << 32 | columns['pos']))  # by `get_chrom_pos_key()`, then weakest first like `.pop_all()`
+    with SidecarWriter(get_sidecar_filepath(out_filepath)) as sidecar_writer:
+        with VariantFileWriter(out_filepath) as vfw: vfw.write_all(assocs[i] for i in order.tolist())
+        sidecar_writer.write(columns[order])
+
+class BestOfPhenoFileMaker:
+    '''
+    Makes a best-of-pheno file from the variants of a pheno file, for `scan_variant_file()`.
+    It only keeps the index and pval of the variants that could be among the best, and then `.finish()` reads the best ones from `in_filepath` again.
+    '''
+    def __init__(self, in_filepath:str, out_filepath:str):
+        self._in_filepath = in_filepath
+        self._out_filepath = out_filepath
+        self._num_variants = 0
+        self._idxs = array.array('q')
+        self._pvals = array.array('d')
+        self._threshold = math.inf  # once `NUM_VARIANTS` earlier variants have smaller-or-equal pvals, a variant with a pval >= this can't be kept
+    def process_variant(self, v:Dict[str,Any]) -> None:
+        if v['pval'] < self._threshold:
+            self._idxs.append(self._num_variants)
+            self._pvals.append(v['pval'])
+            if len(self._pvals) >= 2 * NUM_VARIANTS: self._drop_candidates()
+        self._num_variants += 1
+    def _drop_candidates(self) -> None:
+        # Keeps the best `NUM_VARIANTS` candidates.  Doing this every `NUM_VARIANTS` candidates avoids the per-variant work of a heap.
+        pvals = np.frombuffer(self._pvals, dtype=np.float64)
+        row_mask = get_best_row_mask(pvals)
+        self._threshold = float(pvals[row_mask].max())
+        self._idxs = array.array('q', np.frombuffer(self._idxs, dtype=np.int64)[row_mask].tobytes())
+        self._pvals = array.array('d', pvals[row_mask].tobytes())
+    def finish(self) -> None:
+        row_mask = np.zeros(self._num_variants, dtype=bool)
+        row_mask[np.frombuffer(self._idxs, dtype=np.int64)[get_best_row_mask(np.frombuffer(self._pvals, dtype=np.float64))]] = True
+        write_bestof_file(self._in_filepath, self._out_filepath, row_mask)
@@ -12,9 +12,14 @@ ffibuilder = cffi.FFI()
 ffibuilder.set_source('pheweb.load.cffi._x',
                       src,
                       source_extension='.cpp',
-                      extra_compile_args=['--std=c++11'],
+                      extra_compile_args=['--std=c++11', '-pthread'],
+                      extra_link_args=['-pthread'],
                       libraries=['z'], # needed on Linux but not macOS
 )
 ffibuilder.cdef('''
-const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath);
+const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath, unsigned num_threads, int sparse);
+const char* cffi_make_matrix_chrom(const char *sites_filepath, uint64_t sites_offset, uint64_t sites_first_idx, const char **augmented_pheno_filepaths, const uint64_t *augmented_pheno_offsets, unsigned num_phenos,
+                                   const char *chrom, const char *matrix_filepath, unsigned num_threads, int write_header, int sparse);
+const char* cffi_make_matrix_shard(const char *sites_filepath, const char **augmented_pheno_filepaths, unsigned num_phenos, const char *matrix_filepath, unsigned num_threads,
+                                   int pheno_shard);
 ''')
@@ -1,7 +1,7 @@
 
 /*
 compile with:
-  g++ -std=c++11 -lz -o x x.cpp
+  g++ -std=c++11 -pthread -lz -o x x.cpp
 */
 
 #include <cstring> // memcpy on Linux
@@ -21,6 +21,9 @@ compile with:
 #include <zlib.h>
 #include <fcntl.h> // O_WRONLY &c
 #include <exception> // do I need this?
+#include <thread>
+#include <unistd.h> // lseek
+#include <map>
 
 
 // ------
@@ -29,18 +32,22 @@ compile with:
 class BgzipWriter {
 // This is adapted from <https://github.com/samtools/htslib/blob/master/bgzf.c>,
 // also referencing <http://github.com/samtools/htslib/blob/master/bgzip.c>
+// With num_threads > 1, full blocks are collected into batches, and each batch is compressed on `num_threads` threads while the next batch fills.
 public:
-    BgzipWriter(std::string filepath) {
+    BgzipWriter(std::string filepath, unsigned num_threads = 1) {
         if (compressBound(BGZF_BLOCK_SIZE) > BGZF_MAX_BLOCK_SIZE) { throw std::runtime_error("[BGZF_MAX_BLOCK_SIZE is too small to hold compressed random data]"); }
         _filepath = filepath;
         _file.open(filepath.c_str(), std::ios::out | std::ios::binary);
+        _num_threads = num_threads ? num_threads : 1;
         _uncompressed_block = new uint8_t[2*BGZF_MAX_BLOCK_SIZE];
         _compressed_block = _uncompressed_block + BGZF_MAX_BLOCK_SIZE;
         _uncompressed_block_size = 0;
+        _compressed_block_offsets.push_back(0);
     }
     ~BgzipWriter() {
+        for (std::thread &thread : _threads) { if (thread.joinable()) thread.join(); }
         _file.close();
-        delete _uncompressed_block;
+        delete[] _uncompressed_block;
     }
     void write(const char* src_buffer, size_t src_len) {
         while (src_len > 0) {
@@ -48,6 +55,7 @@ public:
             if (copy_length > src_len) copy_length = src_len;
             memcpy(_uncompressed_block + _uncompressed_block_size, src_buffer, copy_length);
             _uncompressed_block_size += copy_length;
+            _uncompressed_size += copy_length;
             src_buffer += copy_length;
             src_len -= copy_length;
             if (_uncompressed_block_size >= BGZF_BLOCK_SIZE) {
@@ -61,10 +69,29 @@ public:
     void write(const std::string src_string) {
         write(src_string.c_str(), src_string.length());
     }
-    void close() {
+    // tell_uncompressed returns the number of (uncompressed) bytes written so far.
+    // Every block except the last holds exactly BGZF_BLOCK_SIZE of them, so after `close()` this is converted to a virtual offset by `get_virtual_offset()`.
+    uint64_t tell_uncompressed() {
+        return _uncompressed_size;
+    }
+    uint64_t get_virtual_offset(uint64_t uncompressed_offset) {
+        size_t block_idx = uncompressed_offset / BGZF_BLOCK_SIZE;
+        if (uncompressed_offset == _uncompressed_size && uncompressed_offset % BGZF_BLOCK_SIZE) {
+            return _compressed_block_offsets.at(block_idx + 1) << 16; // like htslib, the end of the last block is the start of the next
+        }
+        return _compressed_block_offsets.at(block_idx) << 16 | uncompressed_offset % BGZF_BLOCK_SIZE;
+    }
+    void close(bool write_eof = true) {
         // Make one empty block at the end to indicate EOF (as per samtools unofficial spec)
+        // Files that will be concatenated together skip it, so that EOF is only at the very end.
         if (_uncompressed_block_size) flush_uncompressed();
-        flush_uncompressed();
+        if (write_eof) flush_uncompressed();
+        if (_num_threads > 1) {
+            write_compressed_batch();
+            compress_batch_in_background();
+            write_compressed_batch();
+        }
+        _file.close();
     }
 private:
      static inline void packInt16(uint8_t *buffer, uint16_t value) {
@@ -138,22 +165,71 @@ private:
         packInt32((uint8_t*)&dst[dlen - 8], crc);
         packInt32((uint8_t*)&dst[dlen - 4], slen);
     }
-    // flush_uncompressed compresses _uncompressed_block into _file
+    // flush_uncompressed compresses _uncompressed_block into _file (or, with threads, queues it to be compressed)
     inline void flush_uncompressed() {
         // NOTE: for random data, the compressed data is often longer than the uncompressed.
         //       but compressed blocks cannot be more than 64KiB, because their size is two bytes.
         //       so, if `bgzf_compress` throws `insufficient_space_exception`, rerun with each half of data.
         //       this should never happen, because our header+footer is 26 bytes, so we only need marginally compressible data.
+        if (_num_threads > 1) {
+            _batch.emplace_back(_uncompressed_block, _uncompressed_block + _uncompressed_block_size);
+            _uncompressed_block_size = 0;
+            if (_batch.size() >= BATCH_NUM_BLOCKS_PER_THREAD * _num_threads) {
+                write_compressed_batch();
+                compress_batch_in_background();
+            }
+            return;
+        }
         size_t compressed_block_size = BGZF_MAX_BLOCK_SIZE;
         bgzf_compress(_compressed_block, compressed_block_size, _uncompressed_block, _uncompressed_block_size);
         _file.write( (const char*)_compressed_block, compressed_block_size);
+        _compressed_block_offsets.push_back(_compressed_block_offsets.back() + compressed_block_size);
         _uncompressed_block_size = 0;
     }
+    // compress_batch_in_background moves _batch to _compressing_batch and starts threads that each compress some of its blocks (in place)
+    void compress_batch_in_background() {
+        _compressing_batch.swap(_batch);
+        _batch.clear();
+        _thread_errors.assign(_num_threads, std::string());
+        for (unsigned thread_idx = 0; thread_idx < _num_threads; thread_idx++) {
+            _threads.emplace_back([this, thread_idx]() {
+                try {
+                    std::vector<uint8_t> compressed_block(BGZF_MAX_BLOCK_SIZE);
+                    for (size_t i = thread_idx; i < _compressing_batch.size(); i += _num_threads) {
+                        size_t compressed_block_size = BGZF_MAX_BLOCK_SIZE;
+                        bgzf_compress(compressed_block.data(), compressed_block_size, _compressing_batch[i].data(), _compressing_batch[i].size());
+                        _compressing_batch[i].assign(compressed_block.begin(), compressed_block.begin() + compressed_block_size);
+                    }
+                } catch (const std::exception &exc) {
+                    _thread_errors[thread_idx] = exc.what();
+                }
+            });
+        }
+    }
+    // write_compressed_batch waits for the threads started by compress_batch_in_background and then writes their blocks in order
+    void write_compressed_batch() {
+        for (std::thread &thread : _threads) thread.join();
+        _threads.clear();
+        for (const std::string &error : _thread_errors) { if (!error.empty()) throw std::runtime_error(error); }
+        for (const std::vector<uint8_t> &compressed_block : _compressing_batch) {
+            _file.write((const char*)compressed_block.data(), compressed_block.size());
+            _compressed_block_offsets.push_back(_compressed_block_offsets.back() + compressed_block.size());
+        }
+        _compressing_batch.clear();
+    }
     std::string _filepath;
     std::ofstream _file;
     uint8_t *_uncompressed_block; // 64KiB
     uint8_t *_compressed_block; // 64KiB
     size_t _uncompressed_block_size; // num bytes occupied
+    uint64_t _uncompressed_size = 0; // num bytes written
+    std::vector<uint64_t> _compressed_block_offsets; // where each written block starts, and then where the next one will
+    unsigned _num_threads;
+    std::vector<std::vector<uint8_t>> _batch; // uncompressed blocks waiting for the next batch
+    std::vector<std::vector<uint8_t>> _compressing_batch; // blocks being compressed by _threads
+    std::vector<std::thread> _threads;
+    std::vector<std::string> _thread_errors;
+    static const unsigned BATCH_NUM_BLOCKS_PER_THREAD = 4;
     static const size_t BGZF_BLOCK_SIZE = 0xff00; // 255*256
     static const size_t BGZF_MAX_BLOCK_SIZE = 0x10000; //64K
     static const int COMPRESSION_LEVEL = 2; // default of 6 is 3x slower than 2.  2 is 10% slower than 1.
@@ -167,6 +243,134 @@ private:
 };
 
 
+// ------
+// Tabix-index builder
+
+class TabixIndexBuilder {
+// This makes the same bins, chunks and linear index as `pysam.tabix_index(filepath, seq_col=0, start_col=1, end_col=1)`, following <https://github.com/samtools/htslib/blob/master/hts.c>.
+// The bins are written in a different order than htslib's hash table, so the `.tbi` files aren't byte-identical.
+// It's the same as `TabixIndexBuilder` in `file_utils.py`, but `add_line()` is given each line's chrom, pos, and offset (from `BgzipWriter::tell_uncompressed()`).
+public:
+    void add_line(const std::string& chrom, int64_t pos, uint64_t offset) {
+        if (pos < 1 || pos > MAX_POS) {
+            throw std::runtime_error("[position " + std::to_string(pos) + " on chromosome " + chrom + " can't be tabix-indexed]");
+        }
+        int64_t beg = pos - 1; // tabix uses 0-based positions
+        uint32_t bin = FIRST_BIN_OF_LAST_LEVEL + (beg >> MIN_SHIFT);
+        if (_chroms.empty() || chrom != _chroms.back().name) {
+            if (!_chroms.empty()) finish_chrom(offset);
+            for (const Chrom &c : _chroms) { if (c.name == chrom) throw std::runtime_error("[chromosome " + chrom + " isn't contiguous, so it can't be tabix-indexed]"); }
+            _chroms.emplace_back();
+            _chroms.back().name = chrom;
+            _chroms.back().beg = offset;
+            _chunk_beg = offset;
+            _chunk_bin = bin;
+            _last_beg = beg;
+        }
+        Chrom &c = _chroms.back();
+        if (beg < _last_beg) throw std::runtime_error("[chromosome " + chrom + " isn't sorted by position, so it can't be tabix-indexed]");
+        _last_beg = beg;
+        size_t window = beg >> MIN_SHIFT;
+        if (c.linear_index.size() <= window) c.linear_index.resize(window + 1, -1);
+        if (c.linear_index[window] == -1) c.linear_index[window] = offset;
+        if (bin != _chunk_bin) {
+            c.bins[_chunk_bin].push_back(std::make_pair(_chunk_beg, offset));
+            _chunk_beg = offset;
+            _chunk_bin = bin;
+        }
+        c.num_lines++;
+    }
+    void finish(uint64_t end_offset) {
+        if (!_chroms.empty()) finish_chrom(end_offset);
+    }
+    // save writes the index, converting the offsets with `writer` (which must be closed).
+    void save(const std::string& filepath, BgzipWriter& writer) {
+        std::string names;
+        for (const Chrom &c : _chroms) { names += c.name; names.push_back('\0'); }
+        std::string out = "TBI\1";
+        int32_t header[8] = {(int32_t)_chroms.size(), 0, 1, 2, 2, '#', 0, (int32_t)names.size()}; // generic format, chrom/pos/pos columns, '#' comments, no skipped lines
+        for (int32_t value : header) pack(out, value);
+        out += names;
+        for (Chrom &c : _chroms) {
+            for (auto &bin : c.bins) {
+                for (auto &chunk : bin.second) chunk = std::make_pair(writer.get_virtual_offset(chunk.first), writer.get_virtual_offset(chunk.second));
+            }
+            compress_binning(c.bins);
+            uint64_t beg = writer.get_virtual_offset(c.beg);
+            c.bins[(uint32_t)META_BIN] = {std::make_pair(beg, writer.get_virtual_offset(c.end)), std::make_pair(c.num_lines, (uint64_t)0)};
+            pack(out, (int32_t)c.bins.size());
+            for (const auto &bin : c.bins) {
+                pack(out, bin.first);
+                pack(out, (int32_t)bin.second.size());
+                for (const auto &chunk : bin.second) { pack(out, chunk.first); pack(out, chunk.second); }
+            }
+            // Like `update_loff()`, empty windows point to the next line
+            std::vector<uint64_t> linear_index(c.linear_index.size());
+            for (size_t i = linear_index.size(); i-- > 0; ) {
+                linear_index[i] = (c.linear_index[i] != -1) ? writer.get_virtual_offset(c.linear_index[i]) : linear_index[i+1];
+            }
+            pack(out, (int32_t)linear_index.size());
+            for (uint64_t offset : linear_index) pack(out, offset);
+        }
+        pack(out, (uint64_t)0); // number of lines without coordinates
+        BgzipWriter index_writer(filepath);
+        index_writer.write(out);
+        index_writer.close();
+    }
+private:
+    typedef std::map<uint32_t, std::vector<std::pair<uint64_t,uint64_t>>> Bins;
+    struct Chrom {
+        std::string name;
+        Bins bins;
+        std::vector<int64_t> linear_index; // -1 for empty windows
+        uint64_t beg, end, num_lines = 0;
+    };
+    void finish_chrom(uint64_t end_offset) {
+        _chroms.back().bins[_chunk_bin].push_back(std::make_pair(_chunk_beg, end_offset));
+        _chroms.back().end = end_offset;
+    }
+    static void compress_binning(Bins& bins) {
+        // Like `compress_binning()`, merge small bins into their parents and then merge chunks that start in the same block
+        for (int level = NUM_LEVELS; level > 0; level--) {
+            uint32_t first_bin = ((1 << 3*level) - 1) / 7;
+            for (auto it = bins.lower_bound(first_bin); it != bins.end(); ) {
+                std::vector<std::pair<uint64_t,uint64_t>> &chunks = it->second;
+                if (level < NUM_LEVELS) std::sort(chunks.begin(), chunks.end());
+                auto parent = bins.find((it->first - 1) >> 3);
+                if ((chunks.back().second >> 16) - (chunks.front().first >> 16) < 0x10000 && parent != bins.end()) {
+                    parent->second.insert(parent->second.end(), chunks.begin(), chunks.end());
+                    it = bins.erase(it);
+                } else {
+                    ++it;
+                }
+            }
+        }
+        for (auto &bin : bins) {
+            std::vector<std::pair<uint64_t,uint64_t>> &chunks = bin.second;
+            std::sort(chunks.begin(), chunks.end());
+            size_t m = 0;
+            for (size_t i = 1; i < chunks.size(); i++) {
+                if (chunks[m].second >> 16 >= chunks[i].first >> 16) chunks[m].second = std::max(chunks[m].second, chunks[i].second);
+                else chunks[++m] = chunks[i];
+            }
+            chunks.resize(m + 1);
+        }
+    }
+    template <typename T> static void pack(std::string& out, T value) {
+        for (size_t i = 0; i < sizeof(T); i++) out.push_back((char)((uint64_t)value >> (8*i)));
+    }
+    std::vector<Chrom> _chroms;
+    uint64_t _chunk_beg;
+    uint32_t _chunk_bin;
+    int64_t _last_beg;
+    static const int MIN_SHIFT = 14;
+    static const int NUM_LEVELS = 5;
+    static const uint32_t FIRST_BIN_OF_LAST_LEVEL = ((1 << 3*NUM_LEVELS) - 1) / 7; // 4681
+    static const uint32_t META_BIN = ((1 << 3*(NUM_LEVELS+1)) - 1) / 7 + 1; // 37450
+    static const int64_t MAX_POS = 1 << (MIN_SHIFT + 3*NUM_LEVELS);
+};
+
+
 // ------
 // Gzip reader with the istream interface
 // copied from <http://www.cs.unc.edu/Research/compgeom/gzstream/>
@@ -191,6 +395,7 @@ public:
     }
     int is_open() { return opened; }
     gzstreambuf* open( const char* name, int open_mode);
+    gzstreambuf* open_at_offset( const char* name, uint64_t offset);
     gzstreambuf* close();
     ~gzstreambuf() { close(); }
     virtual int     overflow( int c = EOF);
@@ -205,6 +410,7 @@ public:
     gzstreambase( const char* name, int open_mode);
     ~gzstreambase();
     void open( const char* name, int open_mode);
+    void open_at_offset( const char* name, uint64_t offset);
     void close();
     gzstreambuf* rdbuf() { return &buf; }
 };
@@ -240,6 +446,27 @@ gzstreambuf* gzstreambuf::open( const char* name, int open_mode) {
     opened = 1;
     return this;
 }
+gzstreambuf* gzstreambuf::open_at_offset( const char* name, uint64_t offset) {
+    // Starts reading at the gzip member (eg, BGZF block) that begins at byte `offset`, since zlib reads concatenated members.
+    if ( is_open())
+        return (gzstreambuf*)0;
+    mode = std::ios::in;
+    int fd = ::open(name, O_RDONLY);
+    if (fd < 0)
+        return (gzstreambuf*)0;
+    if (lseek(fd, offset, SEEK_SET) != (off_t)offset) {
+        ::close(fd);
+        return (gzstreambuf*)0;
+    }
+    file = gzdopen(fd, "rb");
+    if (file == 0) {
+        ::close(fd);
+        return (gzstreambuf*)0;
+    }
+    setg( buffer + 4, buffer + 4, buffer + 4);
+    opened = 1;
+    return this;
+}
 gzstreambuf * gzstreambuf::close() {
     if ( is_open()) {
         sync();
@@ -314,6 +541,10 @@ void gzstreambase::open( const char* name, int open_mode) {
     if ( ! buf.open( name, open_mode))
         clear( rdstate() | std::ios::badbit);
 }
+void gzstreambase::open_at_offset( const char* name, uint64_t offset) {
+    if ( ! buf.open_at_offset( name, offset))
+        clear( rdstate() | std::ios::badbit);
+}
 void gzstreambase::close() {
     if ( buf.is_open())
         if ( ! buf.close())
@@ -325,9 +556,16 @@ void gzstreambase::close() {
 // Line-by-line file-reader that can handle plaintext or gzip files
 class LineReader {
 public:
-    inline void attach(const std::string& filepath) { // immediately reads the first line
+    inline void attach(const std::string& filepath, uint64_t virtual_offset = 0) { // immediately reads the first line
+        // If `virtual_offset` (a BGZF virtual offset, like in tabix indexes) is set, the line after this one is the line at that offset.
         stream.open(filepath.c_str());
         next();
+        if (virtual_offset) {
+            stream.close();
+            stream.clear();
+            stream.open_at_offset(filepath.c_str(), virtual_offset >> 16);
+            stream.ignore(virtual_offset & 0xffff);
+        }
     }
     inline void next() {
         std::getline(stream, line); // drops the \n
@@ -345,16 +583,20 @@ public:
 static inline void set_ulimit_num_files(unsigned num_files) {
   struct rlimit old_limit, new_limit;
   getrlimit(RLIMIT_NOFILE, &old_limit);
+  if (num_files <= old_limit.rlim_cur) return; // never lower it, since one process can make several matrices
   if (num_files > old_limit.rlim_max) {
-    std::cerr << "You're trying to open " << num_files << " files at once, but your ulimit only allows you to open " << old_limit.rlim_max << ".  Use administrative rights to raise your limit." << std::endl;
-    exit(1);
+    std::ostringstream errstream;
+    errstream << "[You're trying to open " << num_files << " files at once, but your ulimit only allows you to open " << old_limit.rlim_max << ".";
+    errstream << "  Use administrative rights to raise your limit, or set `matrix_phenos_per_shard = 500` in config.py to make a matrix that opens fewer files at once.]";
+    throw std::runtime_error(errstream.str());
   }
   new_limit.rlim_cur = num_files;
-  new_limit.rlim_max = num_files;
+  new_limit.rlim_max = old_limit.rlim_max;
   if (setrlimit(RLIMIT_NOFILE, &new_limit) != 0) {
-    std::cerr << "setrlimit() failed with errno=" << errno << "\n";
-    std::cerr << "current soft limit is " << old_limit.rlim_cur << ", hard limit is " << old_limit.rlim_max << ", requested new limit is " << num_files << std::endl;
-    exit(1);
+    std::ostringstream errstream;
+    errstream << "[setrlimit() failed with errno=" << errno << "]";
+    errstream << "[current soft limit is " << old_limit.rlim_cur << ", hard limit is " << old_limit.rlim_max << ", requested new limit is " << num_files << "]";
+    throw std::runtime_error(errstream.str());
   }
 }
 
@@ -397,20 +639,30 @@ bool endsWith (std::string const &str, std::string const &suffix) {
 // ------
 // main
 
-int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
-    BgzipWriter writer(matrix_filepath);
+// If `chrom` is non-empty, only that chromosome is merged, with every file starting at its virtual offset from `*_offsets` (0 to read from the start).
+// Such a matrix can be a piece of a larger one: only the first piece should have `write_header` and only the last should have `write_eof`.
+// If `pheno_shard`, only chrom-pos-ref-alt and the per-assoc fields are written, and only for variants in some pheno (for column-sharded matrices).
+// If `sparse`, each row has the per-variant fields and then, for each pheno that has the variant, the pheno's index (among the phenos in the header) and its per-assoc fields.
+// Pheno files written with `pheno_gz_site_index` have chrom, pos, and the index of the variant in sites.tsv (with a header like "site@<id>") in place of the per-variant fields.
+// Those are matched by counting the lines of sites.tsv, starting at `sites_first_idx` (the index of the line at `sites_offset`, or `NO_SITES_IDX` if unknown).
+static const uint64_t NO_SITES_IDX = UINT64_MAX;
+int make_matrix(const char *sites_filepath, uint64_t sites_offset, uint64_t sites_first_idx, const std::vector<std::string>& aug_filepaths, const std::vector<uint64_t>& aug_offsets,
+                const std::string& chrom, const char *matrix_filepath, unsigned num_threads, bool write_header, bool write_eof, bool pheno_shard, bool sparse) {
+    BgzipWriter writer(matrix_filepath, num_threads);
 
     LineReader sites_reader;
-    sites_reader.attach(sites_filepath);
+    sites_reader.attach(sites_filepath, sites_offset);
 
-    std::vector<std::string> aug_filepaths = glob(augmented_pheno_glob);
     size_t N_phenos = aug_filepaths.size();
     std::vector<LineReader> aug_readers(N_phenos);
     std::vector<std::string> aug_phenocodes(N_phenos);
     std::vector<unsigned> aug_n_per_assoc_fields(N_phenos); // initialized to 0s.
+    std::vector<size_t> aug_n_per_variant_fields(N_phenos);
+    std::vector<bool> aug_site_indexed(N_phenos);
+    std::vector<uint64_t> aug_sites_idx(N_phenos);
     set_ulimit_num_files(N_phenos + 100); // are python files still open?
     for (size_t i = 0; i < N_phenos; i++) {
-        aug_readers[i].attach(aug_filepaths[i]);
+        aug_readers[i].attach(aug_filepaths[i], aug_offsets[i]);
         aug_phenocodes[i] = aug_filepaths[i];
         size_t last_slash_idx = aug_phenocodes[i].find_last_of("/");
         if (std::string::npos != last_slash_idx) {
@@ -427,7 +679,16 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
     // All fields after the ones in sites.tsv will be written as "<field>@<pheno>"
     static const std::string cpra_header = "chrom\tpos\tref\talt\t";
     if(0 != sites_reader.line.compare(0, cpra_header.size(), cpra_header)) { throw std::runtime_error("[sites.tsv header doesn't begin with \"chrom\tpos\tref\talt\t\"]"); }
+    static const std::string site_index_header = "site@";
     for (size_t i=0; i < N_phenos; i++) {
+        size_t pos_after_chrom_pos = pos_after_n_of_char(aug_readers[i].line, 2, '\t');
+        aug_site_indexed[i] = (pos_after_chrom_pos != (size_t)-1 && 0 == aug_readers[i].line.compare(pos_after_chrom_pos, site_index_header.size(), site_index_header));
+        if (aug_site_indexed[i]) {
+            if (sites_first_idx == NO_SITES_IDX) throw std::runtime_error("[" + aug_filepaths[i] + " was made with `pheno_gz_site_index` but the index of the first line of sites.tsv wasn't given]");
+            aug_n_per_variant_fields[i] = 3;
+            continue;
+        }
+        aug_n_per_variant_fields[i] = n_fields(sites_reader.line);
         if(0 != aug_readers[i].line.compare(0, sites_reader.line.size(), sites_reader.line)) {
             std::ostringstream errstream;
             errstream << "[One of the pheno files has a header that doesn't begin with the header of sites.tsv (or it failed to read).]";
@@ -438,40 +699,62 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
             throw std::runtime_error(errstream.str().c_str());
         }
     }
-    writer.write("#"); // tabix needs the header commented.
-    writer.write(sites_reader.line); // no trailing \t or \n
+    if (write_header) {
+        if (sparse) writer.write("##sparse: after the per-variant fields, each row has the index of each pheno that has the variant followed by its fields\n");
+        writer.write("#"); // tabix needs the header commented.
+        if (pheno_shard) writer.write(cpra_header.c_str(), cpra_header.size() - 1);
+        else writer.write(sites_reader.line); // no trailing \t or \n
+    }
     for (size_t i=0; i < N_phenos; i++) {
-        std::string per_assoc_fields = aug_readers[i].line.substr(sites_reader.line.size(), std::string::npos);
+        size_t per_assoc_start = aug_site_indexed[i] ? pos_after_n_of_char(aug_readers[i].line, 3, '\t') - 1 : sites_reader.line.size();
+        std::string per_assoc_fields = aug_readers[i].line.substr(per_assoc_start, std::string::npos);
         std::istringstream line_stream(per_assoc_fields);
         std::string field;
         std::getline(line_stream, field, '\t'); // consume first tab.
         while(std::getline(line_stream, field, '\t')) {
-            writer.write("\t");
-            writer.write(field);
-            writer.write("@");
-            writer.write(aug_phenocodes[i]);
+            if (write_header) {
+                writer.write("\t");
+                writer.write(field);
+                writer.write("@");
+                writer.write(aug_phenocodes[i]);
+            }
             aug_n_per_assoc_fields[i]++;
         }
     }
-    writer.write("\n");
-    const size_t n_per_variant_fields = n_fields(sites_reader.line);
+    if (write_header) writer.write("\n");
     // advance every file to its 1st data-line
+    auto read_sites_idx = [&](size_t i) {
+        if (aug_site_indexed[i] && !aug_readers[i].eof()) {
+            size_t pos_after_chrom_pos = pos_after_n_of_char(aug_readers[i].line, 2, '\t');
+            aug_sites_idx[i] = (pos_after_chrom_pos == (size_t)-1) ? NO_SITES_IDX : strtoull(aug_readers[i].line.c_str() + pos_after_chrom_pos, NULL, 10);
+        }
+    };
     sites_reader.next();
-    for (size_t i=0; i<N_phenos; i++) aug_readers[i].next();
+    uint64_t sites_idx = sites_first_idx;
+    for (size_t i=0; i<N_phenos; i++) { aug_readers[i].next(); read_sites_idx(i); }
+    const std::string chrom_prefix = chrom + "\t";
+    if (!chrom.empty() && 0 != sites_reader.line.compare(0, chrom_prefix.size(), chrom_prefix)) {
+        throw std::runtime_error("[sites.tsv doesn't have chromosome " + chrom + " at the given offset]");
+    }
 
     // Data:
     // Every aug_pheno is a subsequence of sites.tsv.
     // If a line in an aug_pheno has the same chrom-pos-ref-alt as sites.tsv, then it must have the sites.tsv line as its prefix.
     //    (ie, it must have the same per-variant fields, in the same order.)
     // So, we iterate over sites.tsv, printing and advancing any aug_pheno that matches CPRA, and printing '' for every field in non-matching aug_phenos.
+    TabixIndexBuilder index;
+    std::string row;
     while(1) {
-        writer.write(sites_reader.line);
-
         size_t pos_after_cpra = pos_after_n_of_char(sites_reader.line, 4, '\t');
+        bool any_pheno_matched = false;
+        if (pheno_shard) row.assign(sites_reader.line, 0, pos_after_cpra - 1);
+        else row.assign(sites_reader.line);
 
         for (size_t i=0; i<N_phenos; i++) {
-            if (!aug_readers[i].eof() && 0 == sites_reader.line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)) { // CPRAs match.
-                if (0 != aug_readers[i].line.compare(0, sites_reader.line.size(), sites_reader.line)) {
+            bool matched = aug_site_indexed[i] ? (!aug_readers[i].eof() && aug_sites_idx[i] == sites_idx) :
+                (!aug_readers[i].eof() && 0 == sites_reader.line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)); // CPRAs match.
+            if (matched) {
+                if (!aug_site_indexed[i] && 0 != aug_readers[i].line.compare(0, sites_reader.line.size(), sites_reader.line)) {
                     std::ostringstream errstream;
                     errstream << "[There's a variant in a pheno file that has different information from that same variant in sites.tsv.]";
                     errstream << "[bad phenocode = " << aug_phenocodes[i] << "]";
@@ -479,42 +762,92 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
                     errstream << "[bad sites.tsv line = " << sites_reader.line << "]";
                     throw std::runtime_error(errstream.str().c_str());
                 }
-                if (n_fields(aug_readers[i].line) != n_per_variant_fields + aug_n_per_assoc_fields[i]) { // correct number of fields on line.
+                if (n_fields(aug_readers[i].line) != aug_n_per_variant_fields[i] + aug_n_per_assoc_fields[i]) { // correct number of fields on line.
                     std::ostringstream errstream;
                     errstream << "[a pheno has a line with a different number of tab-delimited fields than its header]";
                     errstream << "[bad phenocode = " << aug_phenocodes[i] << "]";
                     errstream << "[bad pheno line = " << aug_readers[i].line << "]";
                     errstream << "[num fields on line = " << n_fields(aug_readers[i].line) << "]";
-                    errstream << "[num fields in header = " << n_per_variant_fields + aug_n_per_assoc_fields[i] << "]";
+                    errstream << "[num fields in header = " << aug_n_per_variant_fields[i] + aug_n_per_assoc_fields[i] << "]";
                     throw std::runtime_error(errstream.str().c_str());
                 }
-                writer.write(aug_readers[i].line.c_str() + sites_reader.line.size(), aug_readers[i].line.size() - sites_reader.line.size()); //write per-assoc fields
+                if (sparse) {
+                    row.push_back('\t');
+                    row.append(std::to_string(i));
+                }
+                size_t per_assoc_start = aug_site_indexed[i] ? pos_after_n_of_char(aug_readers[i].line, 3, '\t') - 1 : sites_reader.line.size();
+                row.append(aug_readers[i].line, per_assoc_start, std::string::npos); //write per-assoc fields
                 aug_readers[i].next();
+                read_sites_idx(i);
+                any_pheno_matched = true;
 
-            } else { // CPRAs don't match
+            } else if (!sparse) { // CPRAs don't match
                 // write blanks for this pheno
-                for (size_t j=0; j<aug_n_per_assoc_fields[i]; j++) writer.write("\t");
+                row.append(aug_n_per_assoc_fields[i], '\t');
             }
         }
-        writer.write("\n");
+        row.push_back('\n');
+        if (any_pheno_matched || !pheno_shard) {
+            size_t pos_after_chrom = row.find('\t');
+            index.add_line(row.substr(0, pos_after_chrom), strtoll(row.c_str() + pos_after_chrom + 1, NULL, 10), writer.tell_uncompressed());
+            writer.write(row);
+        }
 
         if (sites_reader.eof()) break;
         sites_reader.next();
+        sites_idx++;
+        if (!chrom.empty() && 0 != sites_reader.line.compare(0, chrom_prefix.size(), chrom_prefix)) break;
     }
 
-    writer.close();
+    index.finish(writer.tell_uncompressed());
+    writer.close(write_eof);
+    index.save(std::string(matrix_filepath) + ".tbi", writer);
 
     return 0;
 }
 
+int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath, unsigned num_threads, bool sparse) {
+    std::vector<std::string> aug_filepaths = glob(augmented_pheno_glob);
+    std::vector<uint64_t> aug_offsets(aug_filepaths.size()); // initialized to 0s.
+    return make_matrix(sites_filepath, 0, 0, aug_filepaths, aug_offsets, "", matrix_filepath, num_threads, true, true, false, sparse);
+}
+
 
 
 // ------
 // entry points
 
-const char* make_matrix_and_return_string(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
+const char* make_matrix_and_return_string(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath, unsigned num_threads, bool sparse) {
   try {
-    make_matrix(sites_filepath, augmented_pheno_glob, matrix_filepath);
+    make_matrix(sites_filepath, augmented_pheno_glob, matrix_filepath, num_threads, sparse);
+    return "ok";
+  } catch (const std::exception &exc) {
+    return exc.what();
+  } catch (...) {
+    return "[something broke]";
+  }
+}
+
+const char* make_matrix_chrom_and_return_string(const char *sites_filepath, uint64_t sites_offset, uint64_t sites_first_idx, const char **augmented_pheno_filepaths, const uint64_t *augmented_pheno_offsets, unsigned num_phenos,
+                                                const char *chrom, const char *matrix_filepath, unsigned num_threads, int write_header, int sparse) {
+  try {
+    std::vector<std::string> aug_filepaths(augmented_pheno_filepaths, augmented_pheno_filepaths + num_phenos);
+    std::vector<uint64_t> aug_offsets(augmented_pheno_offsets, augmented_pheno_offsets + num_phenos);
+    make_matrix(sites_filepath, sites_offset, sites_first_idx, aug_filepaths, aug_offsets, chrom, matrix_filepath, num_threads, write_header, false, false, sparse);
+    return "ok";
+  } catch (const std::exception &exc) {
+    return exc.what();
+  } catch (...) {
+    return "[something broke]";
+  }
+}
+
+const char* make_matrix_shard_and_return_string(const char *sites_filepath, const char **augmented_pheno_filepaths, unsigned num_phenos, const char *matrix_filepath, unsigned num_threads,
+                                                int pheno_shard) {
+  try {
+    std::vector<std::string> aug_filepaths(augmented_pheno_filepaths, augmented_pheno_filepaths + num_phenos);
+    std::vector<uint64_t> aug_offsets(num_phenos); // initialized to 0s.
+    make_matrix(sites_filepath, 0, 0, aug_filepaths, aug_offsets, "", matrix_filepath, num_threads, true, true, pheno_shard, false);
     return "ok";
   } catch (const std::exception &exc) {
     return exc.what();
@@ -524,21 +857,30 @@ const char* make_matrix_and_return_string(const char *sites_filepath, const char
 }
 
 extern "C" { // we need C because C++ mangles names supposedly
-  extern const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
-    return make_matrix_and_return_string(sites_filepath, augmented_pheno_glob, matrix_filepath);
+  extern const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath, unsigned num_threads, int sparse) {
+    return make_matrix_and_return_string(sites_filepath, augmented_pheno_glob, matrix_filepath, num_threads, sparse);
+  }
+  extern const char* cffi_make_matrix_chrom(const char *sites_filepath, uint64_t sites_offset, uint64_t sites_first_idx, const char **augmented_pheno_filepaths, const uint64_t *augmented_pheno_offsets, unsigned num_phenos,
+                                            const char *chrom, const char *matrix_filepath, unsigned num_threads, int write_header, int sparse) {
+    return make_matrix_chrom_and_return_string(sites_filepath, sites_offset, sites_first_idx, augmented_pheno_filepaths, augmented_pheno_offsets, num_phenos, chrom, matrix_filepath, num_threads, write_header, sparse);
+  }
+  extern const char* cffi_make_matrix_shard(const char *sites_filepath, const char **augmented_pheno_filepaths, unsigned num_phenos, const char *matrix_filepath, unsigned num_threads,
+                                            int pheno_shard) {
+    return make_matrix_shard_and_return_string(sites_filepath, augmented_pheno_filepaths, num_phenos, matrix_filepath, num_threads, pheno_shard);
   }
 }
 
 // for use when compiling directly (for debugging)
 int main(int argc, char **argv) {
-  if (argc == 4) {
-    const char* ret = make_matrix_and_return_string(argv[1], argv[2], argv[3]);
+  if (argc == 4 || argc == 5) {
+    unsigned num_threads = (argc == 5) ? std::stoi(argv[4]) : 1;
+    const char* ret = make_matrix_and_return_string(argv[1], argv[2], argv[3], num_threads, false);
     std::cerr << ret << std::endl;
     std::string good_output = "ok";
     return (0 == good_output.compare(ret)) ? 0 : 1;
   }
   std::cout << "Usage:\n"
-            << " ./x /path/to/sites.tsv \"/path/to/pheno/*\" /path/to/matrix.tsv.gz"
+            << " ./x /path/to/sites.tsv \"/path/to/pheno/*\" /path/to/matrix.tsv.gz [num_threads]"
             << std::endl;
   return 1;
 }
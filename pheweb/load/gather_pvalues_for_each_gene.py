@@ -7,12 +7,13 @@ This avoids reading any variant more than once.
 '''
 
 from ..utils import get_padded_gene_tuples
+from .. import conf
 from ..file_utils import MatrixReader, get_filepath, get_tmp_path
 from .load_utils import Parallelizer
 
-import sqlite3, json, traceback, functools
+import sqlite3, json, traceback, functools, bisect
+import numpy as np
 from pathlib import Path
-from intervaltree import IntervalTree, Interval
 from typing import List,Any,Dict,Tuple
 
 def run(argv:List[str]) -> None:
@@ -22,7 +23,7 @@ def run(argv:List[str]) -> None:
 
     # Check whether we're already up-to-date.
     out_filepath = Path(get_filepath('best-phenos-by-gene-sqlite3', must_exist=False))
-    matrix_filepath = Path(get_filepath('matrix'))
+    matrix_filepath = Path(get_filepath('matrix-manifest' if conf.get_matrix_phenos_per_shard() else 'matrix'))
     if out_filepath.exists() and matrix_filepath.stat().st_mtime < out_filepath.stat().st_mtime:
         print('{} is up-to-date!'.format(str(out_filepath)))
         return
@@ -84,43 +85,84 @@ def process_regions(taskq, retq, parent_overrides) -> None:
     except Exception as exc:
         retq.put({'type':'exception', 'task':None, 'exception_str':str(exc), 'exception_tb':traceback.format_exc()})
         raise
-    tree_for_chrom = get_gene_intervaltree_for_chrom()
+    genes_for_chrom = get_genes_for_chrom()
     with MatrixReader().context() as matrix_reader:
-        f = functools.partial(get_region_info, matrix_reader, tree_for_chrom)
+        f = functools.partial(get_region_info, matrix_reader, genes_for_chrom)
         Parallelizer._make_multiple_tasks_doer(f)(taskq, retq, parent_overrides)
 
-def get_region_info(matrix_reader, tree_for_chrom:Dict[str,IntervalTree], region:Tuple[str,int,int]) -> Dict[str,List[Dict[str,Any]]]:
+def get_region_info(matrix_reader, genes_for_chrom:Dict[str,List[Tuple[int,int,str]]], region:Tuple[str,int,int]) -> Dict[str,List[Dict[str,Any]]]:
+    # Each chunk of variants in the region is read as an array of pvals with a column for each pheno.
+    # The variants in each gene are a range of rows, so its best variant for each pheno is an argmin over those rows.
+    # Only the best variants' phenos are parsed.
     chrom, start, end = region
-    best_assoc_for_pheno_gene_pair: Dict[Tuple[str,str],Dict[str,Any]] = {}
-    # best_assoc_for_pheno_gene_pair is like:
-    # { ('<phenocode>', '<genename>'): {'ac': 35, ... all per_pheno and per_assoc fields} }
-
-    for variant in matrix_reader.get_region(chrom, start, end+1):
-        genenames: List[str] = [iv.data for iv in tree_for_chrom[variant['chrom']].at(variant['pos'])]
-
-        for phenocode, pheno in variant['phenos'].items():
-            assert isinstance(pheno['pval'], float)
-            for genename in genenames:
-                pheno_gene_pair = (phenocode, genename)
-                if pheno_gene_pair not in best_assoc_for_pheno_gene_pair or pheno['pval'] < best_assoc_for_pheno_gene_pair[pheno_gene_pair]['pval']:
-                    best_assoc_for_pheno_gene_pair[pheno_gene_pair] = pheno
+    phenocodes = matrix_reader.get_phenocodes()
+    genes = get_genes_in_region(genes_for_chrom.get(chrom, []), start, end)
+    best_for_gene: Dict[str,_BestAssocs] = {}
+    variant_for_row: Dict[int,Dict[str,Any]] = {} # only has the variants that are the best for some gene and pheno
+    row_offset = 0
+
+    for positions, pvals, get_variant in matrix_reader.get_region_field_arrays(chrom, start, end+1, 'pval'):
+        pvals[np.isnan(pvals)] = np.inf
+        best_rows_in_chunk = []
+        for gene_start, gene_end, genename in genes:
+            lo, hi = np.searchsorted(positions, [gene_start, gene_end]) # genes include `start` but not `end`
+            if lo == hi: continue
+            best = best_for_gene.setdefault(genename, _BestAssocs(len(phenocodes)))
+            best.update(pvals[lo:hi], row_offset + lo)
+            best_rows_in_chunk.append(best.rows[(best.rows >= row_offset) & np.isfinite(best.pvals)])
+        for row in np.unique(np.concatenate(best_rows_in_chunk)) if best_rows_in_chunk else []:
+            variant_for_row[row] = get_variant(row - row_offset)
+        row_offset += len(positions)
 
     phenos_in_gene: Dict[str,List[Dict[str,Any]]] = {}
-    for (phenocode, genename), assoc in best_assoc_for_pheno_gene_pair.items():
-        assoc['phenocode'] = phenocode
-        phenos_in_gene.setdefault(genename, []).append(assoc)
-    for genename in phenos_in_gene:
-        phenos_in_gene[genename] = order_and_truncate_phenos(phenos_in_gene[genename])
+    for genename, best in best_for_gene.items():
+        # Order phenos like they were first seen in the gene's variants, so that ties in pval are ordered like before.
+        pheno_idxs = np.flatnonzero(np.isfinite(best.pvals))
+        if len(pheno_idxs) == 0: continue
+        pheno_idxs = pheno_idxs[np.lexsort((pheno_idxs, best.first_rows[pheno_idxs]))]
+        assocs = []
+        for pheno_idx in pheno_idxs:
+            phenocode = phenocodes[pheno_idx]
+            assoc = variant_for_row[best.rows[pheno_idx]]['phenos'][phenocode]
+            assoc['phenocode'] = phenocode
+            assocs.append(assoc)
+        phenos_in_gene[genename] = order_and_truncate_phenos(assocs)
     return phenos_in_gene
 
+class _BestAssocs:
+    '''For one gene, the lowest pval of each pheno, the row of the variant that has it, and the first row where each pheno has a variant.'''
+    def __init__(self, num_phenos:int):
+        self.pvals = np.full(num_phenos, np.inf)
+        self.rows = np.zeros(num_phenos, dtype=np.int64)
+        self.first_rows = np.full(num_phenos, np.iinfo(np.int64).max)
+    def update(self, pvals:np.ndarray, first_row:int) -> None:
+        best_idxs = pvals.argmin(axis=0)
+        best_pvals = pvals[best_idxs, np.arange(pvals.shape[1])]
+        better = best_pvals < self.pvals # earlier rows win ties
+        self.pvals[better] = best_pvals[better]
+        self.rows[better] = best_idxs[better] + first_row
+        has_variant = np.isfinite(pvals)
+        first_idxs = has_variant.argmax(axis=0)
+        self.first_rows = np.where(has_variant.any(axis=0), np.minimum(self.first_rows, first_idxs + first_row), self.first_rows)
+
+def get_genes_in_region(genes:List[Tuple[int,int,str]], start:int, end:int) -> List[Tuple[int,int,str]]:
+    # Regions are merged from genes, so each gene is entirely inside one region.
+    idx = bisect.bisect_left(genes, (start,))
+    ret = []
+    while idx < len(genes) and genes[idx][0] <= end:
+        if genes[idx][1] <= end: ret.append(genes[idx])
+        idx += 1
+    return ret
+assert get_genes_in_region([(1,5,'a'),(3,9,'b'),(20,30,'c')], 1, 9) == [(1,5,'a'),(3,9,'b')]
+
 @functools.lru_cache(None)
-def get_gene_intervaltree_for_chrom() -> Dict[str,IntervalTree]:
-    tree_for_chrom = {}
+def get_genes_for_chrom() -> Dict[str,List[Tuple[int,int,str]]]:
+    genes_for_chrom: Dict[str,List[Tuple[int,int,str]]] = {}
     for chrom,start,end,genename in get_padded_gene_tuples():
-        if chrom not in tree_for_chrom:
-            tree_for_chrom[chrom] = IntervalTree()
-        tree_for_chrom[chrom].add(Interval(start,end,genename))
-    return tree_for_chrom
+        genes_for_chrom.setdefault(chrom, []).append((start,end,genename))
+    for genes in genes_for_chrom.values():
+        genes.sort()
+    return genes_for_chrom
 
 def order_and_truncate_phenos(phenos: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
     # Decide how many phenotypes to show.
@@ -2,7 +2,7 @@
 from ..utils import round_sig, get_phenolist, PheWebError, fmt_seconds
 from .. import conf
 from .. import parse_utils
-from ..file_utils import get_dated_tmp_path
+from ..file_utils import get_dated_tmp_path, VariantFileReader
 
 import functools
 import traceback
@@ -15,7 +15,7 @@ import sys
 import heapq
 from pathlib import Path
 from types import GeneratorType
-from typing import List,Set,Dict,Optional,Any,Callable,Union
+from typing import List,Set,Dict,Optional,Any,Callable,Union,Sequence
 import re
 
 
@@ -45,6 +45,13 @@ def get_maf(variant:Dict[str,Any], pheno:Dict[str,Any]) -> Optional[float]:
         if not isinstance(maf_sigfigs, int): raise Exception()
         return round_sig(sum(mafs)/len(mafs), maf_sigfigs)
 
+def get_mafs(columns:Dict[str,Sequence[Any]], pheno:Dict[str,Any]) -> List[Optional[float]]:
+    '''Like `get_maf()`, but for each variant in `columns` (like `{'pval': [...], 'maf': [...], ...}`).'''
+    maf_fields = [field for field in ['maf', 'af', 'mac', 'ac'] if field in columns]
+    num_variants = len(next(iter(columns.values())))
+    if not maf_fields: return [None] * num_variants
+    return [get_maf(dict(zip(maf_fields, values)), pheno) for values in zip(*(columns[field] for field in maf_fields))]
+
 
 def exception_printer(f):
     @functools.wraps(f)
@@ -126,7 +133,7 @@ class MaxPriorityQueue:
     # Note: `ComparesFalse()` is used to prevent `heapq` from comparing `item`s to eachother.
     #       Even if two priorities are equal, `ComparesFalse() <= ComparesFalse()` will be `False`, so `item`s won't be compared.
     '''
-    `.pop()` returns the item with the largest priority.
+    `.pop()` returns the item with the largest priority, and `.peek_priority()` returns that priority.
     `.popall()` iteratively `.pop()`s until empty.
     priorities must be comparable.
     `item` can be anything.
@@ -148,11 +155,28 @@ class MaxPriorityQueue:
         return item
     def __len__(self):
         return len(self._q)
+    def peek_priority(self):
+        return -self._q[0][0]
     def pop_all(self):
         while self._q:
             yield self.pop()
 
 
+def scan_variant_file(filepath:str, consumers:List[Any]) -> None:
+    '''
+    Reads the variant file once for several consumers, like `manhattan.ManhattanFileMaker`.
+    Each variant is passed to `consumer.process_variant(variant)` of every consumer, and then each `consumer.finish()` is called.
+    The consumers share each variant, so they must not modify it.
+    '''
+    process_variant_functions = [consumer.process_variant for consumer in consumers]
+    with VariantFileReader(filepath) as variants:
+        for variant in variants:
+            for process_variant in process_variant_functions:
+                process_variant(variant)
+    for consumer in consumers:
+        consumer.finish()
+
+
 class Parallelizer:
     def run_multiple_tasks(self, tasks, do_multiple_tasks, cmd=None):
         '''
@@ -20,11 +20,11 @@ def run(argv:List[str]) -> None:
 
     else:
         def get_cpra_rsid_pairs() -> Iterator[Tuple[str,Optional[str]]]:
-            with VariantFileReader(sites_filepath) as reader:
+            with VariantFileReader(sites_filepath, fields=['chrom', 'pos', 'ref', 'alt', 'rsids'], records=True) as reader:
                 for v in reader:
-                    cpra = '{chrom}-{pos}-{ref}-{alt}'.format(**v)
-                    if v['rsids']:
-                        for rsid in v['rsids'].split(','):
+                    cpra = '{}-{}-{}-{}'.format(v.chrom, v.pos, v.ref, v.alt)
+                    if v.rsids:
+                        for rsid in v.rsids.split(','):
                             yield (cpra, rsid)
                     else:
                         yield (cpra, None)
@@ -8,20 +8,23 @@ This script creates json files which can be used to render Manhattan plots.
 # TODO: optimize binning for fold@20 view.
 #       - if we knew the max_qval before we started (eg, by running qq first), it would be very easy.
 #       - at present, we set qval bin size well for the [0-40] range but not for variants above that.
-# TODO: combine with QQ?
+# NOTE: `pheweb summarize-phenos` makes these files along with the QQ files, using `ManhattanFileMaker`.
 
 # TODO: keep 10 variants unbinned from each chrom
 
-from ..utils import chrom_order
+from ..utils import chrom_order, chrom_order_list
 from .. import conf
-from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
-from .load_utils import MaxPriorityQueue, parallelize_per_pheno, get_phenos_subset, get_phenolist
+from ..file_utils import write_json, get_pheno_filepath, read_sidecar, VariantFileReader
+from .load_utils import MaxPriorityQueue, parallelize_per_pheno, get_phenos_subset, get_phenolist, scan_variant_file
 
-import math, argparse
-from typing import List,Dict,Any,Tuple
+import math, argparse, array, heapq, itertools
+import numpy as np
+from typing import List,Dict,Any,Tuple,Optional,Set,Callable
 Variant = Dict[str,Any]
 
 BIN_LENGTH = int(3e6)
+QVAL_BIN_SIZES = [0.05, 0.1, 0.2]
+INF_FLOOR = 2**32 - 1
 
 
 def run(argv:List[str]) -> None:
@@ -44,124 +47,234 @@ def make_manhattan_json_file(pheno:Dict[str,Any]) -> None:
     make_manhattan_json_file_explicit(get_pheno_filepath('pheno_gz', pheno['phenocode']),
                                       get_pheno_filepath('manhattan', pheno['phenocode'], must_exist=False))
 def make_manhattan_json_file_explicit(in_filepath:str, out_filepath:str) -> None:
-    binner = Binner()
-    with VariantFileReader(in_filepath) as variants:
-        for variant in variants:
-            binner.process_variant(variant)
-    data = binner.get_result()
-    write_json(filepath=out_filepath, data=data)
+    sidecar = read_sidecar(in_filepath)
+    if sidecar is not None:
+        write_json(filepath=out_filepath, data=get_manhattan_data_from_sidecar(sidecar, in_filepath))
+    else:
+        scan_variant_file(in_filepath, [ManhattanFileMaker(out_filepath)])
+
+def get_manhattan_data_from_sidecar(sidecar:np.ndarray, in_filepath:str, row_mask:Optional[np.ndarray] = None) -> Dict[str,List[Variant]]:
+    '''
+    Bins the variants of `in_filepath` (only those where `row_mask` is True) using the columns of its sidecar.
+    Only the variants that stay unbinned are read from `in_filepath`.
+    '''
+    idxs = np.arange(len(sidecar)) if row_mask is None else np.flatnonzero(row_mask)
+    columns = sidecar[idxs]
+    def get_variants(binner_idxs:np.ndarray) -> List[Variant]:
+        unbinned_mask = np.zeros(len(sidecar), dtype=bool)
+        unbinned_mask[idxs[binner_idxs]] = True
+        with VariantFileReader(in_filepath, row_mask=unbinned_mask) as reader:
+            return list(reader)
+    return Binner(columns['chrom_idx'], columns['pos'], columns['pval']).get_result(get_variants)
+
+def get_manhattan_data_from_variants(variants:List[Variant]) -> Dict[str,List[Variant]]:
+    binner = Binner(np.fromiter((chrom_order[v['chrom']] for v in variants), dtype=np.int64, count=len(variants)),
+                    np.fromiter((v['pos'] for v in variants), dtype=np.int64, count=len(variants)),
+                    np.fromiter((v['pval'] for v in variants), dtype=np.float64, count=len(variants)))
+    return binner.get_result(lambda idxs: [variants[idx] for idx in idxs.tolist()])
+
+class ManhattanFileMaker:
+    '''
+    Makes a manhattan json file from the variants of a pheno file, for `scan_variant_file()`.
+    It collects chrom, pos, and pval for `Binner`, but it only keeps the whole variants that might stay unbinned:
+    those in peaks, and those with fewer than `num_unbinned + peak_max_count` stronger variants before them.
+    '''
+    def __init__(self, out_filepath:str):
+        self._out_filepath = out_filepath
+        self._chrom_idxs = array.array('B')
+        self._positions = array.array('I')
+        self._pvals = array.array('d')
+        self._variants: Dict[int,Variant] = {}
+        self._peak_pval_threshold = conf.get_manhattan_peak_pval_threshold()
+        self._num_strongest = conf.get_manhattan_num_unbinned() + conf.get_manhattan_peak_max_count()
+        self._strongest_pvals: List[float] = []  # a heap of the negated `_num_strongest` strongest pvals so far
+    def process_variant(self, v:Variant) -> None:
+        pval = v['pval']
+        if len(self._strongest_pvals) < self._num_strongest:
+            heapq.heappush(self._strongest_pvals, -pval)
+            self._variants[len(self._pvals)] = v
+        elif pval <= -self._strongest_pvals[0]:
+            heapq.heappushpop(self._strongest_pvals, -pval)
+            self._variants[len(self._pvals)] = v
+        elif pval < self._peak_pval_threshold:
+            self._variants[len(self._pvals)] = v
+        self._chrom_idxs.append(chrom_order[v['chrom']])
+        self._positions.append(v['pos'])
+        self._pvals.append(pval)
+    def finish(self) -> None:
+        binner = Binner(np.frombuffer(self._chrom_idxs, dtype=np.uint8), np.frombuffer(self._positions, dtype=np.uintc), np.frombuffer(self._pvals, dtype=np.float64))
+        write_json(filepath=self._out_filepath, data=binner.get_result(lambda idxs: [self._variants[idx] for idx in idxs.tolist()]))
 
 
 class Binner:
-    def __init__(self):
-        self._peak_best_variant = None
-        self._peak_last_chrpos = None
-        self._peak_pq = MaxPriorityQueue()
-        self._unbinned_variant_pq = MaxPriorityQueue()
-        self._bins = {} # like {<chrom>: {<pos // bin_length>: [{chrom, startpos, qvals}]}}
-        self._qval_bin_size = 0.05 # this makes 200 bins for the minimum-allowed y-axis covering 0-10
-        self._num_significant_in_current_peak = 0  # num variants stronger than manhattan_peak_variant_counting_pval_threshold
+    '''
+    Bins the variants of a pheno, from arrays of their chrom indexes (in `chrom_order`), positions, and pvals (in the order of the pheno file).
+
+    Each variant is either kept for a peak, kept unbinned, or binned:
+      - A peak is a run of variants with pval < `conf.get_manhattan_peak_pval_threshold()` (ignoring the weaker variants between them)
+        where each is on the same chrom as the last and within `conf.get_manhattan_peak_sprawl_dist()` of it.
+        The strongest variant of each peak (the first, if tied) is pushed into `peak_pq` at the end of the peak, and its other variants are pushed into `unbinned_variant_pq`.
+      - Whenever `peak_pq` exceeds the size `conf.get_manhattan_peak_max_count()`, its member with the weakest pval is pushed into `unbinned_variant_pq`.
+      - Whenever `unbinned_variant_pq` exceeds the size `conf.get_manhattan_num_unbinned()`, its member with the weakest pval is binned.
+    A binned variant's qval is rounded using the qval bin size at that point in the file, which depends on the last variant with qval > 20.
+    The peaks and the pushes are found with arrays.  The queues are still `MaxPriorityQueue`s so that ties are broken the same way,
+    but only pushes that are stronger than the weakest member of the full `unbinned_variant_pq` are pushed.
+    '''
+    def __init__(self, chrom_idxs:np.ndarray, positions:np.ndarray, pvals:np.ndarray):
+        self._chrom_idxs = np.asarray(chrom_idxs, dtype=np.int64)
+        self._positions = np.asarray(positions, dtype=np.int64)
+        self._pvals = np.asarray(pvals, dtype=np.float64)
+        assert len(self._chrom_idxs) == len(self._positions) == len(self._pvals)
         assert conf.get_manhattan_peak_variant_counting_pval_threshold() < conf.get_manhattan_peak_pval_threshold() # counting must be stricter than peak-extending
 
-    def process_variant(self, variant:Variant) -> None:
-        '''
-        There are 3 types of variants:
-          a) If the variant starts or extends a peak and has a stronger pval than the current `peak_best_variant`:
-             1) push the old `peak_best_variant` into `unbinned_variant_pq`.
-             2) make the current variant the new `peak_best_variant`.
-          b) If the variant ends a peak, push `peak_best_variant` into `peak_pq` and push the current variant into `unbinned_variant_pq`.
-          c) Otherwise, just push the variant into `unbinned_variant_pq`.
-        Whenever `peak_pq` exceeds the size `conf.get_manhattan_peak_max_count()`, push its member with the weakest pval into `unbinned_variant_pq`.
-        Whenever `unbinned_variant_pq` exceeds the size `conf.get_manhattan_num_unbinned()`, bin its member with the weakest pval.
-        So, at the end, we'll have `peak_pq`, `unbinned_variant_pq`, and `bins`.
-        '''
+    def get_result(self, get_variants:Callable[[np.ndarray],List[Variant]]) -> Dict[str,List[Variant]]:
+        '''`get_variants(idxs)` must return the variants at the (sorted) indexes `idxs`, which are the ones that stay unbinned.'''
+        num_variants = len(self._pvals)
+        qvals = self._get_qvals(self._pvals)
+        qval_bin_sizes = self._get_qval_bin_sizes(qvals)
+        peak_idxs, peak_num_significants, peak_times, other_push_idxs, other_push_times = self._get_peaks()
 
-        if variant['pval'] != 0:
-            qval = -math.log10(variant['pval'])
-            if qval > 40:
-                self._qval_bin_size = 0.2 # this makes 200 bins for a y-axis extending past 40 (but folded so that the lower half is 0-20)
-            elif qval > 20:
-                self._qval_bin_size = 0.1 # this makes 200-400 bins for a y-axis extending up to 20-40.
-
-        if variant['pval'] < conf.get_manhattan_peak_pval_threshold(): # part of a peak
-            if self._peak_best_variant is None: # open a new peak
-                self._peak_best_variant = variant
-                self._peak_last_chrpos = (variant['chrom'], variant['pos'])
-                self._num_significant_in_current_peak = 1 if variant['pval'] < conf.get_manhattan_peak_variant_counting_pval_threshold() else 0
-            elif self._peak_last_chrpos[0] == variant['chrom'] and self._peak_last_chrpos[1] + conf.get_manhattan_peak_sprawl_dist() > variant['pos']: # extend current peak
-                if variant['pval'] < conf.get_manhattan_peak_variant_counting_pval_threshold(): self._num_significant_in_current_peak += 1
-                self._peak_last_chrpos = (variant['chrom'], variant['pos'])
-                if variant['pval'] >= self._peak_best_variant['pval']:
-                    self._maybe_bin_variant(variant)
-                else:
-                    self._maybe_bin_variant(self._peak_best_variant)
-                    self._peak_best_variant = variant
-            else: # close old peak and open new peak
-                self._peak_best_variant['num_significant_in_peak'] = self._num_significant_in_current_peak
-                self._num_significant_in_current_peak = 1 if variant['pval'] < conf.get_manhattan_peak_variant_counting_pval_threshold() else 0
-                self._maybe_peak_variant(self._peak_best_variant)
-                self._peak_best_variant = variant
-                self._peak_last_chrpos = (variant['chrom'], variant['pos'])
-        else:
-            self._maybe_bin_variant(variant)
-
-    def _maybe_peak_variant(self, variant:Variant) -> None:
-        self._peak_pq.add_and_keep_size(variant, variant['pval'],
-                                        size=conf.get_manhattan_peak_max_count(),
-                                        popped_callback=self._maybe_bin_variant)
-    def _maybe_bin_variant(self, variant:Variant) -> None:
-        self._unbinned_variant_pq.add_and_keep_size(variant, variant['pval'],
-                                                    size=conf.get_manhattan_num_unbinned(),
-                                                    popped_callback=self._bin_variant)
-    def _bin_variant(self, variant:Variant) -> None:
-        chrom_idx = chrom_order[variant['chrom']]
-        if chrom_idx not in self._bins: self._bins[chrom_idx] = {}
-        pos_bin_id = variant['pos'] // BIN_LENGTH
-        if pos_bin_id not in self._bins[chrom_idx]:
-            self._bins[chrom_idx][pos_bin_id] = {'chrom': variant['chrom'], 'startpos': pos_bin_id * BIN_LENGTH, 'qvals': set()}
-        qval = math.inf if variant['pval'] == 0 else self._rounded(-math.log10(variant['pval']))
-        self._bins[chrom_idx][pos_bin_id]["qvals"].add(qval)
-
-    def get_result(self) -> Dict[str,List[Variant]]:
-        # this can only be called once
-        if getattr(self, 'already_got_result', None): raise Exception()
-        self.already_got_result = True
-
-        if self._peak_best_variant:
-            self._peak_best_variant['num_significant_in_peak'] = self._num_significant_in_current_peak
-            self._maybe_peak_variant(self._peak_best_variant)
-
-        peaks = list(self._peak_pq.pop_all())
-        for peak in peaks: peak['peak'] = True
-        unbinned_variants = list(self._unbinned_variant_pq.pop_all())
-        unbinned_variants = sorted(unbinned_variants + peaks, key=(lambda variant: variant['pval']))
-
-        # unroll dict-of-dict-of-array `bins` into array `variant_bins`
-        variant_bins = []
-        for chrom_idx in sorted(self._bins.keys()):
-            for pos_bin_id in sorted(self._bins[chrom_idx].keys()):
-                b = self._bins[chrom_idx][pos_bin_id]
-                assert len(b['qvals']) > 0
-                b['qvals'], b['qval_extents'] = self._get_qvals_and_qval_extents(b['qvals'])
-                b['pos'] = int(b['startpos'] + BIN_LENGTH/2)
-                del b['startpos']
-                variant_bins.append(b)
+        # Each peak is pushed into `peak_pq` at the first variant of the next peak (or at the end of the file).
+        # Pushes into `unbinned_variant_pq` are variants (by index) or peaks that overflowed `peak_pq` (by `num_variants + <index in peak_idxs>`).
+        peak_pq = MaxPriorityQueue()
+        overflowed_peaks: List[int] = []
+        overflow_times: List[int] = []
+        for peak, (idx, time) in enumerate(zip(peak_idxs.tolist(), peak_times.tolist())):
+            if len(peak_pq) >= conf.get_manhattan_peak_max_count(): overflow_times.append(time)  # a peak will overflow
+            peak_pq.add_and_keep_size(peak, self._pvals[idx], size=conf.get_manhattan_peak_max_count(), popped_callback=overflowed_peaks.append)
+        non_peak_idxs = np.flatnonzero(~(self._pvals < conf.get_manhattan_peak_pval_threshold()))
+        overflowed_peaks_arr = np.array(overflowed_peaks, dtype=np.int64)
+        push_items = np.concatenate([non_peak_idxs, other_push_idxs, num_variants + overflowed_peaks_arr])
+        push_variant_idxs = np.concatenate([non_peak_idxs, other_push_idxs, peak_idxs[overflowed_peaks_arr]])
+        push_times = np.concatenate([non_peak_idxs, other_push_times, np.array(overflow_times, dtype=np.int64)])
+        order = np.argsort(push_times, kind='stable')
+        push_items, push_variant_idxs, push_times = push_items[order], push_variant_idxs[order], push_times[order]
+        push_pvals = self._pvals[push_variant_idxs]
+
+        unbinned_variant_pq = MaxPriorityQueue()
+        num_unbinned = conf.get_manhattan_num_unbinned()
+        binned_pushes: List[np.ndarray] = []  # indexes into `push_*` of binned pushes, and of the pushes that binned them
+        binning_pushes: List[np.ndarray] = []
+        popped_pushes: List[int] = []
+        popping_pushes: List[int] = []
+        start = 0
+        while start < len(push_items):
+            if len(unbinned_variant_pq) < num_unbinned:
+                stop = min(start + num_unbinned - len(unbinned_variant_pq), len(push_items))
+                candidates = np.arange(start, stop)
+            else:
+                stop = min(start + 65536, len(push_items))
+                is_candidate = push_pvals[start:stop] < unbinned_variant_pq.peek_priority()
+                rejected = start + np.flatnonzero(~is_candidate)
+                binned_pushes.append(rejected); binning_pushes.append(rejected)
+                candidates = start + np.flatnonzero(is_candidate)
+            for push in candidates.tolist():
+                if len(unbinned_variant_pq) >= num_unbinned: popping_pushes.append(push)
+                unbinned_variant_pq.add_and_keep_size(push, push_pvals[push], size=num_unbinned, popped_callback=popped_pushes.append)
+            start = stop
+        binned_pushes.append(np.array(popped_pushes, dtype=np.int64)); binning_pushes.append(np.array(popping_pushes, dtype=np.int64))
+        binned_pushes_arr, binning_pushes_arr = np.concatenate(binned_pushes), np.concatenate(binning_pushes)
+        variant_bins = self._get_variant_bins(push_variant_idxs[binned_pushes_arr], qval_bin_sizes[push_times[binning_pushes_arr]], qvals, qval_bin_sizes[-1])
+
+        peaks = list(peak_pq.pop_all())
+        unbinned_pushes = list(unbinned_variant_pq.pop_all())
+        unbinned_items = push_items[np.array(unbinned_pushes, dtype=np.int64)].tolist()
+        needed_idxs = np.unique(np.concatenate([peak_idxs[peaks], push_variant_idxs[unbinned_pushes]]).astype(np.int64))
+        variant_for_idx = dict(zip(needed_idxs.tolist(), get_variants(needed_idxs)))
+        def get_peak(peak:int) -> Variant:
+            return {**variant_for_idx[int(peak_idxs[peak])], 'num_significant_in_peak': int(peak_num_significants[peak])}
+        unbinned_variants = [variant_for_idx[item] if item < num_variants else get_peak(item - num_variants) for item in unbinned_items]
+        peak_variants = [{**get_peak(peak), 'peak': True} for peak in peaks]
+        unbinned_variants = sorted(unbinned_variants + peak_variants, key=(lambda variant: variant['pval']))
 
         return {
             'variant_bins': variant_bins,
             'unbinned_variants': unbinned_variants,
         }
 
-    def _rounded(self, qval:float) -> float:
-        # round down to the nearest multiple of `self._qval_bin_size`, then add 1/2 of `self._qval_bin_size` to be in the middle of the bin
-        x = qval // self._qval_bin_size * self._qval_bin_size + self._qval_bin_size / 2
+    @staticmethod
+    def _get_qvals(pvals:np.ndarray) -> np.ndarray:
+        # `np.log10()` sometimes differs from `math.log10()` in the last bit, which can change rounding, so use `math.log10()` on each unique pval.
+        unique_pvals, inverse = np.unique(pvals, return_inverse=True)
+        unique_qvals = np.array([math.inf if pval == 0 else -math.log10(pval) for pval in unique_pvals.tolist()], dtype=np.float64)
+        return unique_qvals[inverse.ravel()]
+
+    def _get_qval_bin_sizes(self, qvals:np.ndarray) -> np.ndarray:
+        '''Returns the qval bin size after each variant, and then at the end.'''
+        # 0.05 makes 200 bins for the minimum-allowed y-axis covering 0-10.
+        # 0.1 makes 200-400 bins for a y-axis extending up to 20-40.
+        # 0.2 makes 200 bins for a y-axis extending past 40 (but folded so that the lower half is 0-20).
+        is_large = (self._pvals != 0) & (qvals > 20)
+        last_large_idxs = np.maximum.accumulate(np.where(is_large, np.arange(len(qvals)), -1))
+        sizes = np.where(last_large_idxs == -1, QVAL_BIN_SIZES[0], np.where(qvals[np.maximum(last_large_idxs, 0)] > 40, QVAL_BIN_SIZES[2], QVAL_BIN_SIZES[1]))
+        return np.append(sizes, sizes[-1] if len(sizes) else QVAL_BIN_SIZES[0])
+
+    def _get_peaks(self) -> Tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray,np.ndarray]:
+        '''
+        Returns (for each peak) the index of its strongest variant, its number of variants with pval < `conf.get_manhattan_peak_variant_counting_pval_threshold()`,
+        and the index of the first variant of the next peak (or `len(pvals)` at the end),
+        and (for each other variant in a peak) the index of the variant it pushes into `unbinned_variant_pq` and its own index.
+        '''
+        idxs = np.flatnonzero(self._pvals < conf.get_manhattan_peak_pval_threshold())
+        if len(idxs) == 0:
+            empty = np.array([], dtype=np.int64)
+            return (empty, empty, empty, empty, empty)
+        chrom_idxs, positions, pvals = self._chrom_idxs[idxs], self._positions[idxs], self._pvals[idxs]
+        starts_peak = np.ones(len(idxs), dtype=bool)
+        starts_peak[1:] = (chrom_idxs[1:] != chrom_idxs[:-1]) | (positions[:-1] + conf.get_manhattan_peak_sprawl_dist() <= positions[1:])
+        peak_ids = np.cumsum(starts_peak) - 1
+        peak_starts = np.flatnonzero(starts_peak)
+        # A variant becomes its peak's strongest if its pval is smaller than all before it in the peak.
+        # To find the smallest pval so far in each peak, accumulate the max of `(peak_id, -rank)` packed into an int.
+        ranks = np.unique(pvals, return_inverse=True)[1].ravel().astype(np.int64)
+        m = len(idxs) + 1
+        min_ranks = m - 1 - (np.maximum.accumulate(peak_ids * m + (m - 1 - ranks)) - peak_ids * m)
+        is_strongest = starts_peak.copy()
+        is_strongest[1:] |= ranks[1:] < min_ranks[:-1]
+        strongest = np.maximum.accumulate(np.where(is_strongest, np.arange(len(idxs)), 0))
+        # Each other variant pushes either itself or the variant that it replaces as strongest.
+        others = np.flatnonzero(~starts_peak)
+        push_idxs = idxs[np.where(is_strongest[others], strongest[others - 1], others)]
+        peak_last = np.append(peak_starts[1:], len(idxs)) - 1
+        num_significants = np.add.reduceat(pvals < conf.get_manhattan_peak_variant_counting_pval_threshold(), peak_starts).astype(np.int64)
+        return (idxs[strongest[peak_last]], num_significants, np.append(idxs[peak_starts[1:]], len(self._pvals)), push_idxs, idxs[others])
+
+    def _get_variant_bins(self, idxs:np.ndarray, qval_bin_sizes:np.ndarray, qvals:np.ndarray, final_qval_bin_size:float) -> List[Dict[str,Any]]:
+        '''Bins the variants at `idxs`, each rounded with its qval bin size, and then re-rounded with the final qval bin size.'''
+        # A rounded qval only depends on the qval bin size and `qval // qval_bin_size`, so pack those with the bin into an int for `np.unique()`.
+        # Variants with pval=0 get qval=inf, which isn't rounded.
+        size_codes = np.searchsorted(QVAL_BIN_SIZES, qval_bin_sizes)
+        assert np.array_equal(np.array(QVAL_BIN_SIZES)[size_codes], qval_bin_sizes)
+        with np.errstate(invalid='ignore'):
+            floors = np.where(self._pvals[idxs] == 0, INF_FLOOR, qvals[idxs] // qval_bin_sizes).astype(np.int64)
+        bin_ids = self._chrom_idxs[idxs] * 2048 + self._positions[idxs] // BIN_LENGTH  # `pos // BIN_LENGTH` < 2048
+        keys = np.unique(bin_ids << 34 | size_codes << 32 | floors)
+        variant_bins = []
+        for bin_id, group in itertools.groupby(keys.tolist(), key=lambda key: key >> 34):
+            qvals_in_bin = set()
+            for key in group:
+                qval_bin_size, floor = QVAL_BIN_SIZES[key >> 32 & 3], key & INF_FLOOR
+                qvals_in_bin.add(math.inf if floor == INF_FLOOR else round(floor * qval_bin_size + qval_bin_size / 2, 3))  # trim `0.35000000000000003` to `0.35`
+            bin_qvals, bin_qval_extents = self._get_qvals_and_qval_extents(qvals_in_bin, final_qval_bin_size)
+            variant_bins.append({
+                'chrom': chrom_order_list[bin_id // 2048],
+                'qvals': bin_qvals,
+                'qval_extents': bin_qval_extents,
+                'pos': int(bin_id % 2048 * BIN_LENGTH + BIN_LENGTH/2),
+            })
+        return variant_bins
+
+    @staticmethod
+    def _rounded(qval:float, qval_bin_size:float) -> float:
+        # round down to the nearest multiple of `qval_bin_size`, then add 1/2 of `qval_bin_size` to be in the middle of the bin
+        x = qval // qval_bin_size * qval_bin_size + qval_bin_size / 2
         return round(x, 3) # trim `0.35000000000000003` to `0.35` for convenience and network request size
 
-    def _get_qvals_and_qval_extents(self, qvals:List[float]) -> Tuple[List[float],List[Tuple[float,float]]]:
-        qvals = sorted(self._rounded(qval) for qval in qvals)
-        extents = [(qvals[0], qvals[0])]
-        for q in qvals:
-            if q <= extents[-1][1] + self._qval_bin_size * 1.1:
+    def _get_qvals_and_qval_extents(self, qvals:Set[float], qval_bin_size:float) -> Tuple[List[float],List[Tuple[float,float]]]:
+        qvals_list = sorted(self._rounded(qval, qval_bin_size) for qval in qvals)
+        extents = [(qvals_list[0], qvals_list[0])]
+        for q in qvals_list:
+            if q <= extents[-1][1] + qval_bin_size * 1.1:
                 extents[-1] = (extents[-1][0], q)
             else:
                 extents.append((q,q))
@@ -1,21 +1,25 @@
 
-# TODO: Parallelize by chromosome.
-#  Spawn a pheweb process to do each chromosome.  Each one must do:
-#  + For every `pheno_gz/*.gz` and `sites/sites.tsv`, find the byte offset to the block that begins our chromosome.
-#  + Now cffi down into a function just like our normal one, but which starts at that offset, discards variants until it hits the target chromosome, merges, and then exits.
-#  + Don't append an empty block in `BgzipWriter:close()`.
-#  When all the child processes are done, the main thread needs to concatenate all the single-chrom matrix files and then append an empty bgzip block to signal EOF.
+# When there are multiple processes, each chromosome is merged in its own process:
+#  + For every `pheno_gz/*.gz` and `sites/sites.tsv`, the tabix index gives the offset of the BGZF block that begins our chromosome.
+#  + The cffi function starts at that offset, merges until sites.tsv leaves the chromosome, and doesn't append an empty block to signal EOF.
+#  When all the child processes are done, the main process concatenates all the single-chrom matrix files and then appends an empty block to signal EOF.
+#  It also concatenates their tabix indexes, which the c++ writes along with each matrix file.
+# With `matrix_phenos_per_shard`, the matrix is instead split by columns into the files in `matrix/manifest.json` (see `make_sharded_matrix()`).
 
 
 from ..utils import get_phenolist, PheWebError
-from ..file_utils import MatrixReader, get_tmp_path, get_filepath, get_pheno_filepath
-from .load_utils import mtime
+from .. import conf
+from ..file_utils import MatrixReader, BgzipWriter, get_tmp_path, get_filepath, get_pheno_filepath, get_chrom_virtual_offsets, concatenate_tabix_indexes, write_json, get_sites_table, get_site_index_header
+from .load_utils import mtime, ProgressBar
 from .cffi._x import ffi, lib
 
 import os
 import glob
+import json
+import shutil
+import multiprocessing
 import pysam
-from typing import List
+from typing import List, Dict, Any, Optional, Set
 
 
 def clear_out_junk() -> None:
@@ -36,9 +40,13 @@ def should_run() -> bool:
     # If the matrix's columns don't match the phenos in pheno-list, rebuild.
     cur_phenocodes = set(pheno['phenocode'] for pheno in get_phenolist())
     try:
-        matrix_phenocodes = set(MatrixReader().get_phenocodes())
+        matrix_reader = MatrixReader()
+        matrix_phenocodes = set(matrix_reader.get_phenocodes())
     except Exception:
         return True # if something broke, let's just rebuild the matrix.
+    if matrix_reader.is_sparse() != conf.should_make_sparse_matrix():
+        print('re-running because `matrix_sparse` changed.')
+        return True
     if matrix_phenocodes != cur_phenocodes:
         print('re-running because cur matrix has wrong phenos.')
         print('- phenos in pheno-list.json but not matrix.tsv.gz:', ', '.join(repr(p) for p in cur_phenocodes - matrix_phenocodes))
@@ -60,6 +68,11 @@ def run(argv:List[str]) -> None:
         print('Make a single large tabixed file of all phenotypes data')
         exit(1)
 
+    phenos_per_shard = conf.get_matrix_phenos_per_shard()
+    if phenos_per_shard:
+        make_sharded_matrix(phenos_per_shard)
+        return
+
     matrix_gz_filepath = get_filepath('matrix', must_exist=False)
     if should_run():
         clear_out_junk()
@@ -68,19 +81,27 @@ def run(argv:List[str]) -> None:
         pheno_gz_glob = get_filepath('pheno_gz')+'/*.gz'
         matrix_gz_tmp_filepath = get_tmp_path(matrix_gz_filepath)
 
-        # we don't need `ffi.new('char[]', ...)` because args are `const`
-        ret = lib.cffi_make_matrix(sites_filepath.encode('utf8'),
-                                   pheno_gz_glob.encode('utf8'),
-                                   matrix_gz_tmp_filepath.encode('utf8'))
-        ret_bytes = ffi.string(ret, maxlen=1000)
-        if ret_bytes != b'ok':
-            raise PheWebError('The portion of `pheweb matrix` written in c++/cffi failed with the message ' + repr(ret_bytes))
+        num_procs = conf.get_num_procs('matrix')
+        pheno_gz_filepaths = sorted(glob.glob(pheno_gz_glob))  # sorted like the glob in c++
+        if num_procs > 1 and all(os.path.exists(filepath + '.tbi') for filepath in [sites_filepath] + pheno_gz_filepaths):
+            make_matrix_by_chrom(sites_filepath, pheno_gz_filepaths, matrix_gz_tmp_filepath, num_procs)
+        else:
+            if num_procs > 1: print('Making the matrix in one process because sites.tsv or some pheno_gz files are missing their tabix index.')
+            # we don't need `ffi.new('char[]', ...)` because args are `const`
+            ret = lib.cffi_make_matrix(sites_filepath.encode('utf8'),
+                                       pheno_gz_glob.encode('utf8'),
+                                       matrix_gz_tmp_filepath.encode('utf8'),
+                                       conf.get_num_compression_threads(),
+                                       conf.should_make_sparse_matrix())
+            check_cffi_return_value(ret)
         os.rename(matrix_gz_tmp_filepath, matrix_gz_filepath)
+        os.rename(matrix_gz_tmp_filepath + '.tbi', matrix_gz_filepath + '.tbi')
     else:
         print('matrix is up-to-date!')
 
     matrix_tbi_filepath = matrix_gz_filepath + '.tbi'
     if not os.path.exists(matrix_tbi_filepath) or mtime(matrix_tbi_filepath) < mtime(matrix_gz_filepath):
+        # The c++ writes the index along with the matrix, so this is only for older matrices
         print('tabixing matrix')
         pysam.tabix_index(
             filename=matrix_gz_filepath, force=True,
@@ -88,3 +109,169 @@ def run(argv:List[str]) -> None:
         )
     else:
         print('matrix.tbi is up-to-date!')
+
+
+def check_cffi_return_value(ret:Any) -> None:
+    ret_bytes = ffi.string(ret, maxlen=1000)
+    if ret_bytes != b'ok':
+        raise PheWebError('The portion of `pheweb matrix` written in c++/cffi failed with the message ' + repr(ret_bytes))
+
+def make_matrix_by_chrom(sites_filepath:str, pheno_gz_filepaths:List[str], out_filepath:str, num_procs:int) -> None:
+    '''Makes the matrix for each chromosome in a separate process, using the tabix indexes, and then concatenates them.'''
+    sites_offsets = get_chrom_virtual_offsets(sites_filepath + '.tbi')
+    pheno_offsets = [get_chrom_virtual_offsets(filepath + '.tbi') for filepath in pheno_gz_filepaths]
+    chroms = sorted(sites_offsets, key=sites_offsets.__getitem__)
+    # Pheno files made with `pheno_gz_site_index` are matched by their index in sites.tsv, so each process needs the index of its chromosome's first variant.
+    site_index_headers = [get_site_index_header(filepath) for filepath in pheno_gz_filepaths]
+    sites_table = get_sites_table() if any(site_index_headers) else None
+    for filepath, site_index_header in zip(pheno_gz_filepaths, site_index_headers):
+        if not site_index_header: continue
+        assert sites_table is not None
+        if site_index_header != 'site@' + sites_table.id:
+            raise PheWebError("{} was made from a different sites file than the current one, so it must be remade by `pheweb augment-phenos`.".format(filepath))
+    tasks: List[Dict[str,Any]] = []
+    for i, chrom in enumerate(chroms):
+        tasks.append({
+            'sites_filepath': sites_filepath,
+            'sites_offset': sites_offsets[chrom],
+            'sites_first_idx': sites_table.get_first_idx_of_chrom(chrom) if sites_table else 2**64-1,
+            'pheno_gz_filepaths': pheno_gz_filepaths,
+            'pheno_gz_offsets': [offsets.get(chrom, 0) for offsets in pheno_offsets],  # phenos without this chrom are read from the start and never match
+            'chrom': chrom,
+            'write_header': i == 0,
+            'sparse': conf.should_make_sparse_matrix(),
+            'out_filepath': '{}-{}'.format(out_filepath, i),
+        })
+    if not tasks: raise PheWebError("sites.tsv has no variants")
+
+    with ProgressBar() as progressbar, multiprocessing.Pool(min(num_procs, len(tasks))) as pool:
+        num_done = 0
+        for _ in pool.imap_unordered(make_matrix_chrom, tasks):
+            num_done += 1
+            progressbar.set_message('Made the matrix for {} of {} chromosomes in {}'.format(num_done, len(tasks), progressbar.fmt_elapsed()))
+
+    # Each file is a sequence of BGZF blocks without the EOF block, so they can just be concatenated.
+    shard_filepaths = [task['out_filepath'] for task in tasks]
+    with open(out_filepath, 'wb') as f_out:
+        for filepath in shard_filepaths:
+            with open(filepath, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f_out, 2**20)
+        f_out.write(BgzipWriter._eof_block)
+    concatenate_tabix_indexes(shard_filepaths, out_filepath + '.tbi')
+    for filepath in shard_filepaths:
+        os.remove(filepath)
+        os.remove(filepath + '.tbi')
+
+def make_matrix_chrom(task:Dict[str,Any]) -> None:
+    pheno_gz_filepaths = [ffi.new('char[]', filepath.encode('utf8')) for filepath in task['pheno_gz_filepaths']]
+    ret = lib.cffi_make_matrix_chrom(task['sites_filepath'].encode('utf8'),
+                                     task['sites_offset'],
+                                     task['sites_first_idx'],
+                                     ffi.new('const char *[]', pheno_gz_filepaths),
+                                     ffi.new('uint64_t[]', task['pheno_gz_offsets']),
+                                     len(pheno_gz_filepaths),
+                                     task['chrom'].encode('utf8'),
+                                     task['out_filepath'].encode('utf8'),
+                                     1,  # each chromosome already has its own process
+                                     task['write_header'],
+                                     task['sparse'])
+    check_cffi_return_value(ret)
+
+
+def make_sharded_matrix(phenos_per_shard:int) -> None:
+    '''
+    Makes `matrix/manifest.json`, which lists a file of the per-variant fields of sites.tsv and shards of the per-assoc fields of `phenos_per_shard` phenos each.
+    Only the files whose inputs changed are remade, so adding or removing phenos only remakes the shards that have them.
+    A shard's per-assoc fields come from its phenos' files in `parsed/`, so it isn't remade when `pheweb augment-phenos` rewrites `pheno_gz/` for a new sites.tsv.
+    '''
+    manifest_filepath = get_filepath('matrix-manifest', must_exist=False)
+    matrix_dir = os.path.dirname(manifest_filepath)
+    sites_filepath = get_filepath('sites')
+    phenocodes = [pheno['phenocode'] for pheno in get_phenolist()]
+
+    old_manifest: Optional[Dict[str,Any]] = None
+    old_filenames: Set[str] = set()
+    next_file_idx = 0
+    if os.path.exists(manifest_filepath):
+        with open(manifest_filepath) as f:
+            old_manifest = json.load(f)
+        next_file_idx = old_manifest['next_file_idx']
+        old_filenames = set([old_manifest['variants']] + [shard['filename'] for shard in old_manifest['shards']])
+        if old_manifest['phenos_per_shard'] != phenos_per_shard:
+            print('Remaking every shard of the matrix because `matrix_phenos_per_shard` changed.')
+            old_manifest = None
+
+    def is_up_to_date(filename:str, input_filepaths:List[str]) -> bool:
+        filepath = os.path.join(matrix_dir, filename)
+        return os.path.exists(filepath) and all(mtime(input_filepath) <= mtime(filepath) for input_filepath in input_filepaths)
+    def get_input_filepath(phenocode:str) -> str:
+        parsed_filepath = get_pheno_filepath('parsed', phenocode, must_exist=False)
+        return parsed_filepath if os.path.exists(parsed_filepath) else get_pheno_filepath('pheno_gz', phenocode)
+
+    # Keep the shards that are up-to-date, and remake the others with their remaining phenos
+    shards: List[Dict[str,Any]] = [] # like `[{'phenocodes': [...], 'filename': None}]`, where `None` means that it needs to be made.
+    for shard in (old_manifest['shards'] if old_manifest else []):
+        shard_phenocodes = [phenocode for phenocode in shard['phenocodes'] if phenocode in phenocodes]
+        if not shard_phenocodes: continue
+        up_to_date = shard_phenocodes == shard['phenocodes'] and is_up_to_date(shard['filename'], [get_input_filepath(phenocode) for phenocode in shard_phenocodes])
+        shards.append({'phenocodes': shard_phenocodes, 'filename': shard['filename'] if up_to_date else None})
+    # New phenos go into shards that are being remade anyways, and then into new shards
+    phenocodes_in_shards = set(phenocode for shard in shards for phenocode in shard['phenocodes'])
+    new_phenocodes = [phenocode for phenocode in phenocodes if phenocode not in phenocodes_in_shards]
+    for shard in shards:
+        if shard['filename'] is None:
+            num_to_add = max(0, phenos_per_shard - len(shard['phenocodes']))
+            shard['phenocodes'].extend(new_phenocodes[:num_to_add])
+            new_phenocodes = new_phenocodes[num_to_add:]
+    for i in range(0, len(new_phenocodes), phenos_per_shard):
+        shards.append({'phenocodes': new_phenocodes[i:i+phenos_per_shard], 'filename': None})
+    variants_filename = old_manifest['variants'] if old_manifest and is_up_to_date(old_manifest['variants'], [sites_filepath]) else None
+
+    if old_manifest and variants_filename and shards == old_manifest['shards']:
+        print('matrix is up-to-date!')
+        return
+
+    # Files get new names, so that the files in the old manifest stay the same.
+    tasks: List[Dict[str,Any]] = []
+    if variants_filename is None:
+        variants_filename = 'variants-{}.tsv.gz'.format(next_file_idx); next_file_idx += 1
+        tasks.append({'phenocodes': [], 'out_filepath': os.path.join(matrix_dir, variants_filename)})
+    for shard in shards:
+        if shard['filename'] is None:
+            shard_filename = 'phenos-{}.tsv.gz'.format(next_file_idx); next_file_idx += 1
+            shard['filename'] = shard_filename
+            tasks.append({'phenocodes': shard['phenocodes'], 'out_filepath': os.path.join(matrix_dir, shard_filename)})
+    for task in tasks:
+        task['sites_filepath'] = sites_filepath
+        task['pheno_gz_filepaths'] = [get_pheno_filepath('pheno_gz', phenocode) for phenocode in task['phenocodes']]
+
+    num_procs = min(conf.get_num_procs('matrix'), len(tasks))
+    num_threads = 1 if num_procs > 1 else conf.get_num_compression_threads()
+    with ProgressBar() as progressbar, multiprocessing.Pool(num_procs) as pool:
+        num_done = 0
+        for _ in pool.imap_unordered(make_matrix_shard, [dict(task, num_threads=num_threads) for task in tasks]):
+            num_done += 1
+            progressbar.set_message('Made {} of {} files of the matrix in {}'.format(num_done, len(tasks), progressbar.fmt_elapsed()))
+
+    write_json(filepath=manifest_filepath, data={
+        'phenos_per_shard': phenos_per_shard,
+        'next_file_idx': next_file_idx,
+        'variants': variants_filename,
+        'shards': shards,
+    }, indent=1)
+    # Remove files that aren't in the new or old manifest.
+    # A running server still reads the files in the old manifest, so they're kept until the next time the matrix is remade.
+    filenames = set([variants_filename] + [shard['filename'] for shard in shards]) | old_filenames
+    for filename in os.listdir(matrix_dir):
+        if filename == os.path.basename(manifest_filepath) or filename in filenames or (filename.endswith('.tbi') and filename[:-len('.tbi')] in filenames): continue
+        os.remove(os.path.join(matrix_dir, filename))
+
+def make_matrix_shard(task:Dict[str,Any]) -> None:
+    pheno_gz_filepaths = [ffi.new('char[]', filepath.encode('utf8')) for filepath in task['pheno_gz_filepaths']]
+    ret = lib.cffi_make_matrix_shard(task['sites_filepath'].encode('utf8'),
+                                     ffi.new('const char *[]', pheno_gz_filepaths),
+                                     len(pheno_gz_filepaths),
+                                     task['out_filepath'].encode('utf8'),
+                                     task['num_threads'],
+                                     bool(task['phenocodes']))  # without phenos, it's the file of per-variant fields
+    check_cffi_return_value(ret)
@@ -1,11 +1,10 @@
 
 from ..utils import get_phenolist, PheWebError
 from .. import conf
-from ..file_utils import VariantFileWriter, write_json, get_generated_path, get_filepath, get_pheno_filepath
+from ..file_utils import VariantFileWriter, IndexedVariantFileWriter, write_json, get_generated_path, get_filepath, get_pheno_filepath
 from .read_input_file import PhenoReader
 from .load_utils import parallelize_per_pheno, indent, get_phenos_subset
 
-import itertools
 import argparse
 from typing import List,Dict,Any,Iterator
 
@@ -19,7 +18,7 @@ def run(argv:List[str]) -> None:
 
     results_by_phenocode = parallelize_per_pheno(
         get_input_filepaths = lambda pheno: pheno['assoc_files'],
-        get_output_filepaths = lambda pheno: get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False),
+        get_output_filepaths = get_output_filepaths,
         convert = convert,
         cmd = 'parse-input-files',
         phenos = phenos,
@@ -49,15 +48,24 @@ def run(argv:List[str]) -> None:
                 'Information about the phenotypes that failed is in {!r}\n'.format(failed_filepath)
             )
 
+def get_output_filepaths(pheno:Dict[str,Any]) -> List[str]:
+    filepaths = [get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False)]
+    if conf.should_merge_sites_by_chrom():
+        filepaths.append(get_pheno_filepath('parsed_tbi', pheno['phenocode'], must_exist=False))
+    return filepaths
+
 def convert(pheno:Dict[str,Any]) -> Iterator[Dict[str,Any]]:
     # suppress Exceptions so that we can report back on which phenotypes succeeded and which didn't.
     try:
-        with VariantFileWriter(get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False)) as writer:
+        out_filepath = get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False)
+        # `pheweb sites` uses the tabix index to read each chromosome separately.
+        with (IndexedVariantFileWriter(out_filepath, compresslevel=2) if conf.should_merge_sites_by_chrom() else VariantFileWriter(out_filepath)) as writer:
             pheno_reader = PhenoReader(pheno, minimum_maf=conf.get_assoc_min_maf())
-            variants = pheno_reader.get_variants()
+            chunks = pheno_reader.get_variant_chunks()
             debugging_limit_num_variants = conf.get_debugging_limit_num_variants()
-            if debugging_limit_num_variants: variants = itertools.islice(variants, 0, debugging_limit_num_variants)
-            writer.write_all(variants)
+            if debugging_limit_num_variants: chunks = limit_num_variants_in_chunks(chunks, debugging_limit_num_variants)
+            for chunk in chunks:
+                writer.write_columns(chunk)
     except Exception as exc:
         import traceback
         yield {
@@ -70,3 +78,12 @@ def convert(pheno:Dict[str,Any]) -> Iterator[Dict[str,Any]]:
         yield {"succeeded": False, "exception_str": str(exc), "exception_tb": traceback.format_exc()}
     else:
         yield {"succeeded": True}
+
+def limit_num_variants_in_chunks(chunks:Iterator[Dict[str,List[Any]]], num_variants:int) -> Iterator[Dict[str,List[Any]]]:
+    for chunk in chunks:
+        chunk_len = len(chunk['pos'])
+        if chunk_len >= num_variants:
+            yield {field: column[:num_variants] for field, column in chunk.items()}
+            return
+        num_variants -= chunk_len
+        yield chunk
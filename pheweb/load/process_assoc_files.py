@@ -20,9 +20,8 @@ make_cpras_rsids_sqlite3
 augment_phenos
 matrix
 gather_pvalues_for_each_gene
-manhattan
+summarize_phenos
 top_hits
-qq
 phenotypes
 pheno_correlation
 '''.split('\n')
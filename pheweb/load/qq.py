@@ -3,24 +3,23 @@
 This script creates json files which can be used to render QQ plots.
 '''
 
-# TODO: share the `VariantFileReader` with `manhattan.py`.
+# NOTE: `pheweb summarize-phenos` makes these files along with the manhattan files, using `QQFileMaker`.
 # TODO: make gc_lambda for maf strata, and show them if they're >1.1?
 # TODO: copy some changes from <https://github.com/statgen/encore/blob/master/plot-epacts-output/make_qq_json.py>
 
-# TODO: Reduce memory usage by binning the (twosigfigs(maf), rounded(neglogpval,2)) for all variants with neglogpval<2.
-#       If manhattan and qq were computed together, we could re-use some information from the first pass.
+# NOTE: With `qq_streaming = True`, phenos with more than `SKETCH_MIN_NUM_VARIANTS` variants only count their variants with neglogpval<2 in a histogram by (maf, neglogpval), using `QQSketch`.
 
 
 # NOTE: `qval` means `-log10(pvalue)`
 
+from .. import conf
 from ..utils import round_sig, approx_equal, get_phenolist, PheWebError
-from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
-from .load_utils import get_maf, parallelize_per_pheno, get_phenos_subset
+from ..file_utils import write_json, get_pheno_filepath, read_sidecar
+from .load_utils import get_maf, parallelize_per_pheno, get_phenos_subset, scan_variant_file
 
-from typing import Dict,Any,List,Iterator,Set,Tuple
-import argparse, itertools
+from typing import Dict,Any,List,Iterator,Set,Tuple,Optional
+import argparse, itertools, array
 import boltons.mathutils
-import boltons.iterutils
 import math
 import scipy.stats
 import numpy as np
@@ -53,85 +52,151 @@ def make_json_file(pheno:Dict[str,Any]) -> None:
     )
 
 def make_json_file_explicit(in_filepath:str, out_filepath:str, pheno:Dict[str,Any]) -> None:
-    # Store all variants in a dataframe with columns (qval, maf) or just (qval)
-    variants = get_variants_df(in_filepath, pheno)
+    sidecar = read_sidecar(in_filepath)
+    if sidecar is not None:
+        make_json_file_from_sidecar(sidecar, out_filepath, pheno)
+    else:
+        scan_variant_file(in_filepath, [QQFileMaker(out_filepath, pheno)])
+
+def make_json_file_from_sidecar(sidecar:np.ndarray, out_filepath:str, pheno:Dict[str,Any]) -> None:
+    '''Does the same as `QQFileMaker`, but with the columns of a sidecar.'''
+    if len(sidecar) == 0: raise PheWebError("No variants found in the pheno file for {!r}".format(pheno['phenocode']))
+    has_maf = not np.isnan(sidecar['maf'][0])  # like `QQFileMaker`, this depends on the first variant
+    if conf.should_stream_qq() and len(sidecar) > SKETCH_MIN_NUM_VARIANTS:
+        sketch = QQSketch(has_maf)
+        for chunk_start in range(0, len(sidecar), SKETCH_CHUNK_SIZE):
+            chunk = sidecar[chunk_start:chunk_start + SKETCH_CHUNK_SIZE]
+            sketch.add(np.nan_to_num(chunk['maf'], nan=0) if has_maf else None, _get_qvals(chunk['pval']))
+        write_json(filepath=out_filepath, data=make_qq_json_from_sketch(sketch))
+        return
+    variants = np.empty(len(sidecar), dtype=[('maf',np.float32),('qval',np.float32)] if has_maf else [('qval',np.float32)])
+    if has_maf: variants['maf'] = np.nan_to_num(sidecar['maf'], nan=0)
+    variants['qval'] = _get_qvals(sidecar['pval'])
+    write_json(filepath=out_filepath, data=make_qq_json(variants))
+
+def _get_qvals(pvals:np.ndarray) -> np.ndarray:
+    pvals = np.asarray(pvals)
+    with np.errstate(divide='ignore'):
+        return np.where(pvals == 0, 1000, -np.log10(pvals))
+
+class QQFileMaker:
+    '''Makes a QQ json file from the variants of a pheno file, for `scan_variant_file()`.'''
+    # I'm making a dataframe with either the columns [qval maf] or just [qval], depending on whether we can calculate maf from the fields we have.
+    # I use float32 because I have no use for more precision, and I want to 100M variants in <1GB.  (ie, <10bytes/variant)
+    # I'm avoid pandas because it's a little fragile and magic and it was broken on my mac.
+    # Instead, I'm collecting each column in an `array.array` (which has no per-item overhead) and then making a "structured array".
+    # With `qq_streaming = True`, once there are more than `SKETCH_MIN_NUM_VARIANTS` variants, the arrays are emptied into a `QQSketch` every `SKETCH_CHUNK_SIZE` variants.
+    def __init__(self, out_filepath:str, pheno:Dict[str,Any]):
+        self._out_filepath = out_filepath
+        self._pheno = pheno
+        self._has_maf: Optional[bool] = None  # depends on the first variant
+        self._mafs = array.array('f')
+        self._qvals = array.array('f')
+        self._should_stream = conf.should_stream_qq()
+        self._sketch: Optional[QQSketch] = None
+    def process_variant(self, v:Dict[str,Any]) -> None:
+        maf = get_maf(v, self._pheno)
+        if self._has_maf is None: self._has_maf = maf is not None
+        if self._has_maf: self._mafs.append(maf or 0)
+        self._qvals.append(1000 if v['pval']==0 else -math.log10(v['pval']))
+        if self._should_stream and len(self._qvals) >= (SKETCH_CHUNK_SIZE if self._sketch is not None else SKETCH_MIN_NUM_VARIANTS + 1): self._add_to_sketch()
+    def _add_to_sketch(self) -> None:
+        if self._sketch is None: self._sketch = QQSketch(bool(self._has_maf))
+        self._sketch.add(np.frombuffer(self._mafs, dtype=np.float32) if self._has_maf else None, np.frombuffer(self._qvals, dtype=np.float32))
+        self._mafs = array.array('f')
+        self._qvals = array.array('f')
+    def finish(self) -> None:
+        if not self._qvals and self._sketch is None: raise PheWebError("No variants found in the pheno file for {!r}".format(self._pheno['phenocode']))
+        if self._sketch is not None:
+            if self._qvals: self._add_to_sketch()
+            write_json(filepath=self._out_filepath, data=make_qq_json_from_sketch(self._sketch))
+            return
+        if self._has_maf:
+            variants = np.empty(len(self._qvals), dtype=[('maf',np.float32),('qval',np.float32)])
+            variants['maf'] = np.frombuffer(self._mafs, dtype=np.float32)
+        else:
+            variants = np.empty(len(self._qvals), dtype=[('qval',np.float32)])
+        variants['qval'] = np.frombuffer(self._qvals, dtype=np.float32)
+        del self._mafs, self._qvals
+        write_json(filepath=self._out_filepath, data=make_qq_json(variants))
+
+def make_qq_json(variants:np.ndarray) -> Dict[str,Any]:
+    # `variants` has the columns (qval, maf) or just (qval)
     rv: Dict[str,Any] = {}
     if 'maf' in variants.dtype.fields:  # type:ignore
         rv['by_maf'] = make_qq_stratified(variants)
-        rv['overall'] = make_qq_unstratified(variants, include_qq=False)  # Must run AFTER `_stratified()`, because it sorts by qval, which could bias the maf_range strata.
+        rv['overall'] = make_qq_unstratified(variants, include_qq=False)
         rv['ci'] = list(get_confidence_intervals(len(variants) / len(rv['by_maf'])))
     else:
         rv['overall'] = make_qq_unstratified(variants, include_qq=True)
         rv['ci'] = list(get_confidence_intervals(len(variants)))
-    write_json(filepath=out_filepath, data=rv)
-
-def get_variants_df(in_filepath:str, pheno:Dict[str,Any]) -> np.ndarray:
-    # I'm making a dataframe with either the columns [qval maf] or just [qval], depending on whether we can calculate maf from the fields we have.
-    # I use float32 because I have no use for more precision, and I want to 100M variants in <1GB.  (ie, <10bytes/variant)
-    # I'm avoid pandas because it's a little fragile and magic and it was broken on my mac.
-    # And anyways pd.DataFrame() allows passing in an iterator, but then it just calls list() on it, so it temporarily uses python's list overhead.
-    # Instead, I'm using np.fromiter() to make a "structured array".
-    with VariantFileReader(in_filepath) as variant_dicts:
-        try: first_variant = next(iter(variant_dicts))
-        except StopIteration: raise PheWebError("No variants found in {}".format(in_filepath))
-    has_maf = get_maf(first_variant, pheno) is not None
-    if has_maf:
-        return np.fromiter(get_maf_qval_pairs(in_filepath, pheno), dtype=[('maf',np.float32),('qval',np.float32)])
-    else:
-        return np.fromiter((qval for maf,qval in get_maf_qval_pairs(in_filepath, pheno)), dtype=[('qval',np.float32)])
-def get_maf_qval_pairs(in_filepath:str, pheno:Dict[str,Any]) -> Iterator[Tuple[float,float]]:
-    with VariantFileReader(in_filepath) as variant_dicts:
-        for v in variant_dicts:
-            maf: float = get_maf(v, pheno) or 0
-            qval: float = 1000 if v['pval']==0 else -math.log10(v['pval'])
-            yield (maf, qval)
+    return rv
 
 
 def make_qq_stratified(variants:np.ndarray) -> List[Dict[str,Any]]:
-    # `variants.sort(order=['maf'])` breaks ties with remaining column 'qval', which biases the qq for the different maf slices.  Unacceptable.
-    # We could fix that by shuffling all the tied rows at maf_range borders.
-    # `sorted_mafs = np.sort(variants['maf'])` would require us to deal with ties.  Inconvenient.
-    # I want the behavior of `pd.sort_values(by='mf', inplace=True, ignore_index=True)` but without requiring pandas.
-    # This is the only way I could find to sort by only one column in numpy, and it's quite inefficient:
-    variants = variants[np.argsort(variants['maf'])]
-
-    def make_strata(idx:int) -> Dict[str,Any]:
-        # Note: slice_indices[1] is the same as slice_indices[0] of the next slice.
-        # But that's not a problem, because range() ignores the last index.
-        slice_indices = (len(variants) * idx//NUM_MAF_RANGES,
-                         len(variants) * (idx+1)//NUM_MAF_RANGES)
-        qvals = variants['qval'][slice_indices[0]:slice_indices[1]].copy()  # Make sure to copy so we don't modify `variants`.
-        qvals *= -1; qvals.sort(); qvals *= -1  # lol, sort descending
-        return {
-            'maf_range': (variants['maf'][slice_indices[0]],
-                          variants['maf'][slice_indices[1]-1]),
+    strata, maf_ranges = get_maf_strata(variants['maf'])
+    rv = []
+    for idx in range(NUM_MAF_RANGES):
+        qvals = variants['qval'][strata == idx]  # This copies, so we don't modify `variants`.
+        qvals[::-1].sort()  # sort descending
+        rv.append({
+            'maf_range': maf_ranges[idx],
             'count': len(qvals),
             'qq': compute_qq(qvals),
-        }
+        })
+    return rv
 
-    return [make_strata(i) for i in range(NUM_MAF_RANGES)]
+def get_maf_strata(mafs:np.ndarray) -> Tuple[np.ndarray, List[Tuple[float,float]]]:
+    '''
+    Returns the stratum of each variant (as uint8) and the maf range of each stratum, in linear time.
+    The strata are the same as slicing the variants into `NUM_MAF_RANGES` equal parts after sorting them by maf,
+    except that the variants tied at a border between two strata are split between them randomly (but reproducibly).
+    (`variants.sort(order=['maf'])` would break those ties by qval, which biases the qq for the different maf slices.)
+    '''
+    # stratum `idx` is `sorted_mafs[cuts[idx]:cuts[idx+1]]`
+    cuts = [len(mafs) * idx // NUM_MAF_RANGES for idx in range(NUM_MAF_RANGES+1)]
+    borders = sorted({cut % len(mafs) for cut in cuts[:-1]} | {(cut - 1) % len(mafs) for cut in cuts[1:]})
+    partitioned_mafs = np.partition(mafs, borders)
+    maf_ranges = [(partitioned_mafs[cuts[idx] % len(mafs)], partitioned_mafs[(cuts[idx+1] - 1) % len(mafs)]) for idx in range(NUM_MAF_RANGES)]
+    del partitioned_mafs
+
+    strata = np.zeros(len(mafs), dtype=np.uint8)
+    for idx in range(1, NUM_MAF_RANGES):
+        strata += mafs >= maf_ranges[idx][0]
+    # Split the ties at each border, by giving each tied variant a random position among the sorted positions of its maf.
+    rng = np.random.default_rng(0)
+    for maf in sorted({maf_ranges[idx][0] for idx in range(1, NUM_MAF_RANGES) if maf_ranges[idx-1][1] == maf_ranges[idx][0]}):
+        tied_idxs = rng.permutation(np.flatnonzero(mafs == maf))
+        sorted_positions = np.count_nonzero(mafs < maf) + np.arange(len(tied_idxs))
+        strata[tied_idxs] = np.searchsorted(cuts[1:-1], sorted_positions, side='right')
+    return strata, maf_ranges
 
 def make_qq_unstratified(variants:np.ndarray, include_qq:bool) -> Dict[str,Any]:
-    variants[::-1].sort(order=['qval'])  # Sort descending.
     qvals = variants['qval']
     rv: Dict[str,Any] = {}
     if include_qq:
+        qvals[::-1].sort()  # Sort descending, in place.  This sorts only the qval column, so it must run AFTER `_stratified()`.
         rv['qq'] = compute_qq(qvals)
     rv['count'] = len(qvals)
-    rv['gc_lambda'] = {}
-    for perc in ['0.5', '0.1', '0.01', '0.001']:
-        gc = gc_value_from_list(qvals, float(perc))
+    rv['gc_lambda'] = get_gc_lambdas(get_qvals_at_quantiles(qvals, [float(perc) for perc in GC_LAMBDA_PERCS]))
+    return rv
+
+GC_LAMBDA_PERCS = ['0.5', '0.1', '0.01', '0.001']
+def get_gc_lambdas(qvals_at_percs:List[float]) -> Dict[str,float]:
+    rv = {}
+    for perc, qval in zip(GC_LAMBDA_PERCS, qvals_at_percs):
+        gc = gc_value(10 ** -qval, float(perc))
         if math.isnan(gc) or abs(gc) == math.inf:
             print('WARNING: got gc_value {!r}'.format(gc))
         else:
-            rv['gc_lambda'][perc] = round_sig(gc, 5)
+            rv[perc] = round_sig(gc, 5)
     return rv
 
 
 def compute_qq(qvals:np.ndarray) -> Dict[str,Any]:
     # qvals must be in decreasing order.
     # Decreasing order (from strongest pvalue to weakest) works well because we it lets us use `(idx+0.5)/len(qvals)` as the expected pvalue.
-    assert all(a >= b for a,b in boltons.iterutils.pairwise_iter(qvals))
+    assert np.all(np.diff(qvals) <= 0)
 
     if len(qvals) == 0 or qvals[0] == 0:
         return {}  # the js detects that the values for each key are undefined
@@ -145,43 +210,251 @@ def compute_qq(qvals:np.ndarray) -> Dict[str,Any]:
     max_obs_qval = boltons.mathutils.clamp(qvals[0],
                                            lower = max_exp_qval,
                                            upper = math.ceil(2*max_exp_qval))
-    if qvals[0] > max_obs_qval:
-        for qval in qvals:
-            if qval <= max_obs_qval:
-                max_obs_qval = qval
-                break
-
-    occupied_bins: Set[Tuple[int,int]] = set()
-    for i, obs_qval in enumerate(qvals):
-        if obs_qval > max_obs_qval: continue
-        exp_qval = -math.log10( (i+0.5) / len(qvals))
-        exp_bin = int(exp_qval / max_exp_qval * NUM_BINS)
+    first_shown_idx = int(np.argmax(qvals <= max_obs_qval)) if qvals[-1] <= max_obs_qval else len(qvals)
+    if qvals[0] > max_obs_qval and first_shown_idx < len(qvals):
+        max_obs_qval = qvals[first_shown_idx]
+
+    # Each bin is packed as `exp_bin * (NUM_BINS+1) + obs_bin`.  Chunks keep the temporary arrays small.
+    occupied_bins = np.array([], dtype=np.int64)
+    for chunk_start in range(first_shown_idx, len(qvals), 2**20):
+        chunk_stop = min(chunk_start + 2**20, len(qvals))
+        exp_bins = _get_exp_bins(np.arange(chunk_start, chunk_stop), len(qvals), max_exp_qval)
         # TODO: it'd be great if the `obs_bin`s started right at the lowest qval in that `exp_bin`.
         #       that way we could have fewer bins but still get a nice straight diagonal line without that stair-stepping appearance.
-        obs_bin = int(obs_qval / max_obs_qval * NUM_BINS)
-        occupied_bins.add( (exp_bin,obs_bin) )
+        obs_bins = (qvals[chunk_start:chunk_stop] / max_obs_qval * NUM_BINS).astype(np.int64)
+        occupied_bins = np.union1d(occupied_bins, exp_bins * (NUM_BINS+1) + obs_bins)
+
+    return {
+        'bins': _get_bins(occupied_bins, max_exp_qval, max_obs_qval),
+        'max_exp_qval': max_exp_qval,
+    }
 
+def _get_bins(occupied_bins:np.ndarray, max_exp_qval:float, max_obs_qval:float) -> List[Tuple[float,float]]:
     bins = []
-    for exp_bin, obs_bin in occupied_bins:
+    for exp_bin, obs_bin in zip(*np.divmod(occupied_bins, NUM_BINS+1)):
         assert 0 <= exp_bin <= NUM_BINS, exp_bin
         assert 0 <= obs_bin <= NUM_BINS, obs_bin
         bins.append((
-            exp_bin / NUM_BINS * max_exp_qval,
-            obs_bin / NUM_BINS * max_obs_qval
+            int(exp_bin) / NUM_BINS * max_exp_qval,
+            int(obs_bin) / NUM_BINS * max_obs_qval
         ))
     bins.sort()
+    return bins
+
+def _get_exp_bins(idxs:np.ndarray, num_qvals:int, max_exp_qval:float) -> np.ndarray:
+    # `int(-math.log10((idx+0.5) / num_qvals) / max_exp_qval * NUM_BINS)` for each idx.
+    # `np.log10()` sometimes differs from `math.log10()` in the last bit, so use `math.log10()` where that could change the bin.
+    exp_bins = -np.log10((idxs + 0.5) / num_qvals) / max_exp_qval * NUM_BINS
+    for i in np.flatnonzero(np.abs(exp_bins - np.round(exp_bins)) < 1e-6).tolist():
+        exp_bins[i] = -math.log10((int(idxs[i])+0.5) / num_qvals) / max_exp_qval * NUM_BINS
+    return exp_bins.astype(np.int64)
+
+
+# With `qq_streaming = True`, each pheno's variants are summarized in a `QQSketch` instead of being kept in memory.
+SKETCH_TAIL_QVAL = 2  # qvals above this are kept exactly
+SKETCH_QVAL_RESOLUTION = 0.001
+SKETCH_MAF_RESOLUTION = 0.001
+SKETCH_CHUNK_SIZE = 2**16
+SKETCH_MIN_NUM_VARIANTS = 2**20  # smaller phenos are kept exactly, in no more memory than the histogram
+
+class QQSketch:
+    '''
+    Summarizes the (maf, qval) of a pheno's variants in memory that doesn't grow with the number of weak variants.
+    Qvals above `SKETCH_TAIL_QVAL` are kept exactly (with their mafs), and the rest are counted in a histogram by (maf, qval).
+    The QQ made from a sketch has the same counts and confidence intervals as `make_qq_json()`,
+    but its maf strata borders, bins, and gc_lambdas are only as precise as the histogram (see `SKETCH_GC_LAMBDA_TOLERANCE`).
+    '''
+    def __init__(self, has_maf:bool):
+        self.has_maf = has_maf
+        self.num_variants = 0
+        num_maf_bins = round(0.5 / SKETCH_MAF_RESOLUTION) + 1 if has_maf else 1
+        self._num_qval_bins = round(SKETCH_TAIL_QVAL / SKETCH_QVAL_RESOLUTION) + 1
+        self._counts = np.zeros((num_maf_bins, self._num_qval_bins), dtype=np.int64)  # 8MB
+        self._min_mafs = np.full(num_maf_bins, np.inf, dtype=np.float32)
+        self._max_mafs = np.full(num_maf_bins, -np.inf, dtype=np.float32)
+        self._tail_mafs: List[np.ndarray] = []
+        self._tail_qvals: List[np.ndarray] = []
+
+    def add(self, mafs:Optional[np.ndarray], qvals:np.ndarray) -> None:
+        self.num_variants += len(qvals)
+        if self.has_maf:
+            assert mafs is not None
+            mafs = np.asarray(mafs, dtype=np.float32)
+            maf_bins = np.clip(mafs / SKETCH_MAF_RESOLUTION, 0, len(self._min_mafs) - 1).astype(np.int64)
+            np.minimum.at(self._min_mafs, maf_bins, mafs)
+            np.maximum.at(self._max_mafs, maf_bins, mafs)
+        else:
+            mafs = np.zeros(len(qvals), dtype=np.float32)
+            maf_bins = np.zeros(len(qvals), dtype=np.int64)
+        qvals = np.asarray(qvals, dtype=np.float32)
+        is_tail = qvals > SKETCH_TAIL_QVAL
+        self._tail_mafs.append(mafs[is_tail])
+        self._tail_qvals.append(qvals[is_tail])
+        qval_bins = np.clip(qvals[~is_tail] / SKETCH_QVAL_RESOLUTION, 0, self._num_qval_bins - 1).astype(np.int64)
+        keys, counts = np.unique(maf_bins[~is_tail] * self._num_qval_bins + qval_bins, return_counts=True)
+        self._counts.reshape(-1)[keys] += counts
+
+    def get_overall(self) -> Tuple[np.ndarray, np.ndarray]:
+        '''Returns (the count in each qval bin, the tail qvals) for all variants.'''
+        return self._counts.sum(axis=0), np.concatenate(self._tail_qvals)
+
+    def get_maf_strata(self) -> List[Tuple[np.ndarray, np.ndarray, Tuple[float,float]]]:
+        '''
+        Returns (the count in each qval bin, the tail qvals, the maf range) for each of `NUM_MAF_RANGES` strata.
+        Like `get_maf_strata()`, except for the maf bins at the borders between strata.
+        The tail variants in those bins are split by maf, in proportion to the sizes of the strata in the bin, but the others are split randomly (but reproducibly).
+        The maf range of a stratum goes from the smallest maf in its first maf bin to the largest maf in its last maf bin,
+        so strata that share a border bin have overlapping maf ranges.
+        '''
+        rng = np.random.default_rng(0)
+        tail_mafs = np.concatenate(self._tail_mafs)
+        tail_qvals = np.concatenate(self._tail_qvals)
+        tail_maf_bins = np.clip(tail_mafs / SKETCH_MAF_RESOLUTION, 0, len(self._counts) - 1).astype(np.int64) if self.has_maf else np.zeros(len(tail_mafs), dtype=np.int64)
+        order = np.lexsort((rng.random(len(tail_mafs)), tail_mafs))  # by maf, with ties in random order
+        tail_qvals = tail_qvals[order]
+        tail_bin_starts = np.searchsorted(tail_maf_bins[order], np.arange(len(self._counts) + 1))
+        bin_counts = self._counts.sum(axis=1) + np.diff(tail_bin_starts)
+        bin_stops = np.cumsum(bin_counts)
+
+        # stratum `idx` is `sorted_variants[cuts[idx]:cuts[idx+1]]`
+        cuts = [self.num_variants * idx // NUM_MAF_RANGES for idx in range(NUM_MAF_RANGES+1)]
+        strata_counts = [np.zeros(self._num_qval_bins, dtype=np.int64) for _ in range(NUM_MAF_RANGES)]
+        strata_tail_qvals: List[List[np.ndarray]] = [[] for _ in range(NUM_MAF_RANGES)]
+        strata_mafs: List[List[float]] = [[] for _ in range(NUM_MAF_RANGES)]
+        for maf_bin in np.flatnonzero(bin_counts).tolist():
+            start, stop = int(bin_stops[maf_bin] - bin_counts[maf_bin]), int(bin_stops[maf_bin])
+            bin_tail_qvals = tail_qvals[tail_bin_starts[maf_bin]:tail_bin_starts[maf_bin+1]]
+            remaining_counts = self._counts[maf_bin]
+            for idx in range(NUM_MAF_RANGES):
+                lo, hi = max(start, cuts[idx]) - start, min(stop, cuts[idx+1]) - start  # the positions of this stratum within the bin
+                if lo >= hi: continue
+                tail_lo, tail_hi = len(bin_tail_qvals) * lo // (stop - start), len(bin_tail_qvals) * hi // (stop - start)
+                num_counted = (hi - lo) - (tail_hi - tail_lo)
+                counts = remaining_counts if num_counted == remaining_counts.sum() else rng.multivariate_hypergeometric(remaining_counts, num_counted)
+                strata_counts[idx] += counts
+                strata_tail_qvals[idx].append(bin_tail_qvals[tail_lo:tail_hi])
+                strata_mafs[idx].extend([self._min_mafs[maf_bin], self._max_mafs[maf_bin]])
+                remaining_counts = remaining_counts - counts
+        return [(strata_counts[idx],
+                 np.concatenate(strata_tail_qvals[idx]) if strata_tail_qvals[idx] else np.array([], dtype=np.float32),
+                 (min(strata_mafs[idx]), max(strata_mafs[idx])) if strata_mafs[idx] else (np.nan, np.nan))
+                for idx in range(NUM_MAF_RANGES)]
+
+def make_qq_json_from_sketch(sketch:QQSketch) -> Dict[str,Any]:
+    '''Like `make_qq_json()`, but from a `QQSketch`.'''
+    rv: Dict[str,Any] = {}
+    if sketch.has_maf:
+        rv['by_maf'] = [{
+            'maf_range': maf_range,
+            'count': int(qval_counts.sum()) + len(tail_qvals),
+            'qq': compute_qq_from_sketch(qval_counts, tail_qvals),
+        } for qval_counts, tail_qvals, maf_range in sketch.get_maf_strata()]
+        rv['overall'] = make_qq_unstratified_from_sketch(sketch, include_qq=False)
+        rv['ci'] = list(get_confidence_intervals(sketch.num_variants / len(rv['by_maf'])))
+    else:
+        rv['overall'] = make_qq_unstratified_from_sketch(sketch, include_qq=True)
+        rv['ci'] = list(get_confidence_intervals(sketch.num_variants))
+    return rv
+
+def make_qq_unstratified_from_sketch(sketch:QQSketch, include_qq:bool) -> Dict[str,Any]:
+    qval_counts, tail_qvals = sketch.get_overall()
+    rv: Dict[str,Any] = {}
+    if include_qq:
+        rv['qq'] = compute_qq_from_sketch(qval_counts, tail_qvals)
+    rv['count'] = sketch.num_variants
+    rv['gc_lambda'] = get_gc_lambdas(get_qvals_at_quantiles_from_sketch(qval_counts, tail_qvals, [float(perc) for perc in GC_LAMBDA_PERCS]))
+    return rv
+
+def compute_qq_from_sketch(qval_counts:np.ndarray, tail_qvals:np.ndarray) -> Dict[str,Any]:
+    '''Like `compute_qq()`, but treats the qvals in each histogram bin as if they were evenly spaced across it.'''
+    # Each run is either one tail qval or one histogram bin, in decreasing order.  A histogram bin's run starts at the top of the bin.
+    qval_bins = np.flatnonzero(qval_counts)[::-1]
+    run_qvals = np.concatenate([np.sort(tail_qvals)[::-1], np.minimum((qval_bins + 1) * SKETCH_QVAL_RESOLUTION, SKETCH_TAIL_QVAL).astype(np.float32)])
+    run_counts = np.concatenate([np.ones(len(tail_qvals), dtype=np.int64), qval_counts[qval_bins]])
+    run_starts = np.cumsum(run_counts) - run_counts
+    num_qvals = int(run_counts.sum())
+
+    if num_qvals == 0:
+        return {}
+
+    max_exp_qval = -math.log10(0.5 / num_qvals)
+    max_obs_qval = boltons.mathutils.clamp(run_qvals[0],
+                                           lower = max_exp_qval,
+                                           upper = math.ceil(2*max_exp_qval))
+    first_shown_run = int(np.argmax(run_qvals <= max_obs_qval)) if run_qvals[-1] <= max_obs_qval else len(run_qvals)
+    if run_qvals[0] > max_obs_qval and first_shown_run < len(run_qvals):
+        max_obs_qval = run_qvals[first_shown_run]
+
+    occupied_bins = [np.array([], dtype=np.int64)]
+    shown_tail = np.arange(first_shown_run, len(tail_qvals))
+    if len(shown_tail):
+        exp_bins = _get_exp_bins(run_starts[shown_tail], num_qvals, max_exp_qval)
+        obs_bins = (run_qvals[shown_tail] / max_obs_qval * NUM_BINS).astype(np.int64)
+        occupied_bins.append(exp_bins * (NUM_BINS+1) + obs_bins)
+    for run in range(max(first_shown_run, len(tail_qvals)), len(run_qvals)):
+        # The `idx_in_run`th qval is `top - (idx_in_run + 0.5) / count * SKETCH_QVAL_RESOLUTION`, so find where those cross from one `obs_bin` to the next.
+        top, count = float(run_qvals[run]), int(run_counts[run])
+        def get_num_qvals_at_least(qval:float) -> int:
+            return min(count, max(0, math.floor((top - qval) / SKETCH_QVAL_RESOLUTION * count - 0.5) + 1))
+        for obs_bin in range(int((top - SKETCH_QVAL_RESOLUTION) / max_obs_qval * NUM_BINS), int(top / max_obs_qval * NUM_BINS) + 1):
+            start = int(run_starts[run]) + get_num_qvals_at_least((obs_bin + 1) / NUM_BINS * max_obs_qval)
+            stop = int(run_starts[run]) + get_num_qvals_at_least(obs_bin / NUM_BINS * max_obs_qval)
+            if start < stop:
+                occupied_bins.append(_get_exp_bins_between(start, stop, num_qvals, max_exp_qval) * (NUM_BINS+1) + min(obs_bin, NUM_BINS))
     return {
-        'bins': bins,
+        'bins': _get_bins(np.unique(np.concatenate(occupied_bins)), max_exp_qval, max_obs_qval),
         'max_exp_qval': max_exp_qval,
     }
 
+def _get_exp_bins_between(start:int, stop:int, num_qvals:int, max_exp_qval:float) -> np.ndarray:
+    # Returns the `exp_bin`s of `range(start, stop)`.
+    # After idx 1000, consecutive idxs are never more than one `exp_bin` apart, so every `exp_bin` between the ends is used.
+    exp_bins = _get_exp_bins(np.arange(start, min(stop, max(start, 1000))), num_qvals, max_exp_qval)
+    if stop > max(start, 1000):
+        last_exp_bin, first_exp_bin = _get_exp_bins(np.array([stop-1, max(start, 1000)]), num_qvals, max_exp_qval)
+        exp_bins = np.concatenate([exp_bins, np.arange(last_exp_bin, first_exp_bin+1)])
+    return exp_bins
+
+def get_qvals_at_quantiles_from_sketch(qval_counts:np.ndarray, tail_qvals:np.ndarray, quantiles:List[float]) -> List[float]:
+    '''Like `get_qvals_at_quantiles()`, but interpolates linearly within a histogram bin.'''
+    tail_qvals = np.sort(tail_qvals)[::-1]
+    desc_counts = qval_counts[::-1]
+    desc_stops = np.cumsum(desc_counts)
+    num_qvals = len(tail_qvals) + int(desc_stops[-1])
+    rv = []
+    for quantile in quantiles:
+        idx = int(num_qvals * quantile)
+        if idx < len(tail_qvals):
+            rv.append(tail_qvals[idx])
+        else:
+            desc_idx = int(np.searchsorted(desc_stops, idx - len(tail_qvals), side='right'))
+            idx_in_bin = idx - len(tail_qvals) - (desc_stops[desc_idx] - desc_counts[desc_idx])
+            qval_bin = len(qval_counts) - 1 - desc_idx
+            rv.append(min((qval_bin + 1 - (idx_in_bin + 0.5) / desc_counts[desc_idx]) * SKETCH_QVAL_RESOLUTION, SKETCH_TAIL_QVAL))
+    return rv
 
-def gc_value_from_list(qvals:List[float], quantile:float = 0.5) -> float:
-    # qvals must be in decreasing order.
-    assert all(a >= b for a,b in boltons.iterutils.pairwise_iter(qvals))
-    qval = qvals[int(len(qvals) * quantile)]
+# A qval from the histogram is in the same bin as the exact qval, so it's off by less than `SKETCH_QVAL_RESOLUTION`.
+# That's enough to change gc_lambdas between 0.8 and 2 by up to 0.7% (mostly for the median, where the density of qvals is lowest),
+# though with many variants per bin, interpolating within the bin is usually much closer.
+SKETCH_GC_LAMBDA_TOLERANCE = 0.007
+def _check_sketch_gc_lambda_tolerance() -> None:
+    for perc in GC_LAMBDA_PERCS:
+        for gc in [0.8, 1, 1.25, 2]:
+            qval = -math.log10(scipy.stats.chi2.sf(gc * scipy.stats.chi2.isf(float(perc), 1), 1))
+            if qval + SKETCH_QVAL_RESOLUTION > SKETCH_TAIL_QVAL: continue  # tail qvals are exact
+            for off_by in [-SKETCH_QVAL_RESOLUTION, SKETCH_QVAL_RESOLUTION]:
+                assert abs(gc_value(10 ** -(qval + off_by), float(perc)) / gc - 1) < SKETCH_GC_LAMBDA_TOLERANCE, (perc, gc, off_by)
+
+
+def gc_value_from_list(qvals:np.ndarray, quantile:float = 0.5) -> float:
+    qval = get_qvals_at_quantiles(qvals, [quantile])[0]
     pval = 10 ** -qval
     return gc_value(pval, quantile)
+def get_qvals_at_quantiles(qvals:np.ndarray, quantiles:List[float]) -> List[float]:
+    # Returns `sorted(qvals, reverse=True)[int(len(qvals) * quantile)]` for each quantile, but partitions instead of sorting.
+    kths = [len(qvals) - 1 - int(len(qvals) * quantile) for quantile in quantiles]
+    partitioned_qvals = np.partition(qvals, kths)
+    return [partitioned_qvals[kth] for kth in kths]
 def gc_value(pval:float, quantile:float = 0.5) -> float:
     # This should be equivalent to this R: `qchisq(median_pval, df=1, lower.tail=F) / qchisq(quantile, df=1, lower.tail=F)`
     return scipy.stats.chi2.ppf(1 - pval, 1) / scipy.stats.chi2.ppf(1 - quantile, 1)
@@ -189,6 +462,7 @@ assert approx_equal(gc_value(0.49), 1.047457) # I computed these using that R co
 assert approx_equal(gc_value(0.5), 1)
 assert approx_equal(gc_value(0.50001), 0.9999533)
 assert approx_equal(gc_value(0.6123), 0.5645607)
+_check_sketch_gc_lambda_tolerance()
 
 
 
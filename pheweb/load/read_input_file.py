@@ -1,5 +1,5 @@
 
-from ..utils import chrom_order, chrom_order_list, chrom_aliases, PheWebError
+from ..utils import chrom_order, chrom_order_list, chrom_aliases, round_sig_array, get_chrom_pos_key, get_chrom_idx_of_key, get_pos_of_key, get_first_unsorted_idx, PheWebError
 from .. import parse_utils
 from .. import conf
 from ..file_utils import read_maybe_gzip
@@ -8,6 +8,10 @@ from .load_utils import get_maf
 import itertools
 import re
 import boltons.iterutils
+import numpy as np
+
+
+CHUNK_NUM_LINES = 50_000 # number of lines that `get_variant_chunks()` parses at once
 
 
 class PhenoReader:
@@ -27,6 +31,17 @@ class PhenoReader:
             itertools.chain.from_iterable(
                 AssocFileReader(filepath, self._pheno).get_variants(minimum_maf=self._minimum_maf) for filepath in self.filepaths))
 
+    def get_variant_chunks(self, num_lines=CHUNK_NUM_LINES):
+        '''
+        Like `get_variants()`, but yields chunks like `{'chrom': ['1', ...], 'pos': [869334, ...], ...}` (one list per field).
+        Each chunk is parsed column-by-column with numpy, which is much faster than parsing one variant at a time.
+        The values are the same as `get_variants()` would produce, so `VariantFileWriter.write_columns()` writes identical files.
+        '''
+        chunks = itertools.chain.from_iterable(
+            AssocFileReader(filepath, self._pheno).get_variant_chunks(minimum_maf=self._minimum_maf, num_lines=num_lines) for filepath in self.filepaths)
+        for chunk in self._order_chunks_refalt_lexicographically(chunks):
+            yield {field: _column_to_list(field, column) for field, column in chunk.items()}
+
     def get_info(self):
         infos = [AssocFileReader(filepath, self._pheno).get_info() for filepath in self.filepaths]
         for info in infos[1:]:
@@ -41,24 +56,81 @@ class PhenoReader:
     def _order_refalt_lexicographically(self, variants):
         # Also assert that chrom and pos are in order
         cp_groups = itertools.groupby(variants, key=lambda v:(v['chrom'], v['pos']))
-        prev_chrom_index, prev_pos = -1, -1
+        prev_key = -1
         for cp, tied_variants in cp_groups:
-            chrom_index = self._get_chrom_index(cp[0])
-            if chrom_index < prev_chrom_index:
-                raise PheWebError(
-                    "The chromosomes in your file appear to be in the wrong order.\n" +
-                    "The required order is: {!r}\n".format(chrom_order_list) +
-                    "But in your file, the chromosome {!r} came after the chromosome {!r}\n".format(
-                        cp[0], chrom_order_list[prev_chrom_index]))
-            if chrom_index == prev_chrom_index and cp[1] < prev_pos:
-                raise PheWebError(
-                    "The positions in your file appear to be in the wrong order.\n" +
-                    "In your file, the position {!r} came after the position {!r} on chromsome {!r}\n".format(
-                        cp[1], prev_pos, cp[0]))
-            prev_chrom_index, prev_pos = chrom_index, cp[1]
+            key = self._get_chrom_pos_key(*cp)
+            if key < prev_key:
+                self._raise_order_error(cp[0], cp[1], prev_key)
+            prev_key = key
             for v in sorted(tied_variants, key=lambda v:(v['ref'], v['alt'])):
                 yield v
 
+    def _order_chunks_refalt_lexicographically(self, chunks):
+        # Same as `_order_refalt_lexicographically()`, but for chunks of columns.
+        # The last chrom-pos of each chunk is held back and prepended to the next chunk, because its variants might continue there.
+        prev_key = -1
+        held_chunk = None
+        for chunk in chunks:
+            if held_chunk is not None: chunk = _concat_chunks(held_chunk, chunk)
+            held_chunk = None
+            num_variants = len(chunk['pos'])
+            if num_variants == 0: continue
+            keys = self._get_chrom_pos_keys(chunk['chrom'], chunk['pos'])
+            self._check_chunk_order(chunk, keys, prev_key)
+
+            starts_group = np.ones(num_variants, dtype=bool)
+            starts_group[1:] = keys[1:] != keys[:-1]
+            group_starts = np.flatnonzero(starts_group)
+            last_group_start = group_starts[-1]
+            held_chunk = _slice_chunk(chunk, last_group_start, num_variants)
+            if last_group_start == 0: continue
+            prev_key = keys[last_group_start-1]
+            yield self._sort_tied_variants(_slice_chunk(chunk, 0, last_group_start), group_starts[:-1], last_group_start)
+        if held_chunk is not None:
+            yield self._sort_tied_variants(held_chunk, np.array([0]), len(held_chunk['pos']))
+
+    def _check_chunk_order(self, chunk, keys, prev_key):
+        # Raise the same error that `_order_refalt_lexicographically()` would raise first.
+        unknown_chrom_idxs = np.flatnonzero(keys < 0)
+        num_known = unknown_chrom_idxs[0] if len(unknown_chrom_idxs) else len(keys)
+        idx = get_first_unsorted_idx(keys[:num_known], prev_key)
+        if idx is not None:
+            self._raise_order_error(chunk['chrom'][idx], int(chunk['pos'][idx]), prev_key if idx == 0 else int(keys[idx-1]))
+        if len(unknown_chrom_idxs):
+            self._get_chrom_index(chunk['chrom'][unknown_chrom_idxs[0]])
+
+    @staticmethod
+    def _raise_order_error(chrom, pos, prev_key):
+        prev_chrom_index = get_chrom_idx_of_key(prev_key)
+        if chrom_order[chrom] < prev_chrom_index:
+            raise PheWebError(
+                "The chromosomes in your file appear to be in the wrong order.\n" +
+                "The required order is: {!r}\n".format(chrom_order_list) +
+                "But in your file, the chromosome {!r} came after the chromosome {!r}\n".format(
+                    chrom, chrom_order_list[prev_chrom_index]))
+        raise PheWebError(
+            "The positions in your file appear to be in the wrong order.\n" +
+            "In your file, the position {!r} came after the position {!r} on chromsome {!r}\n".format(
+                pos, get_pos_of_key(prev_key), chrom))
+
+    @staticmethod
+    def _sort_tied_variants(chunk, group_starts, num_variants):
+        # Variants with the same chrom-pos are sorted by ref-alt.  Those are rare, so just use python.
+        group_lengths = np.diff(np.append(group_starts, num_variants))
+        if (group_lengths == 1).all(): return chunk
+        order = np.arange(num_variants)
+        refs, alts = chunk['ref'], chunk['alt']
+        for start, length in zip(group_starts[group_lengths > 1], group_lengths[group_lengths > 1]):
+            order[start:start+length] = sorted(range(start, start+length), key=lambda i:(refs[i], alts[i]))
+        return {field: column[order] for field, column in chunk.items()}
+
+    @staticmethod
+    def _get_chrom_pos_keys(chroms, positions):
+        # Like `get_chrom_pos_keys()`, but variants on unknown chromosomes get -1
+        index_for_chrom = {chrom: chrom_order.get(chrom, -1) for chrom in set(chroms)}
+        chrom_indexes = np.fromiter(map(index_for_chrom.__getitem__, chroms), dtype=np.int64, count=len(chroms))
+        return np.where(chrom_indexes < 0, -1, (chrom_indexes << 32) | positions)
+
     def _get_fields_and_filepaths(self, filepaths):
         # also sets `self._fields`
         assoc_files = [{'filepath': filepath} for filepath in filepaths]
@@ -76,7 +148,11 @@ class PhenoReader:
 
     @staticmethod
     def _variant_chrpos_order_key(v):
-        return (PhenoReader._get_chrom_index(v['chrom']), v['pos'])
+        return PhenoReader._get_chrom_pos_key(v['chrom'], v['pos'])
+    @staticmethod
+    def _get_chrom_pos_key(chrom, pos):
+        PhenoReader._get_chrom_index(chrom) # raises a helpful error for unknown chromosomes
+        return get_chrom_pos_key(chrom, pos)
     @staticmethod
     def _get_chrom_index(chrom):
         try:
@@ -99,62 +175,115 @@ class AssocFileReader:
 
 
     def get_variants(self, minimum_maf=0, use_per_pheno_fields=False):
-        if use_per_pheno_fields:
-            fieldnames_to_check = [fieldname for fieldname,fieldval in parse_utils.per_pheno_fields.items() if fieldval['from_assoc_files']]
-        else:
-            fieldnames_to_check = [fieldname for fieldname,fieldval in itertools.chain(parse_utils.per_variant_fields.items(), parse_utils.per_assoc_fields.items()) if fieldval['from_assoc_files']]
+        fieldnames_to_check = self._get_fieldnames_to_check(use_per_pheno_fields)
 
         with read_maybe_gzip(self.filepath) as f:
-
-            try:
-                header_line = next(f)
-            except Exception as exc:
-                raise PheWebError("Failed to read from file {} - is it empty?".format(self.filepath)) from exc
-
-            if header_line.count('\t') >= 4: delimiter = '\t'
-            elif header_line.count(' ') >= 4: delimiter = ' '
-            elif header_line.count(',') >= 4: delimiter = ','
-            else: raise PheWebError("Cannot guess what delimiter to use to parse the header line {!r} in file {!r}".format(header_line, self.filepath))
-
-            colnames = [colname.strip('"\' ').lower() for colname in header_line.rstrip('\n\r').split(delimiter)]
-            colidx_for_field = self._parse_header(colnames, fieldnames_to_check)
-            # Special case for `MARKER_ID`
-            if 'marker_id' not in colnames:
-                marker_id_col = None
-            else:
-                marker_id_col = colnames.index('marker_id')
-                colidx_for_field['ref'] = None # This is just to mark that we have 'ref', but it doesn't come from a column.
-                colidx_for_field['alt'] = None
-                # TODO: this sort of provides a mapping for chrom and pos, but those are usually doubled anyways.
-                # TODO: maybe we should allow multiple columns to map to each key, and then just assert that they all agree.
-            self._assert_all_fields_mapped(colnames, fieldnames_to_check, colidx_for_field)
+            delimiter, colnames, colidx_for_field, marker_id_col = self._read_header(f, fieldnames_to_check)
+            rows = (line.rstrip('\n\r').split(delimiter) for line in f)
 
             if use_per_pheno_fields:
-                for line in f:
-                    values = line.rstrip('\n\r').split(delimiter)
+                for values in rows:
                     variant = self._parse_variant(values, colnames, colidx_for_field)
                     yield variant
 
             else:
-                for line in f:
-                    values = line.rstrip('\n\r').split(delimiter)
-                    variant = self._parse_variant(values, colnames, colidx_for_field)
-
-                    if variant['pval'] == '': continue
+                yield from self._parse_and_filter_rows(rows, colnames, colidx_for_field, marker_id_col, minimum_maf)
 
-                    maf = get_maf(variant, self._pheno) # checks for agreement
-                    if maf is not None and maf < minimum_maf:
-                        continue
+    def get_variant_chunks(self, minimum_maf=0, num_lines=CHUNK_NUM_LINES):
+        '''
+        Like `get_variants()`, but parses `num_lines` lines at a time into columns like `{'pval': np.array([0.3, ...]), ...}`.
+        Nulls are NaN.  Strings are in object arrays.
+        If anything in a chunk fails to parse, the chunk is re-parsed one variant at a time so that the error matches `get_variants()`.
+        '''
+        fieldnames_to_check = self._get_fieldnames_to_check(use_per_pheno_fields=False)
 
-                    if marker_id_col is not None:
-                        chrom2, pos2, variant['ref'], variant['alt'] = AssocFileReader.parse_marker_id(values[marker_id_col])
-                        assert variant['chrom'] == chrom2, (values, variant, chrom2)
-                        assert variant['pos'] == pos2, (values, variant, pos2)
+        with read_maybe_gzip(self.filepath) as f:
+            delimiter, colnames, colidx_for_field, marker_id_col = self._read_header(f, fieldnames_to_check)
+            fields = list(colidx_for_field)
+            while True:
+                lines = list(itertools.islice(f, num_lines))
+                if not lines: break
+                rows = [line.rstrip('\n\r').split(delimiter) for line in lines]
+                try:
+                    chunk = self._parse_and_filter_chunk(rows, colnames, colidx_for_field, marker_id_col, minimum_maf)
+                except Exception:
+                    variants = list(self._parse_and_filter_rows(rows, colnames, colidx_for_field, marker_id_col, minimum_maf))
+                    chunk = _chunk_from_variants(variants, fields)
+                yield chunk
 
-                    if variant['chrom'] in chrom_aliases:
-                        variant['chrom'] = chrom_aliases[variant['chrom']]
+    def _get_fieldnames_to_check(self, use_per_pheno_fields):
+        if use_per_pheno_fields:
+            return [fieldname for fieldname,fieldval in parse_utils.per_pheno_fields.items() if fieldval['from_assoc_files']]
+        else:
+            return [fieldname for fieldname,fieldval in itertools.chain(parse_utils.per_variant_fields.items(), parse_utils.per_assoc_fields.items()) if fieldval['from_assoc_files']]
 
-                    yield variant
+    def _read_header(self, f, fieldnames_to_check):
+        try:
+            header_line = next(f)
+        except Exception as exc:
+            raise PheWebError("Failed to read from file {} - is it empty?".format(self.filepath)) from exc
+
+        if header_line.count('\t') >= 4: delimiter = '\t'
+        elif header_line.count(' ') >= 4: delimiter = ' '
+        elif header_line.count(',') >= 4: delimiter = ','
+        else: raise PheWebError("Cannot guess what delimiter to use to parse the header line {!r} in file {!r}".format(header_line, self.filepath))
+
+        colnames = [colname.strip('"\' ').lower() for colname in header_line.rstrip('\n\r').split(delimiter)]
+        colidx_for_field = self._parse_header(colnames, fieldnames_to_check)
+        # Special case for `MARKER_ID`
+        if 'marker_id' not in colnames:
+            marker_id_col = None
+        else:
+            marker_id_col = colnames.index('marker_id')
+            colidx_for_field['ref'] = None # This is just to mark that we have 'ref', but it doesn't come from a column.
+            colidx_for_field['alt'] = None
+            # TODO: this sort of provides a mapping for chrom and pos, but those are usually doubled anyways.
+            # TODO: maybe we should allow multiple columns to map to each key, and then just assert that they all agree.
+        self._assert_all_fields_mapped(colnames, fieldnames_to_check, colidx_for_field)
+        return delimiter, colnames, colidx_for_field, marker_id_col
+
+    def _parse_and_filter_rows(self, rows, colnames, colidx_for_field, marker_id_col, minimum_maf):
+        for values in rows:
+            variant = self._parse_variant(values, colnames, colidx_for_field)
+
+            if variant['pval'] == '': continue
+
+            maf = get_maf(variant, self._pheno) # checks for agreement
+            if maf is not None and maf < minimum_maf:
+                continue
+
+            if marker_id_col is not None:
+                chrom2, pos2, variant['ref'], variant['alt'] = AssocFileReader.parse_marker_id(values[marker_id_col])
+                assert variant['chrom'] == chrom2, (values, variant, chrom2)
+                assert variant['pos'] == pos2, (values, variant, pos2)
+
+            if variant['chrom'] in chrom_aliases:
+                variant['chrom'] = chrom_aliases[variant['chrom']]
+
+            yield variant
+
+    def _parse_and_filter_chunk(self, rows, colnames, colidx_for_field, marker_id_col, minimum_maf):
+        # Does the same thing as `_parse_and_filter_rows()`, but one column at a time.
+        if any(len(values) != len(colnames) for values in rows): raise PheWebError('wrong number of values')
+        columns = list(zip(*rows))
+        chunk = {field: parse_utils.array_parser_for_field[field](columns[colidx])[0] for field, colidx in colidx_for_field.items() if colidx is not None}
+
+        keep = ~np.isnan(chunk['pval'])
+        mafs = _get_mafs(chunk, keep, self._pheno)
+        if mafs is not None:
+            keep &= ~(mafs < minimum_maf)
+        chunk = {field: column[keep] for field, column in chunk.items()}
+
+        if marker_id_col is not None:
+            cpras = [AssocFileReader.parse_marker_id(marker_id) for marker_id in itertools.compress(columns[marker_id_col], keep)]
+            assert all(chrom == cpra[0] for chrom, cpra in zip(chunk['chrom'], cpras))
+            assert all(pos == cpra[1] for pos, cpra in zip(chunk['pos'].tolist(), cpras))
+            chunk['ref'] = np.array([cpra[2] for cpra in cpras], dtype=object)
+            chunk['alt'] = np.array([cpra[3] for cpra in cpras], dtype=object)
+
+        alias_for_chrom = {chrom: chrom_aliases.get(chrom, chrom) for chrom in set(chunk['chrom'])}
+        chunk['chrom'] = np.array(list(map(alias_for_chrom.__getitem__, chunk['chrom'])), dtype=object)
+        return chunk
 
     def get_info(self):
         infos = []
@@ -248,3 +377,53 @@ class AssocFileReader:
         chrom, pos, ref, alt = match.groups()
         return chrom, int(pos), ref, alt
     parse_marker_id_regex = re.compile(r'([^:]+):([0-9]+)_([-ATCG\.]+)/([-ATCG\.\*]+)')
+
+
+## Columnar parsing for `get_variant_chunks()`
+
+def _column_to_list(field, column):
+    # Turns a column from `Field.parse_array()` into exactly the values that `parse_utils.parser_for_field[field]` returns.
+    values = column.tolist()
+    if column.dtype != np.float64: return values
+    for idx in np.flatnonzero(np.isnan(column)): values[idx] = ''
+    # `round_sig()` returns the int `0` for zero, so `1 - round_sig(1 - 1.0)` is the int `1`.  They get written as "0" and "1".
+    if 'sigfigs' in parse_utils.fields[field] or 'proportion_sigfigs' in parse_utils.fields[field]:
+        for idx in np.flatnonzero(column == 0): values[idx] = 0
+    if 'proportion_sigfigs' in parse_utils.fields[field]:
+        for idx in np.flatnonzero(column == 1): values[idx] = 1
+    return values
+
+def _get_mafs(chunk, keep, pheno):
+    # Does the same thing as `get_maf()` to each variant, but only checks agreement for variants in `keep`.
+    mafs = []
+    if 'maf' in chunk:
+        mafs.append(chunk['maf'])
+    if 'af' in chunk:
+        mafs.append(np.minimum(chunk['af'], 1-chunk['af']))
+    if 'ac' in chunk and 'num_samples' in pheno:
+        x = chunk['ac'] / 2 / pheno['num_samples']
+        mafs.append(np.minimum(x, 1-x))
+    if len(mafs) == 0: return None
+    elif len(mafs) == 1: return mafs[0]
+    kept_mafs = np.vstack(mafs)[:, keep]
+    if (kept_mafs > 0.5).any(): raise PheWebError("at least one way of computing maf is > 0.5")
+    if (kept_mafs.max(axis=0) - kept_mafs.min(axis=0) > 0.05).any(): raise PheWebError("two ways of computing maf differ by more than 0.05")
+    return round_sig_array(sum(mafs)/len(mafs), parse_utils.fields['maf']['sigfigs'])
+
+def _chunk_from_variants(variants, fields):
+    chunk = {}
+    for field in fields:
+        values = [v[field] for v in variants]
+        if parse_utils.fields[field]['type'] is str:
+            chunk[field] = np.array(values, dtype=object)
+        elif parse_utils.fields[field]['type'] is float:
+            chunk[field] = np.array([np.nan if value == '' else value for value in values], dtype=np.float64)
+        else:
+            chunk[field] = np.array(values, dtype=np.int64)
+    return chunk
+
+def _concat_chunks(chunk1, chunk2):
+    return {field: np.concatenate((column, chunk2[field])) for field, column in chunk1.items()}
+
+def _slice_chunk(chunk, start, end):
+    return {field: column[start:end] for field, column in chunk.items()}
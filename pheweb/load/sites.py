@@ -1,19 +1,30 @@
-
-from ..utils import chrom_order, get_phenolist, PheWebError
+from ..utils import chrom_order, get_phenolist, get_chrom_pos_key, get_pos_of_key, PheWebError
 from .. import conf
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, get_pheno_filepath, make_basedir, get_dated_tmp_path, get_tmp_path
+from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, get_pheno_filepath, make_basedir, get_dated_tmp_path, get_tmp_path, concatenate_variant_files
 from .load_utils import get_maf, mtime, indent, ProgressBar
 
 import contextlib
 import os
 import random
 import multiprocessing
-import bisect
+import heapq
+import math
 import traceback
+import pysam
 
 
-MAX_NUM_FILES_TO_MERGE_AT_ONCE = 8 # I have no idea what's fastest.  Maybe #files / #cpus?
 MIN_NUM_FILES_TO_MERGE_AT_ONCE = 4 # Try to avoid ever merging fewer than this many files at a time.
+NUM_FILE_DESCRIPTORS_TO_RESERVE = 32 # for stdio, the output file, python's imports, etc
+
+def get_max_num_files_to_merge_at_once() -> int:
+    '''Each process can hold open as many files as its soft limit on file descriptors (ie, `ulimit -n`) allows.'''
+    try:
+        import resource
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit == resource.RLIM_INFINITY: soft_limit = 2**16
+    except (ImportError, ValueError, OSError):
+        soft_limit = 1024
+    return max(MIN_NUM_FILES_TO_MERGE_AT_ONCE, soft_limit - NUM_FILE_DESCRIPTORS_TO_RESERVE)
 
 def run(argv):
     out_filepath = get_filepath('unanno', must_exist=False)
@@ -40,6 +51,12 @@ def run(argv):
             print('The list of sites is up-to-date!')
             return
 
+    if conf.should_merge_sites_by_chrom():
+        if all(os.path.exists(f['filepath'] + '.tbi') and mtime(f['filepath'] + '.tbi') >= mtime(f['filepath']) for f in manna.files):
+            merge_by_chrom(manna.files, manna.n_procs, out_filepath)
+            return
+        print('Merging whole files, because `sites_by_chrom = True` but some parsed files have no tabix index.  Re-run `pheweb parse-input-files` to make them.')
+
     taskq = multiprocessing.Queue()
     retq  = multiprocessing.Queue()
     procs = [multiprocessing.Process(target=mp_target, args=(taskq, retq)) for _ in range(manna.n_procs)]
@@ -72,8 +89,51 @@ def run(argv):
     os.rename(manna.files[0]['filepath'], out_filepath)
 
 
+def merge_by_chrom(files, n_procs, out_filepath):
+    '''Merges each chromosome in a separate process, using each parsed file's tabix index, and then concatenates them.'''
+    chroms_for_file = []
+    for f in files:
+        with pysam.TabixFile(f['filepath']) as tabix_file:
+            chroms_for_file.append(set(tabix_file.contigs))
+    unknown_chroms = set().union(*chroms_for_file) - set(chrom_order)
+    if unknown_chroms: raise PheWebError('The chromosomes {!r} are not supported'.format(sorted(unknown_chroms)))
+    chroms = sorted(set().union(*chroms_for_file), key=chrom_order.__getitem__)
+    tasks = []
+    for chrom in chroms:
+        files_to_merge = [dict(f, chrom=chrom) for f, file_chroms in zip(files, chroms_for_file) if chrom in file_chroms]
+        tasks.append({'files_to_merge': files_to_merge, 'out_filepath': get_tmp_path('merging-chrom-{}-{}'.format(chrom, random.randrange(1e10)))})
+
+    with ProgressBar() as progressbar, multiprocessing.Pool(max(1, min(n_procs, len(tasks)))) as pool:
+        num_done = 0
+        for warning_strs in pool.imap_unordered(merge_chrom, tasks):
+            for warning_str in warning_strs: progressbar.prepend_message(warning_str)
+            num_done += 1
+            progressbar.set_message('Merged {} of {} chromosomes in {}'.format(num_done, len(tasks), progressbar.fmt_elapsed()))
+    concatenate_variant_files([task['out_filepath'] for task in tasks], out_filepath)
+    for task in tasks: os.remove(task['out_filepath'])
+
+def merge_chrom(task):
+    # If there are too many files to open at once, merge them in groups, and then merge those.
+    files_to_merge = task['files_to_merge']
+    max_num_files = get_max_num_files_to_merge_at_once()
+    warning_strs = []
+    while len(files_to_merge) > max_num_files:
+        merged_files = []
+        for i in range(0, len(files_to_merge), max_num_files):
+            merged_filepath = get_tmp_path('merging-{}'.format(random.randrange(1e10)))
+            warning_strs.extend(ret['warning_str'] for ret in merge(files_to_merge[i:i+max_num_files], merged_filepath))
+            merged_files.append({'type': 'merged', 'filepath': merged_filepath})
+        files_to_merge = merged_files
+    warning_strs.extend(ret['warning_str'] for ret in merge(files_to_merge, task['out_filepath']))
+    return warning_strs
+
+
 class MergeManager:
-    '''Keeps track of what needs to get merged next.'''
+    '''
+    Keeps track of what needs to get merged next.
+    The input files are split evenly between the processes (limited by how many files each process can open), so that every input file is
+    read just once, and then the last process merges those merged files together.
+    '''
     def __init__(self):
         self.n_procs = conf.get_num_procs(cmd='sites')
         self.files = []
@@ -84,6 +144,9 @@ class MergeManager:
                 'filepath': filepath,
                 'pheno': pheno,
             })
+        self.max_num_files_to_merge_at_once = get_max_num_files_to_merge_at_once()
+        num_tasks = max(1, min(self.n_procs, len(self.files) // MIN_NUM_FILES_TO_MERGE_AT_ONCE))
+        self.num_input_files_per_task = min(self.max_num_files_to_merge_at_once, math.ceil(len(self.files) / num_tasks))
     def apply_ret(self, ret):
         if ret['type'] == 'task-completion':
             self.files.append({
@@ -101,28 +164,30 @@ class MergeManager:
         else:
             raise PheWebError('Unknown ret type: {}'.format(ret['type']))
     def put_task(self, taskq):
+        input_files = [f for f in self.files if f['type'] == 'input']
         if self.n_procs == 1 and len(self.files) == 1 and self.files[0]['type'] == 'merged':
             # ALL DONE!
             self.n_procs -= 1
             taskq.put({'exit':True})
             return 'ALLDONE'
-        elif len(self.files) == 0:
-            # NO WORK, TERMINATE WORKER
-            self.n_procs -= 1
-            taskq.put({'exit':True})
-        elif self.n_procs > 1 and len(self.files) < MIN_NUM_FILES_TO_MERGE_AT_ONCE:
-            # INSUFFICIENT WORK, TERMINATE WORKER
+        elif input_files:
+            # MAKE A TASK FOR THE WORKER FROM INPUT FILES
+            self._put_merge_task(taskq, input_files[:self.num_input_files_per_task])
+        elif self.n_procs > 1 and len(self.files) < self.max_num_files_to_merge_at_once:
+            # OTHER WORKERS ARE STILL MERGING, SO TERMINATE THIS WORKER AND LET THE LAST ONE MERGE EVERYTHING AT ONCE
             self.n_procs -= 1
             taskq.put({'exit':True})
         else:
-            # MAKE A TASK FOR THE WORKER
-            files_to_merge = self.files[:MAX_NUM_FILES_TO_MERGE_AT_ONCE]
-            self.files =     self.files[MAX_NUM_FILES_TO_MERGE_AT_ONCE:]
-            out_filepath = get_tmp_path('merging-{}'.format(random.randrange(1e10)))
-            taskq.put({
-                'files_to_merge': files_to_merge,
-                'out_filepath': out_filepath,
-            })
+            # MAKE A TASK FOR THE WORKER FROM MERGED FILES
+            self._put_merge_task(taskq, self.files[:self.max_num_files_to_merge_at_once])
+    def _put_merge_task(self, taskq, files_to_merge):
+        ids_to_merge = set(map(id, files_to_merge))
+        self.files = [f for f in self.files if id(f) not in ids_to_merge]
+        out_filepath = get_tmp_path('merging-{}'.format(random.randrange(1e10)))
+        taskq.put({
+            'files_to_merge': files_to_merge,
+            'out_filepath': out_filepath,
+        })
 
 
 def mp_target(taskq, retq):
@@ -151,91 +216,70 @@ def mp_target(taskq, retq):
 def merge(files_to_merge, out_filepath):
     # files_to_merge is like [
     #   {filepath: "/foo/bar", type:"input", pheno:pheno},
+    #   {filepath: "/foo/bar", type:"input", pheno:pheno, chrom:"2"},  # only reads chrom 2, using the tabix index
     #   {filepath: "/foo/bar", type:"merged"},
     # ]
+    # Variants are merged with a heap of (key, reader_id, chrom), where key is `(get_chrom_pos_key(chrom, pos), ref, alt)`.
+    # Each variant is written when it's first popped from the heap, and each reader is advanced as its variant is popped.
+    # If a file has the same variant multiple times, then it's written that many times, so that every file is still a subsequence of the output.
+    fields = ['chrom', 'pos', 'ref', 'alt']
     with contextlib.ExitStack() as exit_stack, \
          VariantFileWriter(out_filepath) as writer:
 
         readers = []
-        _reader_info = []
-        vlm = VariantListMerger()
-        for file_to_merge in files_to_merge:
-            reader = iter(exit_stack.enter_context(VariantFileReader(file_to_merge['filepath'], only_per_variant_fields=True)))
-            reader_id = len(readers)
+        heap = []
+        for reader_id, file_to_merge in enumerate(files_to_merge):
+            # Only read chrom-pos-ref-alt, so that extra fields can't cause two of the same variant to not look like a pair.
+            # This is useful if the user has replaced parsed files with symlinks to annotated files in order to save space.
+            reader = iter(exit_stack.enter_context(VariantFileReader(file_to_merge['filepath'], fields=fields, chrom=file_to_merge.get('chrom'))))
             readers.append(reader)
-            _reader_info.append(file_to_merge)
-
-            # insert the first variant of each pheno into the VariantListMerger
             try:
                 v = next(reader)
             except StopIteration:
                 yield {
                     'type': 'warning',
-                    'warning_str': 'Warning: {!r} didnt even have ONE variant that passed the MAF thresholds.'.format(_reader_info[reader_id]['filepath']),
+                    'warning_str': 'Warning: {!r} didnt even have ONE variant that passed the MAF thresholds.'.format(file_to_merge['filepath']),
                 }
-            vlm.insert(v, reader_id)
-
-        # each time we pop the leftmost variant from the VariantListMerger, fetch a new variant from each pheno that contained that variant
-        n_variants = 0
-        while vlm:
-            assert len(vlm) <= len(files_to_merge), repr(vlm)
-            v, reader_ids = vlm.pop()
-            writer.write(v)
-            n_variants += 1
-            for reader_id in reader_ids:
-                try:
-                    new_v = next(readers[reader_id])
-                except StopIteration:
-                    readers[reader_id] = None
-                else:
-                    vlm.insert(new_v, reader_id)
+            else:
+                heap.append(_heap_item_from_variant(v, reader_id))
+        heapq.heapify(heap)
 
-        assert all(reader is None for reader in readers), list(zip(_reader_info, readers))
+        rows = []
+        last_key, last_chrom = None, None
+        num_copies_written, num_copies_for_reader = 0, {}  # for the current key
+        while heap:
+            key, reader_id, chrom = item = heap[0]
+            if key != last_key:
+                last_key, last_chrom = key, chrom
+                num_copies_written, num_copies_for_reader = 1, {reader_id: 1}
+                rows.append((chrom, get_pos_of_key(key[0]), key[1], key[2]))
+                if len(rows) >= 10_000:
+                    writer.write_rows(fields, rows)
+                    rows = []
+            else:
+                if chrom != last_chrom:
+                    # Require that variants match exactly, because if "chrM:1234:A:T" equals "chrMT:1234:A:T" then the merged file won't match the original files.
+                    raise PheWebError('trying to merge {!r} from {!r} with {!r}, which has the same chrom-pos-ref-alt'.format(
+                        (chrom, *key[1:]), files_to_merge[reader_id]['filepath'], (last_chrom, *key[1:])))
+                num_copies = num_copies_for_reader[reader_id] = num_copies_for_reader.get(reader_id, 0) + 1
+                if num_copies > num_copies_written:
+                    num_copies_written = num_copies
+                    rows.append((chrom, get_pos_of_key(key[0]), key[1], key[2]))
+            try:
+                new_item = _heap_item_from_variant(next(readers[reader_id]), reader_id)
+            except StopIteration:
+                heapq.heappop(heap)
+            else:
+                if new_item[0] < key:
+                    raise PheWebError('The variants in {!r} are not sorted: {!r} came after {!r}'.format(files_to_merge[reader_id]['filepath'], new_item, item))
+                heapq.heapreplace(heap, new_item)
+        writer.write_rows(fields, rows)
 
     for file_to_merge in files_to_merge:
         if file_to_merge['type'] == 'merged':
             os.remove(file_to_merge['filepath'])
-    #print('{:8} variants in {} <- {}'.format(n_variants, os.path.basename(out_filepath), [os.path.basename(f['filepath']) for f in files_to_merge]))
-
-class VariantListMerger:
-    '''
-    Works like a heap for variants, where .pop() returns the variant with the smallest chrom-pos-ref-alt.
-    Also tracks which readers had the variant.
-    Variants must match EXACTLY.
-    '''
-    def __init__(self):
-        # self._q = blist.blist()  # TODO: see whether blist.blist() is more performant than [] (b/c blist1.3 raises DeprecationWarnings on py38)
-        self._q = []
-        # self._q is like sorted([(key, variant_dict, [reader_id, ...]), ...])
-        # key is like (chrom_idx, pos, ref, alt)
-
-    def insert(self, variant, reader_id):
-        # Delete extra keys that would cause two of the same variant to not look like a pair.
-        # This is useful if the user has replaced parsed files with symlinks to annotated files in order to save space.
-        # Require that variants match exactly, because if "chrM:1234:A:T" equals "chrMT:1234:A:T" then the merged file won't match the original files.
-        for key in [key for key in variant.keys() if key not in ('chrom', 'pos', 'ref', 'alt')]:
-            del variant[key]
-        key = self._key_from_variant(variant)
-        idx = bisect.bisect_left(self._q, (key,)) # note: (a,) < (a,b)
-        if idx == len(self._q) or self._q[idx][0] != key:
-            # new variant, so just insert
-            self._q.insert(idx, (key, variant, [reader_id]))
-        else:
-            # key matches, so variant must too
-            if variant != self._q[idx][1]:
-                raise PheWebError('trying to add {!r} to VariantMerger, but it already contains {!r} which has the same chrom-pos-ref-alt'.format(
-                    variant, self._q[idx][1]))
-            self._q[idx][2].append(reader_id)
-
-    def pop(self):
-        return self._q.pop(0)[1:3] # return (item, [tag, ...])
-
-    def __len__(self):
-        return len(self._q)
-
-    def __repr__(self):
-        return 'VariantMerger<_q={!r}>'.format(self._q)
 
-    @staticmethod
-    def _key_from_variant(v):
-        return (chrom_order[v['chrom']], v['pos'], v['ref'], v['alt'])
+def _heap_item_from_variant(v, reader_id):
+    try: key = get_chrom_pos_key(v['chrom'], v['pos'])
+    except KeyError: raise PheWebError('The chromosome {!r} is not supported'.format(v['chrom']))
+    return ((key, v['ref'], v['alt']), reader_id, v['chrom'])
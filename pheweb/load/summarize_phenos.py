@@ -0,0 +1,55 @@
+'''
+This script makes the manhattan and QQ json files (and best-of-pheno files, if `show_manhattan_filter_button = True`) for each phenotype.
+It does the same as `pheweb manhattan`, `pheweb qq`, and `pheweb best-of-pheno`, but it reads each pheno file once for all of them.
+'''
+
+from .. import conf
+from ..file_utils import get_pheno_filepath, read_sidecar, write_json
+from .load_utils import parallelize_per_pheno, get_phenos_subset, get_phenolist, scan_variant_file, mtime
+from .manhattan import ManhattanFileMaker, get_manhattan_data_from_sidecar
+from .qq import QQFileMaker, make_json_file_from_sidecar as make_qq_json_file_from_sidecar
+from .best_of_pheno import BestOfPhenoFileMaker, make_bestof_file_from_sidecar
+
+import os, argparse
+from typing import List,Dict,Any
+
+
+def run(argv:List[str]) -> None:
+    parser = argparse.ArgumentParser(description="Make the manhattan plot, QQ plot, and (optionally) best-of-pheno file for each phenotype.")
+    parser.add_argument('--phenos', help="Can be like '4,5,6,12' or '4-6,12' to run on only the phenos at those positions (0-indexed) in pheno-list.json (and only if they need to run)")
+    args = parser.parse_args(argv)
+
+    phenos = get_phenos_subset(args.phenos) if args.phenos else get_phenolist()
+
+    parallelize_per_pheno(
+        get_input_filepaths = lambda pheno: get_pheno_filepath('pheno_gz', pheno['phenocode']),
+        get_output_filepaths = lambda pheno: list(get_output_filepaths(pheno).values()),
+        convert = make_files,
+        cmd = 'summarize_phenos',
+        phenos = phenos,
+    )
+
+
+def get_output_filepaths(pheno:Dict[str,Any]) -> Dict[str,str]:
+    kinds = ['manhattan', 'qq']
+    if conf.should_show_manhattan_filter_button(): kinds.append('best_of_pheno')
+    return {kind: get_pheno_filepath(kind, pheno['phenocode'], must_exist=False) for kind in kinds}
+
+def make_files(pheno:Dict[str,Any]) -> None:
+    in_filepath = get_pheno_filepath('pheno_gz', pheno['phenocode'])
+    out_filepaths = {kind: out_filepath for kind, out_filepath in get_output_filepaths(pheno).items()
+                     if not os.path.exists(out_filepath) or mtime(out_filepath) < mtime(in_filepath)}  # only remake out-of-date files
+    # With a sidecar (from `pheno_sidecars = True`), each file only reads the variants it needs.
+    sidecar = read_sidecar(in_filepath)
+    if sidecar is not None:
+        for kind, out_filepath in out_filepaths.items():
+            if kind == 'manhattan': write_json(filepath=out_filepath, data=get_manhattan_data_from_sidecar(sidecar, in_filepath))
+            elif kind == 'qq': make_qq_json_file_from_sidecar(sidecar, out_filepath, pheno)
+            elif kind == 'best_of_pheno': make_bestof_file_from_sidecar(sidecar, in_filepath, out_filepath)
+        return
+    consumers: List[Any] = []
+    for kind, out_filepath in out_filepaths.items():
+        if kind == 'manhattan': consumers.append(ManhattanFileMaker(out_filepath))
+        elif kind == 'qq': consumers.append(QQFileMaker(out_filepath, pheno))
+        elif kind == 'best_of_pheno': consumers.append(BestOfPhenoFileMaker(in_filepath, out_filepath))
+    scan_variant_file(in_filepath, consumers)
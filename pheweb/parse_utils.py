@@ -3,6 +3,7 @@ from .utils import PheWebError
 from . import conf
 
 import itertools
+import numpy as np
 from collections import OrderedDict,Counter
 import typing as ty
 from typing import Dict,Any
@@ -20,6 +21,7 @@ def scientific_int(s:str) -> int:
 
 
 null_values = ['', '.', 'NA', 'N/A', 'n/a', 'nan', '-nan', 'NaN', '-NaN', 'null', 'NULL']
+_null_values_set = frozenset(null_values)
 
 default_field = {
     'aliases': [],
@@ -216,11 +218,78 @@ class Field:
         if 'decimals' in self._d:
             x = round(x, self._d['decimals'])
         return x
+    def parse_array(self, values:ty.Sequence[str]) -> ty.Tuple[np.ndarray,np.ndarray]:
+        '''
+        parse a column from input file, with the same semantics as `parse()` on each value.
+        Returns `(array, is_null)`.  In `array`, nulls are NaN for float fields, 0 for int fields, and '' for str fields.
+        Errors include the index of the offending value in `values`.
+        '''
+        num_values = len(values)
+        is_null = np.zeros(num_values, dtype=bool)
+        if self._d['nullable']:
+            is_null = np.fromiter(map(_null_values_set.__contains__, values), dtype=bool, count=num_values)
+        nonnull_idx = np.flatnonzero(~is_null)
+        if len(nonnull_idx) < num_values:
+            values = [values[i] for i in nonnull_idx.tolist()]
+        # type
+        if self._d['type'] is str:
+            x = np.array(values, dtype=object)
+        else:
+            x = self._convert_array(values, nonnull_idx)
+        # range
+        if 'range' in self._d:
+            low, high = self._d['range']
+            in_range = np.ones(len(x), dtype=bool)
+            if low is not None: in_range &= (x >= low)
+            if high is not None: in_range &= (x <= high)
+            self._check_array(in_range, x, nonnull_idx, 'is outside of the range {}'.format(self._d['range']))
+        if 'sigfigs' in self._d:
+            self._check_array(np.isfinite(x), x, nonnull_idx, 'cannot be rounded')
+            x = utils.round_sig_array(x, self._d['sigfigs'])
+        if 'proportion_sigfigs' in self._d:
+            self._check_array((0 <= x) & (x <= 1), x, nonnull_idx, 'cannot use proportion_sigfigs on a number outside [0-1]')
+            is_low = x < 0.5
+            x[is_low] = utils.round_sig_array(x[is_low], self._d['proportion_sigfigs'])
+            x[~is_low] = 1 - utils.round_sig_array(1 - x[~is_low], self._d['proportion_sigfigs'])
+        if 'decimals' in self._d:
+            x = utils.round_array(x, self._d['decimals'])
+        if len(nonnull_idx) == num_values:
+            return x, is_null
+        array = np.full(num_values, '' if x.dtype == object else np.nan if x.dtype == np.float64 else 0, dtype=x.dtype)
+        array[nonnull_idx] = x
+        return array, is_null
+    def _convert_array(self, values:ty.Sequence[str], nonnull_idx:np.ndarray) -> np.ndarray:
+        type_ = self._d['type']
+        dtype = np.float64 if type_ is float else np.int64
+        try:
+            # `int()` is much faster than `scientific_int()` and usually works.
+            try: return np.fromiter(map(int if type_ is scientific_int else type_, values), dtype=dtype, count=len(values))
+            except ValueError:
+                if type_ is not scientific_int: raise
+                return np.fromiter(map(type_, values), dtype=dtype, count=len(values))
+        except Exception:
+            for idx, value in zip(nonnull_idx, values):
+                try: type_(value)
+                except Exception as exc:
+                    raise PheWebError('Failed to parse {!r} (at index {}) as {}'.format(value, idx, getattr(type_, '__name__', type_))) from exc
+            raise
+    def _check_array(self, is_ok:np.ndarray, x:np.ndarray, nonnull_idx:np.ndarray, message:str) -> None:
+        if not is_ok.all():
+            first_bad = np.flatnonzero(~is_ok)[0]
+            raise PheWebError('The value {!r} (at index {}) {}'.format(x[first_bad].item(), nonnull_idx[first_bad], message))
     def read(self, value):
         '''read from internal file'''
         if self._d['nullable'] and value == '':
             return ''  # TODO: should this be None?
         return self._d['type'](value)
+    def get_reader(self) -> ty.Callable[[str],ty.Any]:
+        '''returns a function that does the same thing as `read()` but faster'''
+        type_ = self._d['type']
+        if not self._d['nullable']:
+            return type_
+        def read_nullable(value:str) -> ty.Any:
+            return '' if value == '' else type_(value)
+        return read_nullable
 
 # Check that field_names are lowercase
 if any(not field_name.islower() for field_name in fields):
@@ -242,11 +311,14 @@ for field_name, field_dict in fields.items():
 
 # Build readers/parsers
 parser_for_field: ty.Dict[str,ty.Callable[[str],ty.Any]] = {}
+array_parser_for_field: ty.Dict[str,ty.Callable[[ty.Sequence[str]],ty.Tuple[np.ndarray,np.ndarray]]] = {}
 reader_for_field: ty.Dict[str,ty.Callable[[str],ty.Any]] = {}
 for field_name, field_dict in fields.items():
     obj = Field(field_dict)
     parser_for_field[field_name] = obj.parse
-    reader_for_field[field_name] = obj.read
+    array_parser_for_field[field_name] = obj.parse_array
+    reader_for_field[field_name] = obj.get_reader()
+assert array_parser_for_field['af'](['0.99951', '0.00123', '1'])[0].tolist() == [parser_for_field['af'](v) for v in ['0.99951', '0.00123', '1']]
 
 
 
@@ -3,14 +3,14 @@ from ..load.load_utils import get_maf
 from ..utils import get_phenolist, get_gene_tuples, pad_gene, PheWebError, vep_consqeuence_category
 from .. import conf
 from .. import parse_utils
-from ..file_utils import get_filepath, get_pheno_filepath, VariantFileReader
+from ..file_utils import get_filepath, get_pheno_filepath, VariantFileReader, get_site_index_header, get_pheno_tsv_gz, read_sidecar, SIDECAR_FLAG_SNP, SIDECAR_FLAG_LOF, SIDECAR_FLAG_NONSYN
 from .server_utils import get_variant, get_random_page, get_pheno_region
 from .autocomplete import Autocompleter
 from .auth import GoogleSignIn
 from ..version import version as pheweb_version
 from ..import weetabix
 
-from flask import Flask, jsonify, render_template, request, redirect, abort, flash, send_from_directory, send_file, session, url_for, Blueprint
+from flask import Flask, jsonify, render_template, request, redirect, abort, flash, send_from_directory, send_file, session, url_for, Blueprint, Response, stream_with_context
 from flask_compress import Compress
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user
 
@@ -21,6 +21,7 @@ import json
 import os
 import os.path
 import sqlite3
+import numpy as np
 from typing import Dict,Tuple,List,Any
 
 
@@ -137,12 +138,28 @@ def api_pheno_filtered(phenocode):
     if request.args.get('max_maf'):
         try: max_maf = float(request.args['max_maf'])
         except Exception: abort(404, description="Failed to parse GET parameter `max_maf=`.")
+    try: filepath = get_pheno_filepath('best_of_pheno', phenocode)
+    except Exception: abort(404, description="Failed to find a best_of_pheno file.  Perhaps `pheweb best-of-pheno` wasn't run.")
+    from pheweb.load.manhattan import get_manhattan_data_from_sidecar, get_manhattan_data_from_variants
+    # With a sidecar (from `pheno_sidecars = True`), filter using its columns and only read the variants that stay unbinned.
+    sidecar = read_sidecar(filepath)
+    if sidecar is not None:
+        row_mask = np.ones(len(sidecar), dtype=bool)
+        is_snp = (sidecar['flags'] & SIDECAR_FLAG_SNP) != 0
+        if indel == 'true': row_mask &= ~is_snp
+        if indel == 'false': row_mask &= is_snp
+        # Compare in float32, like the mafs in the sidecar.
+        if min_maf is not None: row_mask &= sidecar['maf'] >= np.float32(min_maf)
+        if max_maf is not None: row_mask &= sidecar['maf'] <= np.float32(max_maf)
+        if consequence_category == 'lof': row_mask &= (sidecar['flags'] & SIDECAR_FLAG_LOF) != 0
+        if consequence_category == 'nonsyn': row_mask &= (sidecar['flags'] & (SIDECAR_FLAG_LOF | SIDECAR_FLAG_NONSYN)) != 0
+        manhattan_data = get_manhattan_data_from_sidecar(sidecar, filepath, row_mask)
+        manhattan_data['weakest_pval'] = float(sidecar['pval'].max()) if len(sidecar) else 0
+        return jsonify(manhattan_data)
     # Get variants according to filter
-    chosen_variants = []  # TODO: stream straight from VariantFileReader() -> Binner() without this intermediate list
+    chosen_variants = []
     weakest_pval_seen = 0
     num_variants = 0
-    try: filepath = get_pheno_filepath('best_of_pheno', phenocode)
-    except Exception: abort(404, description="Failed to find a best_of_pheno file.  Perhaps `pheweb best-of-pheno` wasn't run.")
     with VariantFileReader(filepath) as vfr:
         for v in vfr:
             num_variants += 1
@@ -158,11 +175,7 @@ def api_pheno_filtered(phenocode):
                 if consequence_category == 'lof' and csq != 'lof': continue
                 if consequence_category == 'nonsyn' and not csq: continue
             chosen_variants.append(v)
-    from pheweb.load.manhattan import Binner
-    binner = Binner()
-    for variant in chosen_variants:
-        binner.process_variant(variant)
-    manhattan_data = binner.get_result()
+    manhattan_data = get_manhattan_data_from_variants(chosen_variants)
     manhattan_data['weakest_pval'] = weakest_pval_seen
     #print(f'indel={indel} maf={min_maf}-{max_maf} #chosen={len(chosen_variants)} #bins={len(manhattan_data["variant_bins"])} #unbinned={len(manhattan_data["unbinned_variants"])} weakest_pval={weakest_pval_seen}')
     return jsonify(manhattan_data)
@@ -353,6 +366,18 @@ def gene_page(genename:str):
 
 
 
+def send_pheno_gz(phenocode:str) -> Response:
+    attachment_filename = 'phenocode-{}.tsv.gz'.format(phenocode)
+    filepath = get_pheno_filepath('pheno_gz', phenocode, must_exist=False)
+    if not os.path.isfile(filepath): abort(404)  # like `send_from_directory()`
+    if get_site_index_header(filepath):
+        # The file has indexes into sites.tsv instead of the per-variant fields, so send what it would be without them.
+        return Response(stream_with_context(get_pheno_tsv_gz(phenocode)), mimetype='application/gzip',
+                        headers={'Content-Disposition': 'attachment; filename={}'.format(attachment_filename)})
+    return send_from_directory(get_filepath('pheno_gz'), '{}.gz'.format(phenocode),
+                               as_attachment=True,
+                               attachment_filename=attachment_filename)
+
 if conf.is_secret_download_pheno_sumstats():
     if app.config['SECRET_KEY'] == 'nonsecret key':
         raise PheWebError('you must set a SECRET_KEY in config.py to use download_pheno_sumstats = "secret"')
@@ -375,9 +400,7 @@ if conf.is_secret_download_pheno_sumstats():
         if not Hasher.check_hash(token, phenocode):
             die("Sorry, that token is incorrect")
         try:
-            return send_from_directory(get_filepath('pheno_gz'), '{}.gz'.format(phenocode),
-                                       as_attachment=True,
-                                       attachment_filename='phenocode-{}.tsv.gz'.format(phenocode))
+            return send_pheno_gz(phenocode)
         except Exception as exc:
             die("Sorry, that file doesn't exist.", exception=exc)
 
@@ -401,9 +424,7 @@ else:
     def download_pheno(phenocode:str):
         if phenocode not in phenos:
             die("Sorry, that phenocode doesn't exist")
-        return send_from_directory(get_filepath('pheno_gz'), '{}.gz'.format(phenocode),
-                                   as_attachment=True,
-                                   attachment_filename='phenocode-{}.tsv.gz'.format(phenocode))
+        return send_pheno_gz(phenocode)
 
 
 @bp.route('/')
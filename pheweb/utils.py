@@ -4,6 +4,7 @@ import json
 import os
 import csv
 import boltons.mathutils
+import numpy as np
 import urllib.parse
 import types
 import typing as ty
@@ -30,6 +31,45 @@ def round_sig(x:float, digits:int) -> float:
 assert round_sig(0.00123, 2) == 0.0012
 assert round_sig(1.59e-10, 2) == 1.6e-10
 
+def round_array(x:np.ndarray, ndigits) -> np.ndarray:
+    '''
+    Like `[round(v, ndigits) for v in x]` but vectorized, where `ndigits` is an int or an array of ints.
+    Python's `round()` rounds the exact binary value of each float, but multiplying by a power of ten can move a value across a rounding boundary,
+    so wherever the scaled value is near a boundary (or the power of ten isn't exactly representable) this falls back to `round()`.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    ndigits = np.broadcast_to(np.asarray(ndigits, dtype=np.int64), x.shape)
+    is_neg = ndigits < 0
+    with np.errstate(over='ignore', invalid='ignore'):  # values that overflow fall back to `round()` below
+        scale = 10.0 ** np.abs(ndigits)
+        scaled = np.where(is_neg, x / scale, x * scale)
+        rounded = np.rint(scaled)
+        rv = np.where(is_neg, rounded * scale, rounded / scale)
+        # Division and multiplication are correctly rounded when both operands are exact, so outside of these cases `rv` matches `round()`.
+        needs_fallback = (np.abs(ndigits) > 22) | ~(np.abs(scaled) < 2**30) | (np.abs(np.abs(scaled - np.floor(scaled)) - 0.5) < 1e-6)
+    for i in np.flatnonzero(needs_fallback):
+        rv[i] = round(float(x[i]), int(ndigits[i]))
+    return rv
+assert round_array(np.array([0.15, 2.675, 1234.5, -0.05]), 1).tolist() == [round(0.15, 1), round(2.675, 1), 1234.5, round(-0.05, 1)]
+assert round_array(np.array([1234.5, 0.000123456]), np.array([-2, 5])).tolist() == [1200.0, 0.00012]
+
+def round_sig_array(x:np.ndarray, digits:int) -> np.ndarray:
+    '''Like `[round_sig(v, digits) for v in x]` but vectorized.  Zeros stay 0.0 instead of becoming int 0.'''
+    x = np.asarray(x, dtype=np.float64)
+    if not np.isfinite(x).all():
+        raise ValueError("Cannot round infinity or NaN")
+    rv = np.zeros_like(x)
+    nonzero = np.flatnonzero(x)
+    log = np.log10(np.abs(x[nonzero]))
+    digits_above_zero = np.floor(log).astype(np.int64)
+    # `np.log10` can differ from `math.log10` by an ulp, which matters when `log` is nearly an integer.
+    for i in np.flatnonzero(np.abs(log - np.round(log)) < 1e-9):
+        digits_above_zero[i] = int(math.floor(math.log10(abs(float(x[nonzero[i]])))))
+    rv[nonzero] = round_array(x[nonzero], digits - 1 - digits_above_zero)
+    return rv
+assert round_sig_array(np.array([0.00123, 1.59e-10, 0, -987.6, 1e-300]), 2).tolist() == [0.0012, 1.6e-10, 0, -990, 1e-300]
+assert round_sig_array(np.array([1e-320, 1.23456e-315]), 2).tolist() == [round_sig(1e-320, 2), round_sig(1.23456e-315, 2)]
+
 def approx_equal(a:float, b:float, tolerance:float = 1e-4) -> bool:
     return abs(a-b) <= max(abs(a), abs(b)) * tolerance
 assert approx_equal(42, 42.0000001)
@@ -87,6 +127,28 @@ chrom_aliases = {'23': 'X', '24': 'Y', '25': 'MT', 'M': 'MT'}
 for chrom in chrom_order_list: chrom_aliases['chr{}'.format(chrom)] = chrom
 for alias, chrom in list(chrom_aliases.items()): chrom_aliases['chr{}'.format(alias)] = chrom
 
+# A variant's chrom and pos packed into one int (`chrom_idx << 32 | pos`), so that comparing keys compares variants by chrom and then pos.
+# Variants with the same chrom-pos are sorted by ref and then alt, so `(key, ref, alt)` sorts like the variants.
+def get_chrom_pos_key(chrom:str, pos:int) -> int:
+    return chrom_order[chrom] << 32 | pos
+def get_chrom_pos_keys(chroms:ty.Iterable[str], positions:ty.Iterable[int]) -> np.ndarray:
+    '''Returns `get_chrom_pos_key()` of each variant as int64.'''
+    chrom_idxs = np.fromiter(map(chrom_order.__getitem__, chroms), dtype=np.int64)
+    return (chrom_idxs << 32) | np.fromiter(positions, dtype=np.int64, count=len(chrom_idxs))
+def get_pos_of_key(key:int) -> int: return key & 0xffffffff
+def get_chrom_idx_of_key(key:int) -> int: return key >> 32
+def get_first_unsorted_idx(keys:np.ndarray, prev_key:int = -1) -> ty.Optional[int]:
+    '''Returns the index of the first key that's smaller than the one before it (or than `prev_key`), or None if they're sorted.'''
+    if len(keys) == 0: return None
+    is_smaller = np.empty(len(keys), dtype=bool)
+    is_smaller[0] = keys[0] < prev_key
+    np.less(keys[1:], keys[:-1], out=is_smaller[1:])
+    idxs = np.flatnonzero(is_smaller)
+    return int(idxs[0]) if len(idxs) else None
+assert get_chrom_pos_keys(['1', '2'], [7, 3]).tolist() == [get_chrom_pos_key('1', 7), get_chrom_pos_key('2', 3)] == [7, (1 << 32) + 3]
+assert get_pos_of_key(get_chrom_pos_key('X', 5)) == 5 and get_chrom_idx_of_key(get_chrom_pos_key('X', 5)) == chrom_order['X']
+assert get_first_unsorted_idx(np.array([3, 5, 5, 4, 2])) == 3 and get_first_unsorted_idx(np.array([3, 5]), prev_key=4) == 0 and get_first_unsorted_idx(np.array([3, 5])) is None
+
 
 def get_gene_tuples_with_ensg() -> ty.Iterator[ty.Tuple[str,int,int,str,str]]:
     from .file_utils import get_filepath
@@ -2,6 +2,15 @@
 #TODO: split into multiple tests that share tmpdir and run in order
 
 import os
+import sys
+import json
+import glob
+import urllib.parse
+import gzip
+import shutil
+import sqlite3
+import subprocess
+import pytest
 
 def test_all(tmpdir, capsys):
     data_dir = str(tmpdir.realpath())
@@ -51,3 +60,176 @@ def test_all(tmpdir, capsys):
         assert client.get('/api/autocomplete?query=%20DAP-2').status_code == 200
         assert b'EAR-LENGTH' in client.get('/region/1/gene/SAMD11').data
         assert b'\t' in client.get('/download/top_hits.tsv').data
+
+
+# The tests below load the same input files with some option set, and check that the server gives the same responses as with the default options.
+# PheWeb sets up some state for its data_dir when its modules are imported, so each of these runs in a new process.
+
+def run_python(script, *args):
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.run([sys.executable, '-c', script] + [json.dumps(arg) for arg in args], cwd=repo_dir, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+def cl_run_in_new_process(argv):
+    run_python('import sys, json; from pheweb.command_line import run; run(json.loads(sys.argv[1]))', argv)
+
+def get_data_dir(conf):
+    return json.loads(conf[1].split('=', 1)[1])
+
+def process(data_dir, extra_conf=(), default_conf=None):
+    # Runs with options use the pheno-list of `default_conf`, since `pheweb phenolist glob` can order each pheno's assoc_files differently.
+    input_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'input_files/'))
+    cache_dir = os.path.join(input_dir, 'fake-cache')
+    conf = ['conf', 'data_dir="{}"'.format(data_dir), 'cache="{}"'.format(cache_dir), 'disallow_downloads=true', 'show_manhattan_filter_button=true'] + list(extra_conf)
+    if default_conf is not None:
+        shutil.copy(os.path.join(get_data_dir(default_conf), 'pheno-list.json'), data_dir)
+    else:
+        cl_run_in_new_process(conf+['phenolist', 'glob', '--simple-phenocode', '{}/assoc-files/*'.format(input_dir)])
+        cl_run_in_new_process(conf+['phenolist', 'unique-phenocode'])
+        cl_run_in_new_process(conf+['phenolist', 'read-info-from-association-files'])
+        cl_run_in_new_process(conf+['phenolist', 'filter-phenotypes', '--minimum-num-cases', '20', '--minimum-num-controls', '20', '--minimum-num-samples', '20'])
+        cl_run_in_new_process(conf+['phenolist', 'hide-small-numbers-of-samples', '--minimum-visible-number', '50'])
+        cl_run_in_new_process(conf+['phenolist', 'import-phenolist', '-f', '{}/pheno-list-categories.json'.format(data_dir), '{}/categories.csv'.format(input_dir)])
+        cl_run_in_new_process(conf+['phenolist', 'merge-in-info', '{}/pheno-list-categories.json'.format(data_dir)])
+    cl_run_in_new_process(conf+['process'])
+    return conf
+
+@pytest.fixture(scope='module')
+def default_conf(tmpdir_factory):
+    return process(str(tmpdir_factory.mktemp('default').realpath()))
+
+_get_responses_script = '''
+import sys, json
+from pheweb.command_line import run
+run(json.loads(sys.argv[1]))
+from pheweb.serve.server import app
+app.testing = True
+with app.test_client() as client:
+    responses = [client.get(url) for url in json.loads(sys.argv[2])]
+    print(json.dumps([[response.status_code, response.get_data().decode('latin-1')] for response in responses]))
+'''
+def get_responses(conf, urls):
+    output = run_python(_get_responses_script, conf, urls)
+    return dict(zip(urls, json.loads(output.splitlines()[-1])))
+
+def get_best_phenos_by_gene(conf):
+    with sqlite3.connect(os.path.join(get_data_dir(conf), 'generated-by-pheweb', 'best-phenos-by-gene.sqlite3')) as db:
+        return db.execute('SELECT * FROM best_phenos_for_each_gene ORDER BY gene').fetchall()
+
+def test_sharded_matrix(tmpdir, default_conf):
+    data_dir = str(tmpdir.realpath())
+    conf = process(data_dir, ['matrix_phenos_per_shard=5'], default_conf)
+    manifest_filepath = os.path.join(data_dir, 'generated-by-pheweb', 'matrix', 'manifest.json')
+    with open(manifest_filepath) as f: old_manifest = json.load(f)
+
+    # Re-parsing a pheno only remakes its shard, and a server that's already running can still read the matrix.
+    os.utime(os.path.join(data_dir, 'generated-by-pheweb', 'parsed', 'EAR-LENGTH'))
+    run_python('''
+import sys, json
+from pheweb.command_line import run
+from pheweb.file_utils import MatrixReader
+run(json.loads(sys.argv[1]))
+matrix_reader = MatrixReader()
+run(json.loads(sys.argv[1]) + ['matrix'])
+with matrix_reader.context() as mr:
+    assert mr.get_variant('1', 869334, 'G', 'A') is not None
+''', conf)
+    with open(manifest_filepath) as f: manifest = json.load(f)
+    assert [shard['phenocodes'] for shard in manifest['shards']] == [shard['phenocodes'] for shard in old_manifest['shards']]
+    assert [shard['filename'] != old_shard['filename'] for shard, old_shard in zip(manifest['shards'], old_manifest['shards'])].count(True) == 1
+
+    urls = ['/api/variant/1-869334-G-A']
+    assert get_responses(conf, urls) == get_responses(default_conf, urls)
+    assert get_best_phenos_by_gene(conf) == get_best_phenos_by_gene(default_conf)
+
+def test_sparse_matrix(tmpdir, default_conf):
+    conf = process(str(tmpdir.realpath()), ['matrix_sparse=true'], default_conf)
+    urls = ['/api/variant/1-869334-G-A', '/gene/SAMD11', '/gene/DNAH14']
+    assert get_responses(conf, urls) == get_responses(default_conf, urls)
+    assert get_best_phenos_by_gene(conf) == get_best_phenos_by_gene(default_conf)
+
+    # Changing `matrix_sparse` remakes the matrix
+    def should_run(conf):
+        output = run_python('import sys, json; from pheweb.command_line import run; run(json.loads(sys.argv[1])); from pheweb.load import matrix; print(matrix.should_run())', conf)
+        return output.splitlines()[-1] == 'True'
+    dense_conf = [arg for arg in conf if arg != 'matrix_sparse=true'] + ['matrix_sparse=false']
+    assert not should_run(conf)
+    assert should_run(dense_conf)
+    cl_run_in_new_process(dense_conf+['matrix'])
+    assert not should_run(dense_conf)
+    assert should_run(conf)
+    assert get_responses(dense_conf, urls) == get_responses(default_conf, urls)
+
+def test_pheno_gz_site_index(tmpdir, default_conf):
+    conf = process(str(tmpdir.realpath()), ['pheno_gz_site_index=true'], default_conf)
+    urls = ['/api/region/snowstorm/lz-results/?filter=chromosome%20in%20%20%278%27%20and%20position%20ge%20976279%20and%20position%20le%201276279',
+            '/api/region/EAR-LENGTH/lz-results/?filter=chromosome%20in%20%20%271%27%20and%20position%20ge%200%20and%20position%20le%20300000000',
+            '/api/variant/1-869334-G-A']
+    assert get_responses(conf, urls) == get_responses(default_conf, urls)
+    with gzip.open(os.path.join(get_data_dir(conf), 'generated-by-pheweb', 'matrix.tsv.gz')) as f1, \
+         gzip.open(os.path.join(get_data_dir(default_conf), 'generated-by-pheweb', 'matrix.tsv.gz')) as f2:
+        assert f1.read() == f2.read()
+
+    # Downloads are compressed differently, but have the same contents
+    download_urls = ['/download/snowstorm', '/download/EAR-LENGTH']
+    downloads, default_downloads = get_responses(conf, download_urls), get_responses(default_conf, download_urls)
+    for url in download_urls:
+        assert downloads[url][0] == default_downloads[url][0] == 200
+        assert gzip.decompress(downloads[url][1].encode('latin-1')) == gzip.decompress(default_downloads[url][1].encode('latin-1'))
+
+    os.remove(os.path.join(get_data_dir(conf), 'generated-by-pheweb', 'pheno_gz', 'EAR-LENGTH.gz'))
+    assert get_responses(conf, ['/download/EAR-LENGTH'])['/download/EAR-LENGTH'][0] == 404
+
+def test_pheno_sidecars(tmpdir, default_conf):
+    conf = process(str(tmpdir.realpath()), ['pheno_sidecars=true', 'qq_streaming=true'], default_conf)
+    with open(os.path.join(get_data_dir(conf), 'pheno-list.json')) as f:
+        phenocodes = [urllib.parse.quote(pheno['phenocode'], safe='') for pheno in json.load(f)]
+    urls = ['/api/{}/pheno/{}.json'.format(kind, phenocode) for kind in ['manhattan', 'qq'] for phenocode in phenocodes]
+    default_responses = get_responses(default_conf, urls)
+    assert get_responses(conf, urls) == default_responses
+
+    # The phenocode with special characters is saved under a quoted filename that these URLs don't find, so it's skipped.
+    # Filtering by maf errors without sidecars for phenos without mafs, so it's only checked for phenos with mafs.
+    # (The mafs are compared in float32 with sidecars, but none of these filters are that close to a maf.)
+    phenocodes = [phenocode for phenocode in phenocodes if default_responses['/api/qq/pheno/{}.json'.format(phenocode)][0] == 200]
+    phenocodes_with_maf = [phenocode for phenocode in phenocodes if 'by_maf' in json.loads(default_responses['/api/qq/pheno/{}.json'.format(phenocode)][1])]
+    assert phenocodes_with_maf
+    urls = ['/api/manhattan-filtered/pheno/{}.json?{}'.format(phenocode, filter_) for phenocode in phenocodes for filter_ in ['indel=true', 'indel=false', 'csq=lof', 'csq=nonsyn']]
+    urls += ['/api/manhattan-filtered/pheno/{}.json?{}'.format(phenocode, filter_) for phenocode in phenocodes_with_maf for filter_ in ['min_maf=0.05', 'max_maf=0.25', 'indel=false&min_maf=0.01&max_maf=0.4']]
+    assert get_responses(conf, urls) == get_responses(default_conf, urls)
+
+    # Phenos with more variants are summarized in a `QQSketch`, which only keeps the counts and confidence intervals exact.
+    for filepath in glob.glob(os.path.join(get_data_dir(conf), 'generated-by-pheweb', 'qq', '*.json')): os.remove(filepath)
+    run_python('import sys, json; from pheweb.command_line import run; from pheweb.load import qq; qq.SKETCH_MIN_NUM_VARIANTS = 0; run(json.loads(sys.argv[1]) + ["summarize-phenos"])', conf)
+    urls = ['/api/qq/pheno/{}.json'.format(phenocode) for phenocode in phenocodes]
+    from pheweb.load.qq import SKETCH_GC_LAMBDA_TOLERANCE
+    for (status, data), (default_status, default_data) in zip(get_responses(conf, urls).values(), get_responses(default_conf, urls).values()):
+        qq, default_qq = json.loads(data), json.loads(default_data)
+        assert status == default_status == 200
+        assert qq['ci'] == default_qq['ci']
+        assert qq['overall']['count'] == default_qq['overall']['count']
+        assert [stratum['count'] for stratum in qq.get('by_maf', [])] == [stratum['count'] for stratum in default_qq.get('by_maf', [])]
+        for perc, gc_lambda in default_qq['overall']['gc_lambda'].items():
+            if 0.8 <= gc_lambda <= 2:
+                assert abs(qq['overall']['gc_lambda'][perc] / gc_lambda - 1) < SKETCH_GC_LAMBDA_TOLERANCE
+
+def test_repeated_variant(tmpdir):
+    # A variant that's repeated in an input file is repeated in sites.tsv, and each copy gets its own row of it.
+    input_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'input_files/'))
+    with open(os.path.join(input_dir, 'assoc-files', 'snowstorm.txt')) as f:
+        lines = f.readlines()
+    assoc_filepath = str(tmpdir / 'repeated.txt')
+    with open(assoc_filepath, 'w') as f:
+        f.writelines(lines[:2] + lines[1:])
+    pheno_gz_lines = []
+    for extra_conf in [[], ['pheno_gz_site_index=true']]:
+        data_dir = str(tmpdir.mkdir('site-index' if extra_conf else 'default').realpath())
+        with open(os.path.join(data_dir, 'pheno-list.json'), 'w') as f:
+            json.dump([{'phenocode': 'repeated', 'assoc_files': [assoc_filepath]},
+                       {'phenocode': 'snowstorm', 'assoc_files': [os.path.join(input_dir, 'assoc-files', 'snowstorm.txt')]}], f)
+        conf = ['conf', 'data_dir="{}"'.format(data_dir), 'cache="{}"'.format(os.path.join(input_dir, 'fake-cache')), 'disallow_downloads=true'] + extra_conf
+        cl_run_in_new_process(conf+['process'])
+        with gzip.open(os.path.join(data_dir, 'generated-by-pheweb', 'pheno_gz', 'repeated.gz'), 'rt') as f:
+            pheno_gz_lines.append(f.readlines())
+        assert gzip.decompress(get_responses(conf, ['/download/repeated'])['/download/repeated'][1].encode('latin-1')).decode().splitlines(True) == pheno_gz_lines[0]
+    assert pheno_gz_lines[0][1] == pheno_gz_lines[0][2]
+    assert [int(line.split('\t')[2]) for line in pheno_gz_lines[1][1:3]] == [0, 1]
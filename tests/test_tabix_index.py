@@ -0,0 +1,46 @@
+"""Test that the tabix indexes pheweb builds while writing files match pysam's"""
+
+import os
+import random
+import shutil
+
+import pysam
+import pytest
+
+from pheweb.file_utils import IndexedVariantFileWriter, _read_tabix_index
+
+
+@pytest.fixture(scope='module')
+def variant_file(tmpdir_factory):
+    """Write a file of many BGZF blocks, with gaps that leave some windows of the linear index empty"""
+    filepath = str(tmpdir_factory.mktemp('tabix') / 'variants.tsv.gz')
+    rng = random.Random(0)
+    with IndexedVariantFileWriter(filepath, fields=['chrom', 'pos', 'ref', 'alt', 'pval']) as writer:
+        for chrom in ['1', '2', '10', 'X']:
+            pos = 0
+            for i in range(40_000):
+                pos += rng.choice([0, 1, 10, 300, 5000]) if i % 1000 else 300_000
+                writer.write({'chrom': chrom, 'pos': pos + 1, 'ref': 'A', 'alt': 'G', 'pval': rng.random()})
+    return filepath
+
+
+def assert_same_index_as_pysam(filepath, line_skip):
+    # The bins can be in a different order than in pysam's `.tbi`, so compare the parsed indexes.
+    pysam_filepath = filepath + '.pysam.gz'
+    shutil.copy(filepath, pysam_filepath)
+    pysam.tabix_index(pysam_filepath, force=True, seq_col=0, start_col=1, end_col=1, line_skip=line_skip)
+    assert _read_tabix_index(filepath + '.tbi') == _read_tabix_index(pysam_filepath + '.tbi')
+
+
+def test_python_index_matches_pysam(variant_file):
+    assert os.path.getsize(variant_file) > 2**20, "The file has many blocks"
+    assert_same_index_as_pysam(variant_file, line_skip=1)
+
+
+def test_cxx_index_matches_pysam(variant_file):
+    from pheweb.load.cffi._x import ffi, lib
+    from pheweb.load.matrix import check_cffi_return_value
+    matrix_filepath = os.path.join(os.path.dirname(variant_file), 'matrix.tsv.gz')
+    # Without phenos, this writes the per-variant fields of `variant_file`
+    check_cffi_return_value(lib.cffi_make_matrix_shard(variant_file.encode('utf8'), ffi.new('const char *[]', []), 0, matrix_filepath.encode('utf8'), 1, False))
+    assert_same_index_as_pysam(matrix_filepath, line_skip=0)